@@ -0,0 +1,309 @@
+#!/usr/bin/python3
+
+# Import packages for arguments parsing
+import sys
+import textwrap
+import argparse
+
+# Parse arguments
+parser = argparse.ArgumentParser(description="Benchmark the turret detection pipeline without a camera.",
+                                epilog=textwrap.dedent('''
+                                .  Available stages:
+                                .  --------------------------------
+                                .  motion:               detect.motion_detection
+                                .  upperbody-face:       detect.double_cascade
+                                .  face-recognition:     detect.face_recognition
+                                .  upperbody:            detect.single_cascade, upperbody cascade
+                                .  fullbody:             detect.single_cascade, fullbody cascade
+                                .  people:               detect.hog_people
+                                .  people-threaded:      detect.hog_people, pyramid levels shared by 4 threads
+                                .  rotate:               imgutils.rotate_bound
+                                .  save:                 save.save, into a temporary directory
+
+                                .  Example, store a baseline then check against it:
+                                .  python3 benchmark.py -o baseline.json
+                                .  python3 benchmark.py -b baseline.json
+
+                                .  Accuracy per CPU-ms of person detectors, against annotated frames:
+                                .  python3 benchmark.py -i frames/ -t upperbody,fullbody,people --truth people.json
+                                .  people.json maps frame numbers, in input order, to person boxes:
+                                .  {"0": [[120, 40, 210, 300]], "1": [], ...}; frames missing have nobody.
+                                .  A detection is correct if at least half of it lies inside a person
+                                .  not matched yet, so face and upperbody boxes count too.
+
+                            '''), formatter_class=argparse.RawDescriptionHelpFormatter,)
+
+parser.add_argument("-i", help="Replay frames from a directory of images or a video file, see turret.py -h. Default is synthetic frames.")
+parser.add_argument("-n", help="Number of frames per stage (default 200)", type=int, default=200)
+parser.add_argument("-w", help="Warm-up frames per stage, not measured (default 10)", type=int, default=10)
+parser.add_argument("-t", help="Stages to run, comma separated (default all)")
+parser.add_argument("-r", help="Rotation angle for the rotate stage (default 90)", type=int, default=90)
+parser.add_argument("-o", help="Write results to this JSON file")
+parser.add_argument("-b", help="Compare results against this baseline JSON file")
+parser.add_argument("--tolerance", help="Allowed slowdown against the baseline (default 0.15)", type=float, default=0.15)
+parser.add_argument("--truth", help="Score detections against person boxes in this JSON file, see below")
+parser.add_argument("--hog", help="HOG people detector settings, e.g. scale=1.05,stride=8, see modules/detect.py")
+parser.add_argument("--threads", help="Number of OpenCV threads (default 1, for reproducible results)", type=int, default=1)
+
+args = parser.parse_args()
+
+# Import standard packages
+import os
+import json
+import time
+import shutil
+import datetime
+import platform
+import resource
+import tempfile
+
+# Import external packages
+import cv2
+import numpy
+
+# Import project packages
+from modules import imgutils
+from modules import detect
+from modules import save
+from modules import source
+
+# Frame width and height
+WIDTH  = 640
+HEIGHT = 480
+
+def load_frames(n):
+    """
+    Load n frames in memory, so decoding is not measured
+    Recorded inputs shorter than n frames are looped
+    Return the frames and their numbers in the input
+    """
+    if args.i: frames_input = source.open_source(args.i, pace="fast", width=WIDTH, height=HEIGHT)
+    else: frames_input = source.SyntheticSource(n, pace="fast", width=WIDTH, height=HEIGHT)
+    frames = list()
+    while len(frames) < n:
+        frame = frames_input.read()
+        if frame is None: break
+        frames.append(frame)
+    frames_input.release()
+    if len(frames) == 0:
+        sys.exit("No frames found in %s" % (args.i))
+    return [frames[i % len(frames)] for i in range(n)], [i % len(frames) for i in range(n)]
+
+def peak_rss():
+    """
+    Peak resident set size of this process, in MiB
+    """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS reports bytes
+    return rss/1024 if sys.platform != "darwin" else rss/(1024*1024)
+
+# Stages, each one processes a frame it may modify
+# Detection stages return the boxes they found
+def stage_motion(frame):
+    return detect.motion_detection(frame, thresh=50, drawboxes=False, return_objects=True)[2]
+
+def stage_double_cascade(frame):
+    return detect.double_cascade(frame, return_objects=True)[2]
+
+def stage_face_recognition(frame):
+    return [coords for coords, _, _ in detect.face_recognition(frame, return_objects=True)[2]]
+
+def stage_upperbody(frame):
+    return detect.single_cascade(frame, return_objects=True)[2]
+
+def stage_fullbody(frame):
+    return detect.single_cascade(frame, detect.load('fullbody'), return_objects=True, min_rectangle=(30,60))[2]
+
+def stage_people(frame):
+    return detect.hog_people(frame, return_objects=True)[2]
+
+def stage_people_threaded(frame):
+    return detect.hog_people(frame, return_objects=True, threads=4)[2]
+
+def stage_rotate(frame):
+    imgutils.rotate_bound(frame, args.r)
+
+def stage_save(frame):
+    save.save(frame, datetime.datetime.now())
+
+stages = [  ('motion', stage_motion),
+            ('upperbody-face', stage_double_cascade),
+            ('face-recognition', stage_face_recognition),
+            ('upperbody', stage_upperbody),
+            ('fullbody', stage_fullbody),
+            ('people', stage_people),
+            ('people-threaded', stage_people_threaded),
+            ('rotate', stage_rotate),
+            ('save', stage_save) ]
+
+# Dependencies and models each stage loads, see detect.loaders
+stage_requirements = {  'upperbody-face': detect.requirements['upperbody-face'],
+                        'face-recognition': detect.requirements['face-recognition'],
+                        'upperbody': ('upperbody',),
+                        'fullbody': ('fullbody',),
+                        'people': detect.requirements['people'],
+                        'people-threaded': detect.requirements['people'] }
+
+def missing_requirement(name):
+    """
+    Load what a stage needs
+    Return why it can not run, or None if it can
+    """
+    for requirement in stage_requirements.get(name, ()):
+        try: detect.load(requirement)
+        except (ImportError, OSError, KeyError, ValueError) as error:
+            return '%s: %s' % (requirement, error)
+    return None
+
+def run_stage(name, function, frames, truth=None):
+    """
+    Run a stage over all frames and return its statistics
+    CPU time counts every thread, so threaded stages are not favoured
+    """
+    for frame in frames[:args.w]:
+        function(frame.copy())
+    frames = frames[args.w:]
+    latencies = numpy.empty(len(frames))
+    cpu = numpy.empty(len(frames))
+    found = list()
+    for i, frame in enumerate(frames):
+        frame = frame.copy()
+        start, start_cpu = time.perf_counter(), time.process_time()
+        boxes = function(frame)
+        latencies[i] = time.perf_counter() - start
+        cpu[i] = time.process_time() - start_cpu
+        found.append(boxes)
+    latencies *= 1000
+    cpu *= 1000
+    stats = {   'frames': len(frames),
+                'mean_ms': float(numpy.mean(latencies)),
+                'p50_ms': float(numpy.percentile(latencies, 50)),
+                'p95_ms': float(numpy.percentile(latencies, 95)),
+                'p99_ms': float(numpy.percentile(latencies, 99)),
+                'fps': float(1000/numpy.mean(latencies)),
+                'cpu_ms': float(numpy.mean(cpu)),
+                'peak_rss_mb': peak_rss() }
+    if truth is not None and all(boxes is not None for boxes in found):
+        correct, detections, people = score(found, truth[args.w:])
+        precision = correct/detections if detections else 1.0
+        recall = correct/people if people else 1.0
+        f1 = 2*precision*recall/(precision + recall) if precision + recall > 0 else 0.0
+        stats.update({  'precision': precision,
+                        'recall': recall,
+                        'f1': f1,
+                        'f1_per_cpu_ms': f1/max(stats['cpu_ms'], 1e-6) })
+    return stats
+
+def score(found, truth):
+    """
+    Count correct detections, detections and people over all frames
+    A detection is correct if at least half of it lies inside a person
+    not matched yet
+    """
+    correct = detections = people = 0
+    for boxes, persons in zip(found, truth):
+        persons = list(persons)
+        detections += len(boxes)
+        people += len(persons)
+        for x1, y1, x2, y2 in boxes:
+            area = max((x2 - x1)*(y2 - y1), 1)
+            best, best_inside = None, 0.5
+            for person in persons:
+                w = min(x2, person[2]) - max(x1, person[0])
+                h = min(y2, person[3]) - max(y1, person[1])
+                inside = max(w, 0)*max(h, 0)/area
+                if inside >= best_inside: best, best_inside = person, inside
+            if best is not None:
+                persons.remove(best)
+                correct += 1
+    return correct, detections, people
+
+def compare(results, baseline, tolerance):
+    """
+    Print a comparison against a baseline
+    Return the list of regressed stages
+    """
+    regressions = list()
+    print()
+    print('%-18s %12s %12s %8s' % ('stage', 'baseline p95', 'p95', 'change'))
+    for name in baseline['stages']:
+        if name in results['skipped']: print('%-18s %10.2fms %12s' % (name, baseline['stages'][name]['p95_ms'], 'skipped'))
+    for name, stats in results['stages'].items():
+        if name not in baseline['stages']: continue
+        before = baseline['stages'][name]['p95_ms']
+        change = stats['p95_ms']/before - 1 if before > 0 else 0.0
+        flag = ''
+        if change > tolerance:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print('%-18s %10.2fms %10.2fms %+7.1f%%%s' % (name, before, stats['p95_ms'], 100*change, flag))
+    return regressions
+
+if __name__ == "__main__":
+
+    cv2.setNumThreads(args.threads)
+
+    if args.hog:
+        try: detect.hog_settings.update(detect.parse_hog_settings(args.hog))
+        except ValueError as error: parser.error(str(error))
+
+    selected = args.t.split(',') if args.t else [name for name, _ in stages]
+    unknown = set(selected) - set(name for name, _ in stages)
+    if unknown: sys.exit("Unknown stages: %s" % (', '.join(sorted(unknown))))
+
+    frames, numbers = load_frames(args.n + args.w)
+
+    truth = None
+    if args.truth:
+        with open(args.truth) as truth_file:
+            people = json.load(truth_file)
+        truth = [people.get(str(number), []) for number in numbers]
+
+    results = { 'date': str(datetime.datetime.now())[:19],
+                'host': platform.node(),
+                'python': platform.python_version(),
+                'opencv': cv2.__version__,
+                'input': args.i or 'synthetic',
+                'threads': args.threads,
+                'truth': args.truth,
+                'stages': dict(),
+                'skipped': dict() }
+
+    print('%-18s %8s %8s %8s %8s %8s %8s' % ('stage', 'p50', 'p95', 'p99', 'cpu', 'fps', 'rss'))
+    cwd = os.getcwd()
+    for name, function in stages:
+        if name not in selected: continue
+        # Stages whose dependencies are missing are left out of the results
+        missing = missing_requirement(name)
+        if missing is not None:
+            results['skipped'][name] = missing
+            print('%-18s skipped, %s' % (name, missing))
+            continue
+        # save.save writes to detected/ under the current directory
+        tmpdir = tempfile.mkdtemp(prefix='turret-benchmark-') if name == 'save' else None
+        if tmpdir: os.chdir(tmpdir)
+        try:
+            stats = run_stage(name, function, frames, truth)
+        finally:
+            if tmpdir:
+                os.chdir(cwd)
+                shutil.rmtree(tmpdir, ignore_errors=True)
+        results['stages'][name] = stats
+        print('%-18s %6.2fms %6.2fms %6.2fms %6.2fms %8.1f %6.0fMB' % (name, stats['p50_ms'], stats['p95_ms'], stats['p99_ms'], stats['cpu_ms'], stats['fps'], stats['peak_rss_mb']))
+
+    scored = [(name, stats) for name, stats in results['stages'].items() if 'f1' in stats]
+    if scored:
+        print()
+        print('%-18s %9s %9s %9s %12s' % ('stage', 'precision', 'recall', 'f1', 'f1/cpu-ms'))
+        for name, stats in sorted(scored, key=lambda item: -item[1]['f1_per_cpu_ms']):
+            print('%-18s %9.3f %9.3f %9.3f %12.4f' % (name, stats['precision'], stats['recall'], stats['f1'], stats['f1_per_cpu_ms']))
+
+    if args.o:
+        with open(args.o, 'w') as output:
+            json.dump(results, output, indent=4, sort_keys=True)
+
+    if args.b:
+        with open(args.b) as baseline_file:
+            baseline = json.load(baseline_file)
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
@@ -0,0 +1,501 @@
+"""
+Packed per-day archive of detected frames.
+
+A day folder holds frames.pack, the JPEG frames appended one after the
+other, and frames.idx, one fixed-size record per frame with its capture
+time, offset and length in the pack and flags. Both files are append
+only: a frame is written to the pack before its record, so a crash at
+worst leaves unindexed bytes, which the next writer truncates.
+
+Frames keep the names loose files have, e.g. 2019-03-05 14h02m59.123s.jpg,
+so a packed frame is addressed by the same path as before and read()
+returns it whether it is a loose file or packed.
+
+Pack existing day folders with:
+
+    python3 -m modules.archive detected/
+"""
+# coding: utf-8
+
+# Standard imports
+import os
+import re
+import mmap
+import time
+import argparse
+import datetime
+import threading
+import collections
+
+try: import fcntl
+except ImportError: fcntl = None
+
+# External imports
+import numpy
+
+PACK = 'frames.pack'
+INDEX = 'frames.idx'
+
+# Index record: capture time in ms since the epoch (local time), offset
+# and length of the JPEG in the pack, flags
+RECORD = numpy.dtype([('time', '<i8'), ('offset', '<u8'), ('length', '<u4'), ('flags', '<u4')])
+
+# Flags
+DETECTION = 1
+MIGRATED = 2
+
+# Frame names, e.g. 2019-03-05 14h02m59.123s.jpg
+FRAME_NAME = re.compile(r'^(\d{4})-(\d{2})-(\d{2}) (\d{2})h(\d{2})m(\d{2})\.(\d{3})s\.jpg$')
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+def to_ms(img_time):
+    """Milliseconds since the epoch of a naive datetime.
+    """
+    delta = img_time - EPOCH
+    return (delta.days*86400 + delta.seconds)*1000 + delta.microseconds//1000
+
+def from_ms(ms):
+    """Naive datetime of milliseconds since the epoch.
+    """
+    return EPOCH + datetime.timedelta(milliseconds=int(ms))
+
+def frame_name(img_time):
+    """Name of a frame captured at a time, as given to loose files.
+    """
+    return str(img_time)[:10] + ' ' + '%02dh%02dm%02d.%03ds.jpg' % (img_time.hour, img_time.minute, img_time.second, img_time.microsecond//1000)
+
+def parse_name(name):
+    """Capture time of a frame name, or None if it is not one.
+    """
+    match = FRAME_NAME.match(name)
+    if match is None:
+        return None
+    Y, M, D, h, m, s, ms = [int(g) for g in match.groups()]
+    return datetime.datetime(Y, M, D, h, m, s, 1000*ms)
+
+class Writer(object):
+    """Append frames to the pack of a day folder.
+
+        Attributes:
+            path: the day folder.
+
+    """
+
+    def __init__(self, path):
+        """Writer constructor.
+
+            Opens the pack and index for appending, creating them if
+            needed, and drops any partial write left by a crash. A day
+            has a single writer at a time.
+
+            Args:
+                path: the day folder.
+
+            Returns:
+                A Writer object.
+
+            Raises:
+                OSError: if the files can not be opened, or another
+                         writer has them open.
+
+        """
+        self.path = path
+        if not os.path.exists(path):
+            os.makedirs(path, exist_ok=True)
+        self._index = open(os.path.join(path, INDEX), 'ab+')
+        if fcntl is not None:
+            try: fcntl.flock(self._index.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                self._index.close()
+                raise OSError("Archive in %s is being written by another process" % (path))
+        self._pack = open(os.path.join(path, PACK), 'ab+')
+        # Drop a partial record, then unindexed pack bytes
+        size = os.fstat(self._index.fileno()).st_size
+        size -= size % RECORD.itemsize
+        self._index.truncate(size)
+        end = 0
+        if size > 0:
+            self._index.seek(size - RECORD.itemsize)
+            last = numpy.frombuffer(self._index.read(RECORD.itemsize), dtype=RECORD)[0]
+            end = int(last['offset']) + int(last['length'])
+        self._pack.truncate(end)
+        self._end = end
+
+    def append(self, data, img_time, flags=DETECTION):
+        """Append an encoded frame.
+
+            Args:
+                data: the JPEG bytes.
+                img_time: the time of capture.
+                flags: DETECTION, MIGRATED or their combination.
+
+            Returns:
+                The number of bytes appended to the pack.
+
+            Raises:
+                OSError: if the frame can not be written.
+
+        """
+        data = bytes(data)
+        self._pack.write(data)
+        self._pack.flush()
+        record = numpy.array([(to_ms(img_time), self._end, len(data), flags)], dtype=RECORD)
+        self._index.write(record.tobytes())
+        self._index.flush()
+        self._end += len(data)
+        return len(data)
+
+    def sync(self):
+        """Flush both files to disk.
+        """
+        os.fsync(self._pack.fileno())
+        os.fsync(self._index.fileno())
+
+    def close(self):
+        self._pack.close()
+        self._index.close()
+
+class Archive(object):
+    """Append frames to the day folders under a root, switching day as
+    time goes by.
+
+        Attributes:
+            root: the folder holding the day hierarchy, e.g. detected.
+
+    """
+
+    def __init__(self, root="detected"):
+        self.root = root
+        self._day = None
+        self._writer = None
+
+    def daypath(self, img_time):
+        return "/".join((self.root, str(img_time.year), str(img_time.month) + ". " + img_time.strftime('%B'), str(img_time.day)))
+
+    def append(self, data, img_time, flags=DETECTION):
+        """Append an encoded frame to the pack of its day.
+
+            Args:
+                data: the JPEG bytes.
+                img_time: the time of capture.
+                flags: see Writer.append().
+
+            Returns:
+                The path the frame is read back from.
+
+            Raises:
+                OSError: if the frame can not be written.
+
+        """
+        day = img_time.date()
+        if day != self._day:
+            self.close()
+            self._writer = Writer(self.daypath(img_time))
+            self._day = day
+        self._writer.append(data, img_time, flags)
+        return "/".join((self._writer.path, frame_name(img_time)))
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+        self._writer = None
+        self._day = None
+
+class Reader(object):
+    """Read the frames packed in a day folder.
+
+        The index and pack are memory mapped. refresh() maps frames
+        appended since, so a reader follows a live writer.
+
+        Attributes:
+            path: the day folder.
+            index: the index records, a numpy structured array.
+
+    """
+
+    def __init__(self, path):
+        """Reader constructor.
+
+            Args:
+                path: the day folder.
+
+            Returns:
+                A Reader object.
+
+            Raises:
+                OSError: if the day has no pack.
+
+        """
+        self.path = path
+        self.index = numpy.zeros(0, dtype=RECORD)
+        self._size = -1
+        self._pack = None
+        self._pack_size = 0
+        self._names = dict()
+        self._lock = threading.Lock()
+        if not os.path.exists(os.path.join(path, INDEX)):
+            raise OSError("No archive in %s" % (path))
+        self.refresh()
+
+    def refresh(self):
+        """Map frames appended since the last refresh.
+
+            Returns:
+                True if new frames were found.
+
+            Raises:
+
+        """
+        with self._lock:
+            size = os.path.getsize(os.path.join(self.path, INDEX))
+            size -= size % RECORD.itemsize
+            if size == self._size:
+                return False
+            if size > 0:
+                self.index = numpy.memmap(os.path.join(self.path, INDEX), dtype=RECORD, mode='r', shape=(size//RECORD.itemsize,))
+            else:
+                self.index = numpy.zeros(0, dtype=RECORD)
+            known = self._size//RECORD.itemsize if self._size > 0 else 0
+            self._names.update((frame_name(from_ms(t)), known + i) for i, t in enumerate(self.index['time'][known:].tolist()))
+            self._size = size
+            return True
+
+    def __len__(self):
+        return len(self.index)
+
+    def times(self):
+        """Capture times of all frames, in ms since the epoch.
+        """
+        return numpy.asarray(self.index['time'])
+
+    def names(self):
+        """Names of all frames, in pack order.
+        """
+        return [frame_name(from_ms(t)) for t in self.index['time'].tolist()]
+
+    def find(self, name):
+        """Position of a frame in the pack, or None.
+        """
+        i = self._names.get(name)
+        if i is None and self.refresh():
+            i = self._names.get(name)
+        return i
+
+    def read(self, i):
+        """JPEG bytes of the i-th frame.
+        """
+        record = self.index[i]
+        offset, length = int(record['offset']), int(record['length'])
+        with self._lock:
+            if self._pack is None or offset + length > self._pack_size:
+                if self._pack is not None: self._pack.close()
+                with open(os.path.join(self.path, PACK), 'rb') as pack:
+                    self._pack_size = os.fstat(pack.fileno()).st_size
+                    self._pack = mmap.mmap(pack.fileno(), 0, access=mmap.ACCESS_READ)
+            return self._pack[offset:offset + length]
+
+    def close(self):
+        """Unmap the index and the pack, a later refresh() maps them again.
+        """
+        with self._lock:
+            if self._pack is not None: self._pack.close()
+            self._pack = None
+            self._pack_size = 0
+            self.index = numpy.zeros(0, dtype=RECORD)
+            self._names = dict()
+            self._size = -1
+
+class Readers(object):
+    """Readers of day folders, kept open for the most recently used days.
+
+        At most size readers are open, the least recently used one is
+        closed when another day is opened. A folder without a reader is
+        looked at again only after retry seconds.
+
+        Attributes:
+            open: the reader constructor, called with a day folder and
+                  raising OSError if the day has nothing to read.
+            size: maximum number of open readers.
+            retry: seconds before a folder without a reader is looked at
+                   again.
+
+    """
+
+    def __init__(self, open, size=64, retry=0.0):
+        self.open = open
+        self.size = size
+        self.retry = retry
+        self._readers = collections.OrderedDict()
+        self._missing = dict()
+        self._lock = threading.Lock()
+
+    def get(self, path):
+        """The reader of a day folder, or None if it has nothing to read.
+        """
+        path = os.path.normpath(path)
+        with self._lock:
+            reader = self._readers.get(path)
+            if reader is not None:
+                self._readers.move_to_end(path)
+                return reader
+            now = time.monotonic()
+            if path in self._missing and now - self._missing[path] < self.retry:
+                return None
+            try: reader = self.open(path)
+            except OSError:
+                self._missing[path] = now
+                return None
+            self._missing.pop(path, None)
+            self._readers[path] = reader
+            while len(self._readers) > self.size:
+                _, evicted = self._readers.popitem(last=False)
+                evicted.close()
+            return reader
+
+    def close(self):
+        """Close all open readers.
+        """
+        with self._lock:
+            while self._readers:
+                _, reader = self._readers.popitem(last=False)
+                reader.close()
+
+# Readers are kept open for the most recently used days
+readers = Readers(Reader)
+
+def reader(path):
+    """The Reader of a day folder, or None if it has no pack.
+    """
+    return readers.get(path)
+
+def names(path):
+    """Names of all frames of a day folder, loose and packed, sorted.
+
+        Args:
+            path: the day folder.
+
+        Returns:
+            A sorted list of frame names, empty if the folder is missing.
+
+        Raises:
+
+    """
+    frames = set()
+    for (_, _, filenames) in os.walk(path):
+        frames.update(f for f in filenames if f.lower().endswith(IMAGE_EXTENSIONS))
+        break
+    packed = reader(path)
+    if packed is not None:
+        packed.refresh()
+        frames.update(packed.names())
+    return sorted(frames)
+
+def read(path):
+    """Bytes of a frame, from its loose file or from the pack of its day.
+
+        Args:
+            path: the frame path, day folder and frame name.
+
+        Returns:
+            The file content, or None if there is no such frame.
+
+        Raises:
+
+    """
+    try:
+        with open(path, 'rb') as frame:
+            return frame.read()
+    except OSError:
+        pass
+    packed = reader(os.path.dirname(path))
+    if packed is None:
+        return None
+    i = packed.find(os.path.basename(path))
+    return None if i is None else packed.read(i)
+
+def exists(path):
+    """True if a frame exists, loose or packed.
+    """
+    if os.path.exists(path):
+        return True
+    packed = reader(os.path.dirname(path))
+    return packed is not None and packed.find(os.path.basename(path)) is not None
+
+def size(path):
+    """Size of a frame in bytes, loose or packed, or 0 if missing.
+    """
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        pass
+    packed = reader(os.path.dirname(path))
+    i = None if packed is None else packed.find(os.path.basename(path))
+    return 0 if i is None else int(packed.index[i]['length'])
+
+def pack_day(path, keep=False, settle=5.0):
+    """Move the loose frames of a day folder into its pack.
+
+        Frames are appended in name order, then synced to disk, and only
+        then removed. Frames modified in the last settle seconds may
+        still be written and are left for a later run.
+
+        Args:
+            path: the day folder.
+            keep: if True, do not remove the loose frames.
+            settle: seconds a frame must be left untouched to be packed.
+
+        Returns:
+            The number of frames packed.
+
+        Raises:
+            OSError: if the pack can not be written.
+
+    """
+    packed = reader(path)
+    done = set(packed.names()) if packed is not None else set()
+    limit = time.time() - settle
+    frames = list()
+    for (_, _, filenames) in os.walk(path):
+        for name in sorted(filenames):
+            img_time = parse_name(name)
+            if img_time is None: continue
+            framepath = os.path.join(path, name)
+            if os.path.getmtime(framepath) > limit: continue
+            frames.append((name, img_time, framepath))
+        break
+    if not frames:
+        return 0
+    writer = Writer(path)
+    try:
+        for name, img_time, framepath in frames:
+            if name in done: continue
+            with open(framepath, 'rb') as frame:
+                writer.append(frame.read(), img_time, DETECTION | MIGRATED)
+        writer.sync()
+    finally:
+        writer.close()
+    if not keep:
+        for _, _, framepath in frames:
+            os.remove(framepath)
+    return len(frames)
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Pack the loose frames of day folders into per-day archives.")
+    parser.add_argument("root", help="A detected/ folder, or any folder under it")
+    parser.add_argument("-k", help="Keep the loose frames", action="store_true")
+    args = parser.parse_args()
+
+    total = 0
+    for (dirpath, dirnames, filenames) in os.walk(args.root):
+        dirnames[:] = [d for d in dirnames if d != 'clips']
+        if not any(parse_name(f) for f in filenames): continue
+        try: count = pack_day(dirpath, keep=args.k)
+        except OSError as error:
+            print("%s: %s" % (dirpath, error))
+            continue
+        if count > 0: print("%s: %d frames packed" % (dirpath, count))
+        total += count
+    print("%d frames packed" % (total))
@@ -0,0 +1,324 @@
+"""
+Registry of the cascade classifiers in resources/cascades, and detection
+pipelines composing them, described in a JSON file such as:
+
+    {
+        "eyes": {
+            "description": "Eyes inside frontal faces",
+            "stages": [
+                { "cascade": "haarcascade_frontalface_default", "min_size": [60, 60] },
+                { "cascade": "haarcascade_eye", "min_size": [15, 15], "neighbors": 5 }
+            ]
+        }
+    }
+
+The first stage searches the whole frame, every next stage searches
+inside each box found by the previous one. List the cascades, check them
+and the pipelines with:
+
+    python3 -m modules.cascades
+"""
+# coding: utf-8
+
+# Standard imports
+import os
+import re
+import json
+import time
+import argparse
+import threading
+
+# External imports
+import cv2
+
+DIRECTORY = "resources/cascades"
+PIPELINES = "resources/pipelines.json"
+
+# Stage settings and their defaults, see cv2.CascadeClassifier.detectMultiScale
+STAGE_DEFAULTS = {  'scale': 1.2,
+                    'neighbors': 3,
+                    'min_size': (60, 60),
+                    'max_size': None,
+                    'color': (0, 0, 255) }
+
+def _number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+def _size(value, length, low=0, high=None):
+    return isinstance(value, (list, tuple)) and len(value) == length and \
+           all(isinstance(v, int) and not isinstance(v, bool) and v >= low and (high is None or v <= high) for v in value)
+
+# Checks of stage settings and the values they expect
+STAGE_CHECKS = {    'cascade': (lambda v: isinstance(v, str) and v != '', 'a cascade name'),
+                    'scale': (lambda v: _number(v) and v > 1, 'a number above 1'),
+                    'neighbors': (lambda v: isinstance(v, int) and not isinstance(v, bool) and v >= 0, 'an integer of 0 or more'),
+                    'min_size': (lambda v: _size(v, 2), 'a [width, height] list of integers'),
+                    'max_size': (lambda v: v is None or _size(v, 2), 'a [width, height] list of integers or null'),
+                    'color': (lambda v: _size(v, 3, 0, 255), 'a [blue, green, red] list of integers from 0 to 255') }
+
+FEATURE_TYPE = re.compile(rb'<featureType>\s*(\w+)\s*</featureType>')
+EXPECTED = re.compile(r"\(expected: '([^']*)'\)")
+
+class Registry(object):
+    """Cascade classifiers found in a directory, loaded on first use and
+    shared by every caller.
+
+        Cascades are named after their file without the .xml extension,
+        e.g. haarcascade_upperbody. A cascade is checked when loaded:
+        files OpenCV can not parse raise ValueError with the reason,
+        instead of an empty classifier failing on the first frame.
+
+        Attributes:
+            directory: the folder holding the cascades.
+            loaded: name -> loaded cv2.CascadeClassifier.
+            load_times: name -> seconds spent loading.
+
+    """
+
+    def __init__(self, directory=DIRECTORY):
+        self.directory = directory
+        self.loaded = dict()
+        self.load_times = dict()
+        self._lock = threading.Lock()
+
+    def names(self):
+        """Names of all cascades in the directory, sorted.
+        """
+        try: files = os.listdir(self.directory)
+        except OSError: return []
+        return sorted(f[:-4] for f in files if f.endswith('.xml'))
+
+    def path(self, name):
+        """Path of a cascade.
+
+            Args:
+                name: the cascade name.
+
+            Returns:
+                The path of its file.
+
+            Raises:
+                KeyError: if there is no such cascade.
+
+        """
+        path = os.path.join(self.directory, name + '.xml')
+        if not os.path.isfile(path):
+            raise KeyError("No cascade named %s in %s" % (name, self.directory))
+        return path
+
+    def load(self, name):
+        """Return a cascade, loading it on first use.
+
+            Args:
+                name: the cascade name.
+
+            Returns:
+                A cv2.CascadeClassifier.
+
+            Raises:
+                KeyError: if there is no such cascade.
+                ValueError: if OpenCV can not load it.
+
+        """
+        try:
+            return self.loaded[name]
+        except KeyError:
+            pass
+        with self._lock:
+            if name not in self.loaded:
+                path = self.path(name)
+                start = time.monotonic()
+                try: classifier = cv2.CascadeClassifier(path)
+                except (cv2.error, SystemError) as error:
+                    message = str(error.__cause__ or error)
+                    match = EXPECTED.search(message)
+                    reason = "feature outside the window, expected %s" % (match.group(1)) if match else message.strip().splitlines()[-1]
+                    raise ValueError("Invalid cascade %s: %s" % (path, reason))
+                if classifier.empty():
+                    raise ValueError("Invalid cascade %s: no classifier found" % (path))
+                self.loaded[name] = classifier
+                self.load_times[name] = time.monotonic() - start
+            return self.loaded[name]
+
+    def describe(self, name):
+        """Feature type, window size and file size of a cascade.
+
+            Returns:
+                A dict with type, window (width, height), bytes and
+                load_ms, or error if the cascade can not be loaded.
+
+            Raises:
+                KeyError: if there is no such cascade.
+
+        """
+        path = self.path(name)
+        with open(path, 'rb') as cascade:
+            match = FEATURE_TYPE.search(cascade.read(64*1024))
+        info = {'type': match.group(1).decode() if match else 'HAAR', 'bytes': os.path.getsize(path)}
+        try: classifier = self.load(name)
+        except ValueError as error:
+            info['error'] = str(error)
+            return info
+        info['window'] = tuple(classifier.getOriginalWindowSize())
+        info['load_ms'] = 1000*self.load_times[name]
+        return info
+
+class Pipeline(object):
+    """Cascades applied one inside the other.
+
+        Attributes:
+            name: the pipeline name, used as detection mode.
+            description: a short description, shown in the GUI.
+            stages: list of stage settings dicts, see STAGE_DEFAULTS,
+                    each with the name of its cascade.
+
+    """
+
+    def __init__(self, name, description, stages):
+        """Pipeline constructor.
+
+            Args:
+                name: the pipeline name.
+                description: a short description.
+                stages: list of dicts with a cascade name and optional
+                        settings, see STAGE_DEFAULTS.
+
+            Returns:
+                A Pipeline object.
+
+            Raises:
+                ValueError: if a stage has no cascade, unknown settings or
+                            settings of the wrong type.
+
+        """
+        self.name = name
+        self.description = description
+        self.stages = list()
+        if not stages:
+            raise ValueError("Pipeline %s has no stages" % (name))
+        if not isinstance(stages, list):
+            raise ValueError("Stages of pipeline %s are not a list" % (name))
+        for i, stage in enumerate(stages):
+            if not isinstance(stage, dict):
+                raise ValueError("Stage %d of pipeline %s is not an object" % (i + 1, name))
+            if 'cascade' not in stage:
+                raise ValueError("Stage %d of pipeline %s has no cascade" % (i + 1, name))
+            unknown = set(stage) - set(STAGE_DEFAULTS) - set(['cascade'])
+            if unknown:
+                raise ValueError("Unknown settings in stage %d of pipeline %s: %s" % (i + 1, name, ', '.join(sorted(unknown))))
+            for key, value in sorted(stage.items()):
+                check, expected = STAGE_CHECKS[key]
+                if not check(value):
+                    raise ValueError("Invalid %s in stage %d of pipeline %s: %r, expected %s" % (key, i + 1, name, value, expected))
+            settings = dict(STAGE_DEFAULTS, **stage)
+            settings['min_size'] = tuple(settings['min_size'])
+            settings['max_size'] = tuple(settings['max_size']) if settings['max_size'] else (0, 0)
+            settings['color'] = tuple(settings['color'])
+            settings['metric'] = '%s/%d.%s' % (name, i + 1, settings['cascade'])
+            self.stages.append(settings)
+
+    @property
+    def cascades(self):
+        return [stage['cascade'] for stage in self.stages]
+
+    def __call__(self, frame, registry, timer=None):
+        """Run the pipeline on a frame.
+
+            Args:
+                frame: a cv2 image.
+                registry: the Registry loading the cascades.
+                timer: function returning a context manager timing a
+                       stage by name, e.g. Metrics.stage, or None.
+
+            Returns:
+                A list of boxes per stage, as top-left and bottom-right,
+                x and y, in frame scale; the last list holds the boxes
+                found by the whole pipeline.
+
+            Raises:
+
+        """
+        found = list()
+        regions = [(0, 0, frame.shape[1], frame.shape[0])]
+        for stage in self.stages:
+            cascade = registry.load(stage['cascade'])
+            boxes = list()
+            with timer(stage['metric']) if timer is not None else _NO_TIMER:
+                for x1, y1, x2, y2 in regions:
+                    crop = frame[y1:y2, x1:x2]
+                    if crop.shape[0] < stage['min_size'][1] or crop.shape[1] < stage['min_size'][0]: continue
+                    rects = cascade.detectMultiScale(crop, stage['scale'], stage['neighbors'], 0, stage['min_size'], stage['max_size'])
+                    boxes.extend((int(x1 + x), int(y1 + y), int(x1 + x + w), int(y1 + y + h)) for x, y, w, h in rects)
+            found.append(boxes)
+            regions = boxes
+            if not regions: break
+        while len(found) < len(self.stages):
+            found.append([])
+        return found
+
+class _NoTimer(object):
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        return False
+
+_NO_TIMER = _NoTimer()
+
+def load_pipelines(path, registry):
+    """Read pipelines from a JSON file and check their cascades exist.
+
+        Args:
+            path: the JSON file, see the module documentation.
+            registry: the Registry the cascades are looked up in.
+
+        Returns:
+            A dict of name -> Pipeline, in file order.
+
+        Raises:
+            OSError: if the file can not be read.
+            ValueError: if the file is not valid, has settings of the
+                        wrong type, or names a missing cascade.
+
+    """
+    with open(path) as pipelines_file:
+        try: config = json.load(pipelines_file)
+        except ValueError as error:
+            raise ValueError("Invalid pipelines file %s: %s" % (path, error))
+    if not isinstance(config, dict):
+        raise ValueError("Invalid pipelines file %s: expected an object of pipelines" % (path))
+    pipelines = dict()
+    for name, description in config.items():
+        if not isinstance(description, dict):
+            raise ValueError("Invalid pipelines file %s: pipeline %s is not an object" % (path, name))
+        pipeline = Pipeline(name, description.get('description', name), description.get('stages'))
+        for cascade in pipeline.cascades:
+            try: registry.path(cascade)
+            except KeyError as error: raise ValueError("Pipeline %s: %s" % (name, error.args[0]))
+        pipelines[name] = pipeline
+    return pipelines
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Check the cascades and cascade pipelines.")
+    parser.add_argument("-d", help="Cascades directory (default %s)" % (DIRECTORY), default=DIRECTORY)
+    parser.add_argument("-p", help="Pipelines file (default %s)" % (PIPELINES), default=PIPELINES)
+    args = parser.parse_args()
+
+    registry = Registry(args.d)
+    invalid = set()
+    print('%-40s %-5s %9s %8s %8s' % ('cascade', 'type', 'window', 'size', 'load'))
+    for name in registry.names():
+        info = registry.describe(name)
+        if 'error' in info:
+            invalid.add(name)
+            print('%-40s %-5s %9s %6dKB  %s' % (name, info['type'], '-', info['bytes']//1024, info['error'].split(': ', 1)[-1]))
+        else:
+            print('%-40s %-5s %9s %6dKB %6.1fms' % (name, info['type'], '%dx%d' % info['window'], info['bytes']//1024, info['load_ms']))
+
+    if os.path.exists(args.p):
+        print()
+        try: pipelines = load_pipelines(args.p, registry)
+        except ValueError as error: parser.exit(1, "%s\n" % (error))
+        for name, pipeline in pipelines.items():
+            broken = [c for c in pipeline.cascades if c in invalid]
+            print('%-20s %s%s' % (name, ' > '.join(pipeline.cascades), '  INVALID: %s' % (', '.join(broken)) if broken else ''))
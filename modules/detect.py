@@ -5,7 +5,10 @@
 import os
 import sys
 import time
+import importlib
+import threading
 import collections
+import concurrent.futures
 
 # External imports
 import cv2
@@ -13,29 +16,85 @@ import numpy
 
 # Project imports
 from . import imgutils
+from . import cascades
+from . import facestore
 
 # Support for Linux only
 if sys.platform == "linux" or sys.platform == "linux2":
 
-    import face_recognition as fc
-
     detection_modes = [ 'motion',
                         'upperbody-face',
-                        'face-recognition']
+                        'face-recognition',
+                        'people']
 
     mode_description = {    'motion': 'Motion detection',
                             'upperbody-face' : 'Upperbody and face detection',
-                            'face-recognition' : 'Face detection and recognition' }
+                            'face-recognition' : 'Face detection and recognition',
+                            'people' : 'People detection (HOG)' }
+
+# Cascade classifiers in resources/cascades, loaded once and shared
+registry = cascades.Registry()
+
+# Heavy dependencies and models, loaded on first use by the modes needing
+# them; other names are looked up in the cascade registry
+loaders = { 'face_recognition': lambda: importlib.import_module('face_recognition'),
+            'upperbody': lambda: registry.load('haarcascade_upperbody'),
+            'face': lambda: registry.load('lbpcascade_frontalface_improved'),
+            'profileface': lambda: registry.load('haarcascade_profileface'),
+            'fullbody': lambda: registry.load('haarcascade_fullbody'),
+            'hog': lambda: people_detector() }
+
+# What each detection mode loads when first selected
+requirements = {    'motion': (),
+                    'upperbody-face': ('upperbody', 'face'),
+                    'face-recognition': ('face_recognition',),
+                    'people': ('hog',) }
+
+# Module attributes kept for compatibility, now loaded on first access
+lazy_attributes = { 'CASCADE_UPPERBODY': 'upperbody',
+                    'CASCADE_FACE': 'face',
+                    'CASCADE_PROFILE_FACE': 'profileface',
+                    'fc': 'face_recognition' }
+
+loaded = dict()
+load_times = dict()
+loading_lock = threading.Lock()
+
+def load(name):
+    """
+    Return a dependency or model from loaders, loading it on first use
+    Loading times are kept in load_times for the startup report
+    """
+    try:
+        return loaded[name]
+    except KeyError:
+        pass
+    with loading_lock:
+        if name not in loaded:
+            start = time.monotonic()
+            loader = loaders.get(name)
+            loaded[name] = loader() if loader is not None else registry.load(name)
+            load_times[name] = time.monotonic() - start
+        return loaded[name]
+
+def prepare(mode):
+    """
+    Load everything a detection mode needs, before its first frame
+    """
+    for name in requirements.get(mode, ()):
+        load(name)
 
-# Load Cascade Classifiers for upperbody and face
-CASCADE_UPPERBODY = cv2.CascadeClassifier("resources/cascades/haarcascade_upperbody.xml")
-CASCADE_FACE = cv2.CascadeClassifier("resources/cascades/lbpcascade_frontalface_improved.xml")
-CASCADE_PROFILE_FACE = cv2.CascadeClassifier("resources/cascades/haarcascade_profileface.xml")
+def __getattr__(name):
+    if name in lazy_attributes:
+        return load(lazy_attributes[name])
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
 
-def single_cascade(frame, cascade=CASCADE_UPPERBODY, return_objects=False, drawboxes=True, min_rectangle=(60,60)):
+def single_cascade(frame, cascade=None, return_objects=False, drawboxes=True, min_rectangle=(60,60)):
     """
     Use a single cascade to perform object detection
+    The upperbody cascade is used by default
     """
+    if cascade is None: cascade = load('upperbody')
 
     # Detect cascade pattern in frame
     (rects, frame) = imgutils.detect_pattern(frame, cascade, min_rectangle)
@@ -52,10 +111,13 @@ def single_cascade(frame, cascade=CASCADE_UPPERBODY, return_objects=False, drawb
     if return_objects: return frame, found, rects
     else: return frame, found
 
-def double_cascade(frame, first_cascade=CASCADE_UPPERBODY, second_cascade=CASCADE_FACE, return_objects=False, drawboxes=True):
+def double_cascade(frame, first_cascade=None, second_cascade=None, return_objects=False, drawboxes=True):
     """
     Use two cascades to perform object detection
+    The upperbody and face cascades are used by default
     """
+    if first_cascade is None: first_cascade = load('upperbody')
+    if second_cascade is None: second_cascade = load('face')
 
     # Detect upperbodies in the frame
     (rects_first_cascade, frame) = imgutils.detect_pattern(frame, first_cascade, (60,60))
@@ -65,12 +127,14 @@ def double_cascade(frame, first_cascade=CASCADE_UPPERBODY, second_cascade=CASCAD
     
     # Prepare face detection inside detected upperbodies
     rects_second_cascade = []
+    faces = []
     if len(rects_first_cascade) > 0:
 
         # For each upperbody detected, search for faces
         for x, y, w, h in rects_first_cascade:
             frame_crop = frame[y:h, x:w]
             (rects_second_cascade, frame_crop) = imgutils.detect_pattern(frame_crop, second_cascade, (25,25))
+            faces.extend((xf+x, yf+y, wf+x, hf+y) for xf, yf, wf, hf in rects_second_cascade)
 
             # For each face detected, draw a rectangle if required
             if drawboxes:
@@ -86,31 +150,33 @@ def double_cascade(frame, first_cascade=CASCADE_UPPERBODY, second_cascade=CASCAD
 
                     frame = imgutils.box([[xf, yf, wf, hf]], frame, (0, 0, 255))
 
-    # Set found to True if a face was detected
-    found = False
-    if len(rects_second_cascade) > 0:
-        found = True
+    # Set found to True if a face was detected in any upperbody
+    found = len(faces) > 0
 
     # Return detected face coordinates if required + frame and found state
     if return_objects:
-        return frame, found, [ (xf+x, yf+y, wf+x, hf+y) for xf, yf, wf, hf in rects_second_cascade for x, y, w, h in rects_first_cascade]
+        return frame, found, faces
     else:
         return frame, found
 
 # Based on a tutorial from http://www.pyimagesearch.com/
 motion_detection_buffer = collections.deque(maxlen=1)
-def motion_detection(frame, thresh=10, it=35, min_area=200, max_area=numpy.inf, drawboxes=True):
+def motion_detection(frame, thresh=10, it=35, min_area=200, max_area=numpy.inf, drawboxes=True, buffer=None, return_objects=False):
     """ Detect if significant motion happened between two frames
+    Each camera stream passes its own buffer holding its previous frame
+    Moving regions are returned as top-left and bottom-right, x and y
     """
     global motion_detection_buffer
+    if buffer is None: buffer = motion_detection_buffer
 
     found = False
+    rects = []
     raw_frame = frame.copy()
 
-    if len(motion_detection_buffer) > 0:
+    if len(buffer) > 0:
 
         # Process first_frame
-        first_frame = cv2.cvtColor(motion_detection_buffer[-1], cv2.COLOR_BGR2GRAY)
+        first_frame = cv2.cvtColor(buffer[-1], cv2.COLOR_BGR2GRAY)
         first_frame = cv2.GaussianBlur(first_frame, (21, 21), 0)
 
         # Resize the frame, convert it to grayscale, and blur it
@@ -140,37 +206,94 @@ def motion_detection(frame, thresh=10, it=35, min_area=200, max_area=numpy.inf,
             if w*h > max_area: continue
             if drawboxes:
                 cv2.rectangle(frame, (x, y), (x + w, y + h), (0, 0, 255), 2)
+            rects.append((x, y, x + w, y + h))
             found = True
     
-    motion_detection_buffer.append(raw_frame)
+    buffer.append(raw_frame)
 
+    if return_objects: return frame, found, rects
     return frame, found
 
 # Variables required for face recognition function
 database = None
 facedatabase = None
 facedatabase_encodings = None
+enrolled = 0
+enrolled_checked = float('-inf')
+enrolled_check_interval = 5.0
+face_database_lock = threading.Lock()
 fraction = 0.25
 
-def face_recognition(frame, drawboxes=True):
+def load_face_database():
+    """ Encode the known faces in faces/, once, and add the faces enrolled
+    from their encodings, looked up at most every enrolled_check_interval
+    seconds
+    Known faces are in database, facedatabase and facedatabase_encodings,
+    in the same order; enrolled faces have no image in facedatabase
+    """
+    global database, facedatabase, facedatabase_encodings, enrolled, enrolled_checked
+    now = time.monotonic()
+    if database is not None and now - enrolled_checked < enrolled_check_interval:
+        return
+    fc = load('face_recognition')
+    with face_database_lock:
+        # Initialize face database if not already initialized
+        if database is None:
+            names = list()
+            # Search for known faces in faces/ directory
+            for (_, _, filenames) in os.walk('faces'):
+                names.extend(filenames)
+                break
+            # Populate face database and generate face encodings
+            facedatabase = [fc.load_image_file(os.path.join('faces', name)) for name in names]
+            facedatabase_encodings = [fc.face_encodings(face)[0] for face in facedatabase]
+            database = names
+        elif now - enrolled_checked < enrolled_check_interval:
+            return
+        enrolled_checked = now
+
+        # Faces enrolled from visitors, see modules/visitors.py
+        # Names first: match_name() indexes them by encoding, without the lock
+        names, encodings = facestore.enrolled(enrolled)
+        database.extend(names)
+        facedatabase.extend([None]*len(names))
+        facedatabase_encodings.extend(encodings)
+        enrolled += len(names)
+
+def match_name(face_encoding):
+    """ Name of the known face matching an encoding, or "Unknown"
+    """
+    fc = load('face_recognition')
+    match = fc.compare_faces(facedatabase_encodings, face_encoding, tolerance=0.5)
+    try: return database[match.index(True)].split('.')[0]
+    except ValueError: return "Unknown"
+
+def draw_name(frame, coords, name):
+    """ Draw a rectangle and name around a recognized face
+    Coordinates are top-left and bottom-right, x and y, in frame scale
+    """
+    left, top, right, bottom = coords
+    top, right, bottom, left = top - 16, right + 16, bottom + 16, left - 16
+    cv2.rectangle(frame, (left, top), (right, bottom), (0, 0, 255), 2)
+    cv2.rectangle(frame, (left-1, top - 20), (max(right+1, left+12*len(name)), top), (0, 0, 255), cv2.FILLED)
+    font = cv2.FONT_HERSHEY_DUPLEX
+    cv2.putText(frame, name, (left + 6, top - 6), font, 0.5, (255, 255, 255), 1)
+
+def face_recognition(frame, drawboxes=True, return_objects=False):
     """ Perform face recognition using face_recognition package
+    Faces are returned with their names and encodings, as top-left and
+    bottom-right, x and y, in frame scale
     """
-    global database, facedatabase, facedatabase_encodings, fraction
+    global fraction
+    fc = load('face_recognition')
 
     # Define standard found state
     found = False
+    faces = []
 
     # Initialize face database if not already initialized
-    if (not database) or (not facedatabase) or (not facedatabase_encodings):
-        database = list()
-        # Search for known faces in faces/ directory
-        for (_, _, filenames) in os.walk('faces'):
-            database.extend(filenames)
-            break
-        # Populate face database and generate face encodings
-        facedatabase = [fc.load_image_file(os.path.join('faces', name)) for name in database]
-        facedatabase_encodings = [fc.face_encodings(face)[0] for face in facedatabase]
-    
+    load_face_database()
+
     # Create a resized copy of the frame in order to speed up processing
     small_frame = cv2.resize(frame, (0, 0), fx=fraction, fy=fraction)
 
@@ -184,25 +307,215 @@ def face_recognition(frame, drawboxes=True):
         found = True
 
         # Recognize faces and determine their names
-        face_names = []
-        for face_encoding in face_encodings:
-            match = fc.compare_faces(facedatabase_encodings, face_encoding, tolerance=0.5)
-            try: name = database[match.index(True)].split('.')[0]
-            except ValueError: name = "Unknown"
-            face_names.append(name)
-        
+        face_names = [match_name(face_encoding) for face_encoding in face_encodings]
+        faces = [((int((1/fraction)*left), int((1/fraction)*top), int((1/fraction)*right), int((1/fraction)*bottom)), name, face_encoding)
+                 for (top, right, bottom, left), name, face_encoding in zip(face_locations, face_names, face_encodings)]
+
         # Draw a rectangle and name around recognized faces if required
         if drawboxes:
-            for (top, right, bottom, left), name in zip(face_locations, face_names):
+            for coords, name, _ in faces:
                 if name != "Unknown":
-                    top = int((1/fraction)*top - 16)
-                    right = int((1/fraction)*right + 16)
-                    bottom = int((1/fraction)*bottom + 16)
-                    left = int((1/fraction)*left - 16)
-                    cv2.rectangle(frame, (left, top), (right, bottom), (0, 0, 255), 2)
-                    cv2.rectangle(frame, (left-1, top - 20), (max(right+1, left+12*len(name)), top), (0, 0, 255), cv2.FILLED)
-                    font = cv2.FONT_HERSHEY_DUPLEX
-                    cv2.putText(frame, name, (left + 6, top - 6), font, 0.5, (255, 255, 255), 1)
-    
+                    draw_name(frame, coords, name)
+
     # Return frame and found state
-    return frame, found
\ No newline at end of file
+    if return_objects: return frame, found, faces
+    return frame, found
+
+# HOG people detector settings, see hog_people()
+hog_settings = {    'scale': 1.05,          # pyramid scale step
+                    'levels': 64,           # most pyramid levels
+                    'stride': 8,            # window stride, in pixels
+                    'padding': 8,           # padding around the image, in pixels
+                    'width': 400,           # frames wider are reduced to this width first, 0 to keep
+                    'hit_threshold': 0.0,   # SVM margin a window needs to be a hit
+                    'overlap': 0.45,        # non-maximum suppression overlap
+                    'neighbors': 2,         # hits a person needs around the best one
+                    'threads': 1 }          # threads sharing the pyramid levels
+
+# HOG window size, in pixels
+HOG_WINDOW = (64, 128)
+
+# Threads evaluating pyramid levels, created on first use
+hog_pool = None
+hog_pool_size = 0
+
+def people_detector():
+    """ HOG descriptor with the default people detector of OpenCV
+    """
+    hog = cv2.HOGDescriptor()
+    hog.setSVMDetector(cv2.HOGDescriptor_getDefaultPeopleDetector())
+    return hog
+
+def parse_hog_settings(text):
+    """ Parse HOG settings given as key=value pairs separated by commas,
+    e.g. scale=1.1,stride=4,threads=4
+    Raise ValueError on unknown keys or bad values
+    """
+    settings = dict()
+    for item in text.split(','):
+        if not item.strip(): continue
+        key, _, value = item.partition('=')
+        key = key.strip()
+        if key not in hog_settings: raise ValueError("Unknown HOG setting: %s" % (key))
+        settings[key] = type(hog_settings[key])(value)
+    return settings
+
+def hog_level(image, scale, settings):
+    """ Hits of the HOG people detector at one pyramid level
+    Return boxes, in image scale, and their SVM margins
+    """
+    hog = load('hog')
+    (h, w) = image.shape[:2]
+    if scale != 1.0: image = cv2.resize(image, (int(w/scale), int(h/scale)), interpolation=cv2.INTER_LINEAR)
+    stride, padding = settings['stride'], settings['padding']
+    points, weights = hog.detect(image, hitThreshold=settings['hit_threshold'], winStride=(stride, stride), padding=(padding, padding))
+    boxes = [(x*scale, y*scale, (x + HOG_WINDOW[0])*scale, (y + HOG_WINDOW[1])*scale) for x, y in numpy.reshape(points, (-1, 2))]
+    return boxes, list(numpy.ravel(weights))
+
+def hog_people(frame, return_objects=False, drawboxes=True, **settings):
+    """ Detect people with the HOG people detector of OpenCV
+    The frame is reduced to settings width, then searched at every level of
+    a scale pyramid; hits of all levels go through non-maximum suppression
+    With several threads, pyramid levels are evaluated in parallel
+    Settings override hog_settings for this call
+    People are returned as top-left and bottom-right, x and y, in frame
+    scale, with their SVM margins
+    """
+    global hog_pool, hog_pool_size
+    settings = dict(hog_settings, **settings)
+
+    # Reduce the frame, people stay taller than the detection window
+    image = frame
+    ratio = 1.0
+    if settings['width'] > 0 and frame.shape[1] > settings['width']:
+        ratio = frame.shape[1]/float(settings['width'])
+        image = cv2.resize(frame, (settings['width'], int(round(frame.shape[0]/ratio))), interpolation=cv2.INTER_AREA)
+
+    # Scale pyramid, down to the detection window
+    (h, w) = image.shape[:2]
+    scales = list()
+    scale = 1.0
+    while len(scales) < settings['levels'] and w/scale >= HOG_WINDOW[0] and h/scale >= HOG_WINDOW[1]:
+        scales.append(scale)
+        scale *= settings['scale']
+
+    # Search every level, in parallel if required
+    boxes, weights = list(), list()
+    if settings['threads'] > 1:
+        with loading_lock:
+            if hog_pool is None or hog_pool_size != settings['threads']:
+                if hog_pool is not None: hog_pool.shutdown(wait=False)
+                hog_pool = concurrent.futures.ThreadPoolExecutor(max_workers=settings['threads'], thread_name_prefix='hog')
+                hog_pool_size = settings['threads']
+        levels = [hog_pool.submit(hog_level, image, scale, settings) for scale in scales]
+        levels = [level.result() for level in levels]
+    else:
+        levels = [hog_level(image, scale, settings) for scale in scales]
+    for level_boxes, level_weights in levels:
+        boxes.extend(level_boxes)
+        weights.extend(level_weights)
+
+    # Keep one box per person
+    keep = imgutils.non_max_suppression(boxes, weights, settings['overlap'], settings['neighbors'])
+    rects = [tuple(int(round(v*ratio)) for v in boxes[i]) for i in keep]
+    scores = [float(weights[i]) for i in keep]
+
+    # Draw a rectangle around detected people if required
+    if drawboxes: frame = imgutils.box(rects, frame, (0, 0, 255))
+
+    found = len(rects) > 0
+    if return_objects: return frame, found, rects, scores
+    return frame, found
+
+# Cascade pipelines, registered as detection modes by load_pipelines()
+pipelines = dict()
+
+def load_pipelines(path=cascades.PIPELINES):
+    """ Register the cascade pipelines of a JSON file as detection modes
+    Their cascades are loaded when the mode is first selected
+    Raise ValueError if the file is not valid
+    """
+    for name, pipeline in cascades.load_pipelines(path, registry).items():
+        if name in mode_description and name not in pipelines:
+            raise ValueError("Pipeline %s: a detection mode has this name" % (name))
+        if name not in detection_modes: detection_modes.append(name)
+        mode_description[name] = pipeline.description
+        requirements[name] = tuple(pipeline.cascades)
+        pipelines[name] = pipeline
+
+def cascade_pipeline(frame, mode, return_objects=False, drawboxes=True, timer=None):
+    """ Run the cascade pipeline of a detection mode
+    Each stage searches inside the boxes of the previous one, and its time
+    is recorded with timer(name) if given, e.g. metrics.Metrics.stage
+    Boxes of the last stage are returned, as top-left and bottom-right, x and y
+    """
+    pipeline = pipelines[mode]
+    found = pipeline(frame, registry, timer)
+
+    # Draw the boxes of every stage if required
+    if drawboxes:
+        for stage, boxes in zip(pipeline.stages, found):
+            frame = imgutils.box(boxes, frame, stage['color'])
+
+    rects = found[-1]
+    if return_objects: return frame, len(rects) > 0, rects
+    return frame, len(rects) > 0
+
+# Detectors and recognizers for modules/tracking.py, boxes are top-left
+# and bottom-right, x and y, in frame scale
+def upperbody_faces(frame):
+    """ Faces found inside upperbodies
+    """
+    faces = list()
+    (upperbodies, frame) = imgutils.detect_pattern(frame, load('upperbody'), (60,60))
+    for x, y, w, h in upperbodies:
+        (rects, _) = imgutils.detect_pattern(frame[y:h, x:w], load('face'), (25,25))
+        faces.extend((xf+x, yf+y, wf+x, hf+y) for xf, yf, wf, hf in rects)
+    return faces
+
+def face_boxes(frame):
+    """ Faces found by the face_recognition package
+    """
+    fc = load('face_recognition')
+    small_frame = cv2.resize(frame, (0, 0), fx=fraction, fy=fraction)
+    return [(int(left/fraction), int(top/fraction), int(right/fraction), int(bottom/fraction))
+            for top, right, bottom, left in fc.face_locations(small_frame)]
+
+def people_boxes(frame):
+    """ People found by the HOG people detector
+    """
+    return hog_people(frame, return_objects=True, drawboxes=False)[2]
+
+def face_name(frame, coords):
+    """ Name of the known face in a box, or "Unknown"
+    """
+    return face_identity(frame, coords)[0]
+
+def face_identity(frame, coords):
+    """ Name of the known face in a box, or "Unknown", and its encoding,
+    or None if the face could not be encoded
+    """
+    fc = load('face_recognition')
+    load_face_database()
+    left, top, right, bottom = coords
+    small_frame = cv2.resize(frame, (0, 0), fx=fraction, fy=fraction)
+    location = (int(top*fraction), int(right*fraction), int(bottom*fraction), int(left*fraction))
+    face_encodings = fc.face_encodings(small_frame, [location])
+    if len(face_encodings) == 0: return "Unknown", None
+    return match_name(face_encodings[0]), face_encodings[0]
+
+# Modes whose detections can be tracked between detector runs: detector,
+# recognizer or None
+tracked_modes = {   'upperbody-face': (upperbody_faces, None),
+                    'face-recognition': (face_boxes, face_identity),
+                    'people': (people_boxes, None) }
+
+def draw_tracks(frame, mode, tracks):
+    """ Draw tracked objects as their mode draws detections
+    """
+    for track in tracks:
+        if mode == 'face-recognition':
+            if track.label != "Unknown": draw_name(frame, track.coords, track.label)
+        else:
+            frame = imgutils.box([track.coords], frame, (0, 0, 255))
+    return frame
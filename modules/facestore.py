@@ -0,0 +1,566 @@
+"""
+Encodings of every face seen, kept next to the frames of each day, and
+searched by example across days without re-encoding any frame.
+
+A day folder holds faces.vec, the 128 float32 face_recognition encoding
+of each face one after the other, and faces.meta, one fixed-size record
+per face with its capture time, box and recognized name. Both files are
+append only: an encoding is written before its record, so a crash at
+worst leaves an unreferenced encoding, which the next writer truncates.
+
+Once a day is over its encodings get an inverted file index, faces.ivf:
+they are clustered with k-means and a search only compares the query to
+the encodings of the few clusters nearest to it. Faces appended after
+the index was built are compared one by one, so a day without an index
+is still searched, exhaustively. Find when someone came in a date range,
+by a known name from faces/ or an example photo, with:
+
+    python3 -m modules.facestore detected/ --name Alice --since 2019-03-01
+"""
+# coding: utf-8
+
+# Standard imports
+import os
+import time
+import argparse
+import datetime
+import threading
+
+try: import fcntl
+except ImportError: fcntl = None
+
+# External imports
+import numpy
+
+# Project imports
+from . import archive
+
+RECORDS = 'faces.meta'
+VECTORS = 'faces.vec'
+INDEX = 'faces.ivf'
+
+# Known faces enrolled from their stored encodings, without an image in
+# faces/, see modules/visitors.py
+ENROLLED = 'faces/enrolled'
+
+# Size of a face_recognition encoding
+DIMENSION = 128
+VECTOR = numpy.dtype(('<f4', (DIMENSION,)))
+
+# Face record: capture time in ms since the epoch (local time), box as
+# top-left and bottom-right, x and y, in frame scale, recognized name,
+# "Unknown" or empty
+FACE = numpy.dtype([    ('time', '<i8'), ('x1', '<i2'), ('y1', '<i2'), ('x2', '<i2'), ('y2', '<i2'),
+                        ('name', 'S24') ])
+
+# Encodings closer than this are the same person, as in modules/detect.py
+TOLERANCE = 0.5
+# Days with fewer faces are searched exhaustively, which is as fast
+MIN_INDEXED = 1024
+
+def daypath(root, img_time):
+    return "/".join((root, str(img_time.year), str(img_time.month) + ". " + img_time.strftime('%B'), str(img_time.day)))
+
+class Writer(object):
+    """Append face encodings to a day folder.
+
+        Attributes:
+            path: the day folder.
+
+    """
+
+    def __init__(self, path):
+        """Writer constructor.
+
+            Opens both files for appending, creating them if needed, and
+            drops any partial write left by a crash. A day has a single
+            writer at a time.
+
+            Args:
+                path: the day folder.
+
+            Returns:
+                A Writer object.
+
+            Raises:
+                OSError: if the files can not be opened, or another
+                         writer has them open.
+
+        """
+        self.path = path
+        if not os.path.exists(path):
+            os.makedirs(path, exist_ok=True)
+        self._records = open(os.path.join(path, RECORDS), 'ab+')
+        if fcntl is not None:
+            try: fcntl.flock(self._records.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                self._records.close()
+                raise OSError("Faces in %s are being written by another process" % (path))
+        self._vectors = open(os.path.join(path, VECTORS), 'ab+')
+        # Drop a partial record, then unreferenced encodings
+        size = os.fstat(self._records.fileno()).st_size
+        size -= size % FACE.itemsize
+        self._records.truncate(size)
+        self._vectors.truncate((size//FACE.itemsize)*VECTOR.itemsize)
+
+    def append(self, img_time, boxes, encodings, names=None):
+        """Append the faces of a frame.
+
+            Args:
+                img_time: the time of capture.
+                boxes: boxes as top-left and bottom-right, x and y.
+                encodings: an encoding per box.
+                names: a recognized name per box, or None.
+
+            Returns:
+
+            Raises:
+                OSError: if the faces can not be written.
+
+        """
+        if len(boxes) == 0:
+            return
+        vectors = numpy.asarray(encodings, dtype=numpy.float32).reshape(len(boxes), DIMENSION)
+        records = numpy.zeros(len(boxes), dtype=FACE)
+        records['time'] = archive.to_ms(img_time)
+        coords = numpy.clip(numpy.array(boxes, dtype=numpy.int64), -32768, 32767)
+        for i, column in enumerate(('x1', 'y1', 'x2', 'y2')):
+            records[column] = coords[:, i]
+        if names is not None:
+            records['name'] = [(n or '').encode('utf-8')[:FACE['name'].itemsize] for n in names]
+        self._vectors.write(vectors.astype('<f4').tobytes())
+        self._vectors.flush()
+        self._records.write(records.tobytes())
+        self._records.flush()
+
+    def close(self):
+        self._vectors.close()
+        self._records.close()
+
+class Log(object):
+    """Append face encodings to the day folders under a root, switching day
+    as time goes by.
+
+        The day left behind is indexed in a background thread.
+
+        Attributes:
+            root: the folder holding the day hierarchy, e.g. detected.
+
+    """
+
+    def __init__(self, root="detected"):
+        self.root = root
+        self._day = None
+        self._writer = None
+
+    def append(self, img_time, boxes, encodings, names=None):
+        """Append the faces of a frame to its day.
+
+            See Writer.append().
+
+        """
+        day = img_time.date()
+        if day != self._day:
+            closed = self._writer.path if self._writer is not None else None
+            self.close()
+            self._writer = Writer(daypath(self.root, img_time))
+            self._day = day
+            if closed is not None:
+                threading.Thread(target=index_day, args=(closed,), name='facestore', daemon=True).start()
+        self._writer.append(img_time, boxes, encodings, names)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+        self._writer = None
+        self._day = None
+
+def kmeans(vectors, k, iterations=10, seed=0):
+    """Cluster vectors with Lloyd's k-means.
+
+        Args:
+            vectors: a float32 numpy array, one vector per row.
+            k: the number of clusters.
+            iterations: the number of refinement passes.
+            seed: the seed choosing the initial centroids.
+
+        Returns:
+            The centroids, a k x dimension float32 numpy array.
+
+        Raises:
+
+    """
+    rng = numpy.random.RandomState(seed)
+    centroids = vectors[rng.choice(len(vectors), k, replace=False)].copy()
+    for _ in range(iterations):
+        nearest = assign(vectors, centroids)
+        counts = numpy.bincount(nearest, minlength=k)
+        sums = numpy.zeros_like(centroids)
+        numpy.add.at(sums, nearest, vectors)
+        # Empty clusters keep their centroid
+        filled = counts > 0
+        centroids[filled] = sums[filled]/counts[filled, None]
+    return centroids
+
+def assign(vectors, centroids, chunk=65536):
+    """Index of the nearest centroid of each vector.
+    """
+    norms = numpy.einsum('ij,ij->i', centroids, centroids)
+    nearest = numpy.empty(len(vectors), dtype=numpy.int64)
+    for start in range(0, len(vectors), chunk):
+        block = numpy.asarray(vectors[start:start + chunk], dtype=numpy.float32)
+        nearest[start:start + chunk] = numpy.argmin(norms[None, :] - 2*block.dot(centroids.T), axis=1)
+    return nearest
+
+def index_day(path, lists=None, sample=32768):
+    """Build the inverted file index of a day folder.
+
+        Encodings are clustered on a sample, then every encoding is
+        listed under its nearest centroid. The index is written next to
+        the encodings and replaces the previous one at once, so readers
+        never see it half written.
+
+        Args:
+            path: the day folder.
+            lists: the number of clusters, by default the square root of
+                   the number of faces.
+            sample: the most encodings clustered.
+
+        Returns:
+            The number of faces indexed, 0 if the day has too few faces
+            to need an index.
+
+        Raises:
+            OSError: if the index can not be written.
+
+    """
+    day = Reader(path)
+    count = len(day)
+    if count < MIN_INDEXED:
+        return 0
+    vectors = day.vectors[:count]
+    k = lists or int(min(numpy.sqrt(count), 1024))
+    rng = numpy.random.RandomState(0)
+    training = vectors[numpy.sort(rng.choice(count, min(sample, count), replace=False))]
+    centroids = kmeans(numpy.asarray(training, dtype=numpy.float32), k)
+    nearest = assign(vectors, centroids)
+    order = numpy.argsort(nearest, kind='stable').astype(numpy.uint32)
+    offsets = numpy.searchsorted(nearest[order], numpy.arange(k + 1))
+    with open(os.path.join(path, INDEX + '.tmp'), 'wb') as index:
+        numpy.savez(index, centroids=centroids, order=order, offsets=offsets, count=count)
+    os.replace(os.path.join(path, INDEX + '.tmp'), os.path.join(path, INDEX))
+    return count
+
+class Reader(object):
+    """Search the face encodings of a day folder.
+
+        Both files are memory mapped. refresh() maps faces appended
+        since, so a reader follows a live writer.
+
+        Attributes:
+            path: the day folder.
+            records: the face records, a numpy structured array.
+            vectors: the encodings, a float32 numpy array.
+            index: the inverted file index as a dict with centroids, order,
+                   offsets and count, or None.
+
+    """
+
+    def __init__(self, path):
+        """Reader constructor.
+
+            Args:
+                path: the day folder.
+
+            Returns:
+                A Reader object.
+
+            Raises:
+                OSError: if the day has no faces.
+
+        """
+        self.path = path
+        self.records = numpy.zeros(0, dtype=FACE)
+        self.vectors = numpy.zeros((0, DIMENSION), dtype=numpy.float32)
+        self.index = None
+        self._size = -1
+        self._index_time = None
+        self._lock = threading.Lock()
+        if not os.path.exists(os.path.join(path, RECORDS)):
+            raise OSError("No faces in %s" % (path))
+        self.refresh()
+
+    def refresh(self):
+        """Map faces appended, and load an index built, since the last
+        refresh.
+
+            Returns:
+                True if new faces were found.
+
+            Raises:
+
+        """
+        with self._lock:
+            try: index_time = os.path.getmtime(os.path.join(self.path, INDEX))
+            except OSError: index_time = None
+            if index_time != self._index_time:
+                if index_time is None: self.index = None
+                else:
+                    with numpy.load(os.path.join(self.path, INDEX)) as index:
+                        self.index = {key: index[key] for key in index.files}
+                    self.index['count'] = int(self.index['count'])
+                self._index_time = index_time
+            size = os.path.getsize(os.path.join(self.path, RECORDS))
+            size -= size % FACE.itemsize
+            if size == self._size:
+                return False
+            count = size//FACE.itemsize
+            if count > 0:
+                self.records = numpy.memmap(os.path.join(self.path, RECORDS), dtype=FACE, mode='r', shape=(count,))
+                self.vectors = numpy.memmap(os.path.join(self.path, VECTORS), dtype='<f4', mode='r', shape=(count, DIMENSION))
+            self._size = size
+            return True
+
+    def __len__(self):
+        return len(self.records)
+
+    def at(self, img_time):
+        """Faces of the frame captured at a time.
+
+            Returns:
+                A list of (box, name, encoding), with boxes as top-left
+                and bottom-right, x and y.
+
+            Raises:
+
+        """
+        ms = archive.to_ms(img_time)
+        times = self.records['time']
+        if len(times) == 0 or times[-1] < ms: self.refresh()
+        times = self.records['time']
+        start, end = numpy.searchsorted(times, ms, 'left'), numpy.searchsorted(times, ms, 'right')
+        return [((int(r['x1']), int(r['y1']), int(r['x2']), int(r['y2'])), r['name'].decode('utf-8'), numpy.array(v))
+                for r, v in zip(self.records[start:end], self.vectors[start:end])]
+
+    def candidates(self, query, nprobe=8):
+        """Positions of the faces worth comparing to a query encoding.
+
+            Args:
+                query: an encoding.
+                nprobe: the number of nearest clusters searched.
+
+            Returns:
+                A sorted numpy array of face positions: those listed in
+                the nearest clusters, and those appended after the index
+                was built, or all of them without an index.
+
+            Raises:
+
+        """
+        count = len(self.records)
+        index = self.index
+        if index is None or index['count'] > count:
+            return numpy.arange(count)
+        centroids, order, offsets = index['centroids'], index['order'], index['offsets']
+        probes = numpy.argsort(numpy.sum((centroids - query)**2, axis=1))[:nprobe]
+        rows = [order[offsets[c]:offsets[c + 1]] for c in probes]
+        rows.append(numpy.arange(index['count'], count, dtype=numpy.uint32))
+        return numpy.sort(numpy.concatenate(rows))
+
+    def search(self, queries, radius=TOLERANCE, start=None, end=None, nprobe=8):
+        """Faces close to any of the query encodings.
+
+            Args:
+                queries: encodings, one per row.
+                radius: the largest distance of a face found.
+                start: the earliest capture time, or None.
+                end: the latest capture time, or None.
+                nprobe: the number of nearest clusters searched.
+
+            Returns:
+                A numpy array of face positions, and one of their
+                distances to the nearest query.
+
+            Raises:
+
+        """
+        self.refresh()
+        queries = numpy.asarray(queries, dtype=numpy.float32).reshape(-1, DIMENSION)
+        rows = numpy.unique(numpy.concatenate([self.candidates(q, nprobe) for q in queries] or [numpy.zeros(0, dtype=numpy.int64)]))
+        if start is not None or end is not None:
+            times = self.records['time'][rows]
+            keep = numpy.ones(len(rows), dtype=bool)
+            if start is not None: keep &= times >= archive.to_ms(start)
+            if end is not None: keep &= times <= archive.to_ms(end)
+            rows = rows[keep]
+        if len(rows) == 0:
+            return rows, numpy.zeros(0, dtype=numpy.float32)
+        vectors = numpy.asarray(self.vectors[rows])
+        distances = numpy.min([numpy.linalg.norm(vectors - q, axis=1) for q in queries], axis=0)
+        keep = distances <= radius
+        return rows[keep], distances[keep]
+
+    def close(self):
+        """Unmap the faces and drop the index, a later refresh() maps them
+        again.
+        """
+        with self._lock:
+            self.records = numpy.zeros(0, dtype=FACE)
+            self.vectors = numpy.zeros((0, DIMENSION), dtype=numpy.float32)
+            self.index = None
+            self._index_time = None
+            self._size = -1
+
+# Readers are kept open for the most recently used days, a folder without
+# faces is looked at again after a few seconds
+readers = archive.Readers(Reader, retry=5.0)
+
+def reader(path):
+    """The Reader of a day folder, or None if it has no faces.
+    """
+    return readers.get(path)
+
+def lookup(path):
+    """Faces recorded for a frame, see Reader.at().
+
+        Args:
+            path: the frame path, day folder and frame name.
+
+        Returns:
+            The faces, or None if none were recorded.
+
+        Raises:
+
+    """
+    img_time = archive.parse_name(os.path.basename(path))
+    faces = reader(os.path.dirname(path))
+    if img_time is None or faces is None:
+        return None
+    return faces.at(img_time) or None
+
+def enrolled(start=0, path=ENROLLED):
+    """Known faces enrolled from their encodings.
+
+        Args:
+            start: the number of enrolled faces already known, only
+                   those enrolled after are returned.
+            path: the folder holding the enrolled faces.
+
+        Returns:
+            A list of names and a list of encodings.
+
+        Raises:
+
+    """
+    faces = reader(path)
+    if faces is None:
+        return [], []
+    faces.refresh()
+    return [n.decode('utf-8') for n in faces.records['name'][start:].tolist()], [numpy.array(v) for v in faces.vectors[start:]]
+
+def search(root, queries, start, end, radius=TOLERANCE, nprobe=8):
+    """Faces close to any of the query encodings in a date range.
+
+        Args:
+            root: the folder holding the day hierarchy, e.g. detected.
+            queries: encodings, one per row.
+            start: the earliest capture time.
+            end: the latest capture time.
+            radius: the largest distance of a face found.
+            nprobe: the number of nearest clusters searched per day.
+
+        Returns:
+            A list of (time, path, box, name, distance) in time order,
+            with path the frame path and box as top-left and
+            bottom-right, x and y.
+
+        Raises:
+
+    """
+    found = list()
+    day = start.date()
+    while day <= end.date():
+        path = daypath(root, day)
+        day += datetime.timedelta(days=1)
+        faces = reader(path)
+        if faces is None: continue
+        rows, distances = faces.search(queries, radius, start, end, nprobe)
+        for i, distance in zip(rows.tolist(), distances.tolist()):
+            record = faces.records[i]
+            img_time = archive.from_ms(record['time'])
+            found.append((img_time, "/".join((path, archive.frame_name(img_time))),
+                          (int(record['x1']), int(record['y1']), int(record['x2']), int(record['y2'])),
+                          record['name'].decode('utf-8'), distance))
+    return sorted(found, key=lambda face: face[0])
+
+def visits(found, gap=300.0):
+    """Group faces found into visits.
+
+        Args:
+            found: faces as returned by search().
+            gap: seconds without the face that end a visit.
+
+        Returns:
+            A list of (first time, last time, faces, best distance).
+
+        Raises:
+
+    """
+    grouped = list()
+    for img_time, _, _, _, distance in found:
+        if grouped and (img_time - grouped[-1][1]).total_seconds() <= gap:
+            first, _, count, best = grouped[-1]
+            grouped[-1] = (first, img_time, count + 1, min(best, distance))
+        else:
+            grouped.append((img_time, img_time, 1, distance))
+    return grouped
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Search the faces seen, by name or example photo, or index past days.")
+    parser.add_argument("root", help="A detected/ folder")
+    parser.add_argument("-n", "--name", help="A known face, named after its image in faces/")
+    parser.add_argument("-p", "--photo", help="An example photo of the face")
+    parser.add_argument("--since", help="First day searched, e.g. 2019-03-01 (default 30 days ago)")
+    parser.add_argument("--until", help="Last day searched (default today)")
+    parser.add_argument("-t", help="Distance tolerance (default %g)" % (TOLERANCE), type=float, default=TOLERANCE)
+    parser.add_argument("--nprobe", help="Clusters searched per indexed day (default 8)", type=int, default=8)
+    parser.add_argument("--frames", help="List every frame instead of visits", action="store_true")
+    parser.add_argument("--index", help="Index the past days missing an index", action="store_true")
+    args = parser.parse_args()
+
+    if args.index:
+        today = daypath(args.root, datetime.date.today())
+        for (dirpath, dirnames, filenames) in os.walk(args.root):
+            dirnames[:] = [d for d in dirnames if d != 'clips']
+            if RECORDS not in filenames or INDEX in filenames or os.path.normpath(dirpath) == os.path.normpath(today): continue
+            count = index_day(dirpath)
+            if count > 0: print("%s: %d faces indexed" % (dirpath, count))
+        parser.exit()
+
+    if (args.name is None) == (args.photo is None):
+        parser.error("give either a name or a photo")
+    # Encodings of the query need face_recognition, only loaded here
+    from . import detect
+    fc = detect.load('face_recognition')
+    if args.name is not None:
+        detect.load_face_database()
+        queries = [e for f, e in zip(detect.database, detect.facedatabase_encodings) if f.split('.')[0] == args.name]
+        if not queries: parser.exit(1, "No known face named %s in faces/\n" % (args.name))
+    else:
+        queries = fc.face_encodings(fc.load_image_file(args.photo))
+        if not queries: parser.exit(1, "No face found in %s\n" % (args.photo))
+
+    until = datetime.datetime.strptime(args.until, '%Y-%m-%d') if args.until else datetime.datetime.now()
+    until = until.replace(hour=23, minute=59, second=59, microsecond=999000)
+    since = datetime.datetime.strptime(args.since, '%Y-%m-%d') if args.since else (until - datetime.timedelta(days=30)).replace(hour=0, minute=0, second=0, microsecond=0)
+    started = time.monotonic()
+    found = search(args.root, queries, since, until, args.t, args.nprobe)
+    elapsed = time.monotonic() - started
+    if args.frames:
+        for img_time, path, box, name, distance in found:
+            print('%s  %.3f  %d,%d,%d,%d  %s' % ((path, distance) + box + (name,)))
+    else:
+        for first, last, count, best in visits(found):
+            print('%s - %s  %4d faces  best %.3f' % (str(first)[:19], str(last)[11:19], count, best))
+    print('%d faces found in %.1f ms' % (len(found), 1000*elapsed))
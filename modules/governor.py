@@ -0,0 +1,145 @@
+"""
+Adapt the frame rate and detector cadence of a live stream to the scene,
+so idle and dark hours cost a fraction of the CPU of busy ones.
+"""
+# coding: utf-8
+
+# Standard imports
+import time
+
+# External imports
+import cv2
+import numpy
+
+ACTIVE = 'active'
+IDLE = 'idle'
+DARK = 'dark'
+
+class Governor(object):
+    """Duty cycle a live stream according to activity and brightness.
+
+        The stream starts active and processes every frame. After
+        active_seconds without activity it turns idle, or dark if the
+        scene is dark, and only takes idle_fps or dark_fps frames; the
+        frames in between are skipped without being decoded when the
+        source allows it. Each frame taken while idle or dark is compared
+        to the previous one at thumbnail size, which costs far less than
+        a detector: the detector only runs when this finds motion, or
+        every probe_seconds so a still scene is checked too. Motion or a
+        detection makes the stream active again at once, on the frame
+        that showed it, so the start of an event is not missed.
+
+        Brightness has hysteresis: the scene turns dark below dark_below
+        and light again above light_above, so lights near the threshold
+        do not make the state flicker.
+
+        Attributes:
+            state: ACTIVE, IDLE or DARK.
+            brightness: mean brightness of the last frame taken, 0 to 1.
+            changes: list of (time, state) transitions, most recent last.
+
+    """
+
+    def __init__(self, idle_fps=2.0, dark_fps=2.0, active_seconds=10.0, probe_seconds=5.0,
+                 dark_below=0.2, light_above=0.3, motion_threshold=0.005, log=print):
+        """Governor constructor.
+
+            Args:
+                idle_fps: frames taken per second in a still scene.
+                dark_fps: frames taken per second in a dark scene.
+                active_seconds: seconds without activity before slowing down.
+                probe_seconds: most seconds between detector runs while
+                               idle or dark.
+                dark_below: brightness under which the scene turns dark.
+                light_above: brightness over which it turns light again.
+                motion_threshold: fraction of thumbnail pixels that must
+                                  change to count as motion.
+                log: function called with state changes, or None.
+
+            Returns:
+                A Governor object.
+
+            Raises:
+
+        """
+        self.idle_fps = idle_fps
+        self.dark_fps = dark_fps
+        self.active_seconds = active_seconds
+        self.probe_seconds = probe_seconds
+        self.dark_below = dark_below
+        self.light_above = light_above
+        self.motion_threshold = motion_threshold
+        self.log = log
+        self.state = ACTIVE
+        self.brightness = None
+        self.changes = list()
+        self._dark = False
+        self._last_activity = time.monotonic()
+        self._last_taken = None
+        self._last_detection = None
+        self._thumbnail = None
+
+    def due(self, now=None):
+        """True if the next frame should be taken, False to skip it.
+        """
+        if self.state == ACTIVE or self._last_taken is None:
+            return True
+        now = time.monotonic() if now is None else now
+        fps = self.dark_fps if self.state == DARK else self.idle_fps
+        return now - self._last_taken >= 1.0/fps
+
+    def watch(self, frame, now=None):
+        """Look at a frame taken and tell if the detector should run on it.
+
+            Args:
+                frame: a cv2 BGR image.
+                now: the monotonic time, by default the current one.
+
+            Returns:
+                True to run the detector on the frame.
+
+            Raises:
+
+        """
+        now = time.monotonic() if now is None else now
+        self._last_taken = now
+        thumbnail = cv2.resize(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY), (64, 48), interpolation=cv2.INTER_AREA)
+        self.brightness = float(numpy.mean(thumbnail))/255
+        if self._dark and self.brightness > self.light_above: self._dark = False
+        elif not self._dark and self.brightness < self.dark_below: self._dark = True
+        moved = False
+        if self._thumbnail is not None:
+            changed = cv2.absdiff(thumbnail, self._thumbnail) > 25
+            moved = numpy.count_nonzero(changed) > self.motion_threshold*changed.size
+        self._thumbnail = thumbnail
+        if moved:
+            self._last_activity = now
+        self._settle(now)
+        detect = self.state == ACTIVE or self._last_detection is None or now - self._last_detection >= self.probe_seconds
+        if detect:
+            self._last_detection = now
+        return detect
+
+    def update(self, found, now=None):
+        """Report the detector result on the frame last watched.
+        """
+        if not found:
+            return
+        now = time.monotonic() if now is None else now
+        self._last_activity = now
+        self._settle(now)
+
+    def _settle(self, now):
+        """Move to the state the scene calls for.
+        """
+        if now - self._last_activity < self.active_seconds: state = ACTIVE
+        elif self._dark: state = DARK
+        else: state = IDLE
+        if state == self.state:
+            return
+        self.state = state
+        self.changes.append((now, state))
+        del self.changes[:-100]
+        if self.log is not None:
+            if state == ACTIVE: self.log('Governor: active, processing every frame')
+            else: self.log('Governor: %s, %g fps (brightness %.2f)' % (state, self.dark_fps if state == DARK else self.idle_fps, self.brightness))
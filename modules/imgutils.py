@@ -161,3 +161,43 @@ def crop(img, startx, endx, starty, endy):
 
     """
     return img[starty:endy, startx:endx]
+
+
+def non_max_suppression(boxes, scores, overlap=0.45, min_neighbors=0):
+    """Keep the best of overlapping boxes.
+
+        Boxes are taken from the highest score down; each box kept
+        suppresses the remaining boxes overlapping it by more than
+        overlap. Detectors firing several times around an object then
+        yield one box for it.
+
+        Args:
+            boxes: a list of boxes, each one with top-left and
+                   bottom-right, x and y.
+            scores: a score for each box.
+            overlap: intersection over union above which a box is
+                     suppressed.
+            min_neighbors: boxes a box must suppress to be kept;
+                           isolated hits are often false positives.
+
+        Returns:
+            The indices of the boxes kept, highest score first.
+
+        Raises:
+
+    """
+    boxes = numpy.asarray(boxes, dtype=numpy.float64).reshape(-1, 4)
+    scores = numpy.asarray(scores, dtype=numpy.float64).ravel()
+    areas = (boxes[:, 2] - boxes[:, 0])*(boxes[:, 3] - boxes[:, 1])
+    order = numpy.argsort(-scores, kind='stable')
+    keep = []
+    while order.size > 0:
+        i, rest = order[0], order[1:]
+        w = numpy.minimum(boxes[i, 2], boxes[rest, 2]) - numpy.maximum(boxes[i, 0], boxes[rest, 0])
+        h = numpy.minimum(boxes[i, 3], boxes[rest, 3]) - numpy.maximum(boxes[i, 1], boxes[rest, 1])
+        inter = numpy.clip(w, 0, None)*numpy.clip(h, 0, None)
+        suppressed = inter > overlap*(areas[i] + areas[rest] - inter)
+        if numpy.count_nonzero(suppressed) >= min_neighbors:
+            keep.append(int(i))
+        order = rest[~suppressed]
+    return keep
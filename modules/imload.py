@@ -0,0 +1,161 @@
+"""
+Load images from disk, optionally at reduced resolution or in grayscale.
+Frames packed in a day archive are read by the path of their loose file.
+Decoded thumbnails can be kept in a shared LRU cache.
+"""
+# coding: utf-8
+
+# Standard imports
+import os
+import threading
+import collections
+
+# External imports
+import cv2
+import numpy
+
+# Project imports
+from . import archive
+
+# JPEG images are scaled by 1/2, 1/4 or 1/8 while decoding, in the DCT domain
+COLOR_FLAGS = { 1: cv2.IMREAD_COLOR,
+                2: cv2.IMREAD_REDUCED_COLOR_2,
+                4: cv2.IMREAD_REDUCED_COLOR_4,
+                8: cv2.IMREAD_REDUCED_COLOR_8 }
+
+GRAY_FLAGS = {  1: cv2.IMREAD_GRAYSCALE,
+                2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+                4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+                8: cv2.IMREAD_REDUCED_GRAYSCALE_8 }
+
+class ThumbnailCache(object):
+    """Least recently used cache of decoded images.
+
+        Images are indexed by path, modification time and decoding
+        options, so a file rewritten on disk is decoded again. The
+        cache is bounded by the total size of the stored images.
+
+        Attributes:
+            max_bytes: maximum size of all cached images, in bytes.
+
+    """
+
+    def __init__(self, max_bytes=64*1024*1024):
+        """ThumbnailCache constructor.
+
+            Args:
+                max_bytes: maximum size of all cached images, in bytes.
+
+            Returns:
+                A ThumbnailCache object.
+
+            Raises:
+
+        """
+        self.max_bytes = max_bytes
+        self._images = collections.OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the image stored under key, or None.
+        """
+        with self._lock:
+            img = self._images.get(key)
+            if img is not None:
+                self._images.move_to_end(key)
+            return img
+
+    def put(self, key, img):
+        """Store an image under key, evicting the oldest ones if needed.
+        """
+        with self._lock:
+            if key in self._images:
+                self._bytes -= self._images.pop(key).nbytes
+            self._images[key] = img
+            self._bytes += img.nbytes
+            while self._bytes > self.max_bytes and len(self._images) > 1:
+                _, old = self._images.popitem(last=False)
+                self._bytes -= old.nbytes
+
+    def clear(self):
+        """Remove all images.
+        """
+        with self._lock:
+            self._images.clear()
+            self._bytes = 0
+
+# Cache shared by all callers of imread(..., cached=True)
+thumbnails = ThumbnailCache()
+
+def load(path, flags):
+    """Decode an image file, or the frame packed under its path.
+    """
+    if os.path.exists(path):
+        return cv2.imread(path, flags)
+    data = archive.read(path)
+    if data is None:
+        return None
+    return cv2.imdecode(numpy.frombuffer(data, dtype=numpy.uint8), flags)
+
+def imread(path, reduction=1, gray=False, cached=False):
+    """Read an image from disk.
+
+        Args:
+            path: path to the image file, or of a packed frame.
+            reduction: 1, 2, 4 or 8; the image is decoded with its width
+                       and height divided by this factor.
+            gray: if True, decode a single channel grayscale image.
+            cached: if True, look up and store the decoded image in the
+                    shared thumbnail cache. Cached images must not be
+                    modified by the caller.
+
+        Returns:
+            The decoded cv2 image, or None if the file could not be read.
+
+        Raises:
+            KeyError: if reduction is not 1, 2, 4 or 8.
+
+    """
+
+    flags = (GRAY_FLAGS if gray else COLOR_FLAGS)[reduction]
+
+    if not cached:
+        return load(path, flags)
+
+    # Packed frames never change
+    try: key = (path, os.stat(path).st_mtime_ns, flags)
+    except OSError:
+        if not archive.exists(path): return None
+        key = (path, 0, flags)
+
+    img = thumbnails.get(key)
+    if img is None:
+        img = load(path, flags)
+        if img is not None:
+            img.setflags(write=False)
+            thumbnails.put(key, img)
+    return img
+
+def brightness(path, reduction=8):
+    """Mean intensity of an image.
+
+        The image is decoded at reduced size and kept in the thumbnail
+        cache, so checking the same frame again is free.
+
+        Args:
+            path: path to the image file.
+            reduction: 1, 2, 4 or 8, see imread().
+
+        Returns:
+            The mean of all channels, between 0.0 and 1.0, or None if
+            the file could not be read.
+
+        Raises:
+
+    """
+
+    img = imread(path, reduction=reduction, cached=True)
+    if img is None:
+        return None
+    return float(numpy.mean(img))/255
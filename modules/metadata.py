@@ -0,0 +1,373 @@
+"""
+Per-detection metadata, kept next to the frames of each day.
+
+A day folder holds detections.meta, one fixed-size record per detected
+frame with its capture time, detection mode, frame statistics and the
+position of its boxes in boxes.meta, which holds one fixed-size record
+per box with its coordinates, score and recognized name. Both files are
+append only: boxes are written before the record of their frame, so a
+crash at worst leaves unreferenced boxes, which the next writer
+truncates.
+
+Records are numpy structured arrays, so offline queries such as frames
+with a face, frames of someone or the largest moving areas are index
+lookups on memory mapped columns instead of new detector runs:
+
+    python3 -m modules.metadata "detected/2019/3. March/5" --name Alice
+"""
+# coding: utf-8
+
+# Standard imports
+import os
+import argparse
+import threading
+
+try: import fcntl
+except ImportError: fcntl = None
+
+# External imports
+import cv2
+import numpy
+
+# Project imports
+from . import archive
+
+FRAMES = 'detections.meta'
+BOXES = 'boxes.meta'
+
+# Frame record: capture time in ms since the epoch (local time), detection
+# mode, frame size, mean brightness between 0 and 1, area of the largest
+# box as a fraction of the frame, index of the first box and box count
+FRAME = numpy.dtype([   ('time', '<i8'), ('mode', 'S16'), ('width', '<u2'), ('height', '<u2'),
+                        ('brightness', '<f4'), ('area', '<f4'), ('box', '<u4'), ('count', '<u4') ])
+
+# Box record: top-left and bottom-right, x and y, in frame scale, detector
+# score or NaN if the detector gives none, recognized name or empty
+BOX = numpy.dtype([ ('x1', '<i2'), ('y1', '<i2'), ('x2', '<i2'), ('y2', '<i2'),
+                    ('score', '<f4'), ('name', 'S24') ])
+
+def statistics(frame, boxes):
+    """Frame statistics stored with its detections.
+
+        Args:
+            frame: a cv2 BGR image.
+            boxes: boxes as top-left and bottom-right, x and y.
+
+        Returns:
+            Mean brightness between 0 and 1, and area of the largest box
+            as a fraction of the frame.
+
+        Raises:
+
+    """
+    (h, w) = frame.shape[:2]
+    brightness = sum(cv2.mean(frame)[:3])/(3*255)
+    area = max([(x2 - x1)*(y2 - y1) for x1, y1, x2, y2 in boxes] or [0])
+    return brightness, float(area)/(w*h)
+
+class Writer(object):
+    """Append detections to the metadata of a day folder.
+
+        Attributes:
+            path: the day folder.
+
+    """
+
+    def __init__(self, path):
+        """Writer constructor.
+
+            Opens both files for appending, creating them if needed, and
+            drops any partial write left by a crash. A day has a single
+            writer at a time.
+
+            Args:
+                path: the day folder.
+
+            Returns:
+                A Writer object.
+
+            Raises:
+                OSError: if the files can not be opened, or another
+                         writer has them open.
+
+        """
+        self.path = path
+        if not os.path.exists(path):
+            os.makedirs(path, exist_ok=True)
+        self._frames = open(os.path.join(path, FRAMES), 'ab+')
+        if fcntl is not None:
+            try: fcntl.flock(self._frames.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                self._frames.close()
+                raise OSError("Metadata in %s is being written by another process" % (path))
+        self._boxes = open(os.path.join(path, BOXES), 'ab+')
+        # Drop a partial frame record, then unreferenced boxes
+        size = os.fstat(self._frames.fileno()).st_size
+        size -= size % FRAME.itemsize
+        self._frames.truncate(size)
+        end = 0
+        if size > 0:
+            self._frames.seek(size - FRAME.itemsize)
+            last = numpy.frombuffer(self._frames.read(FRAME.itemsize), dtype=FRAME)[0]
+            end = int(last['box']) + int(last['count'])
+        self._boxes.truncate(end*BOX.itemsize)
+        self._end = end
+
+    def append(self, img_time, mode, frame, boxes, scores=None, names=None):
+        """Append the detections of a frame.
+
+            Args:
+                img_time: the time of capture.
+                mode: the detection mode, e.g. "motion".
+                frame: the cv2 image, for its size and statistics.
+                boxes: boxes as top-left and bottom-right, x and y.
+                scores: a score per box, or None.
+                names: a recognized name per box, or None.
+
+            Returns:
+
+            Raises:
+                OSError: if the records can not be written.
+
+        """
+        (h, w) = frame.shape[:2]
+        brightness, area = statistics(frame, boxes)
+        records = numpy.zeros(len(boxes), dtype=BOX)
+        if len(boxes) > 0:
+            coords = numpy.clip(numpy.array(boxes, dtype=numpy.int64), -32768, 32767)
+            for i, column in enumerate(('x1', 'y1', 'x2', 'y2')):
+                records[column] = coords[:, i]
+        records['score'] = numpy.nan if scores is None else scores
+        if names is not None:
+            records['name'] = [(n or '').encode('utf-8')[:BOX['name'].itemsize] for n in names]
+        self._boxes.write(records.tobytes())
+        self._boxes.flush()
+        record = numpy.array([(archive.to_ms(img_time), mode.encode('utf-8'), w, h, brightness, area, self._end, len(boxes))], dtype=FRAME)
+        self._frames.write(record.tobytes())
+        self._frames.flush()
+        self._end += len(boxes)
+
+    def close(self):
+        self._boxes.close()
+        self._frames.close()
+
+class Log(object):
+    """Append detections to the day folders under a root, switching day as
+    time goes by.
+
+        Attributes:
+            root: the folder holding the day hierarchy, e.g. detected.
+
+    """
+
+    def __init__(self, root="detected"):
+        self.root = root
+        self._day = None
+        self._writer = None
+
+    def daypath(self, img_time):
+        return "/".join((self.root, str(img_time.year), str(img_time.month) + ". " + img_time.strftime('%B'), str(img_time.day)))
+
+    def append(self, img_time, mode, frame, boxes, scores=None, names=None):
+        """Append the detections of a frame to the metadata of its day.
+
+            See Writer.append().
+
+        """
+        day = img_time.date()
+        if day != self._day:
+            self.close()
+            self._writer = Writer(self.daypath(img_time))
+            self._day = day
+        self._writer.append(img_time, mode, frame, boxes, scores, names)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+        self._writer = None
+        self._day = None
+
+class Reader(object):
+    """Query the metadata of a day folder.
+
+        Both files are memory mapped. refresh() maps records appended
+        since, so a reader follows a live writer.
+
+        Attributes:
+            path: the day folder.
+            frames: the frame records, a numpy structured array.
+            boxes: the box records, a numpy structured array.
+
+    """
+
+    def __init__(self, path):
+        """Reader constructor.
+
+            Args:
+                path: the day folder.
+
+            Returns:
+                A Reader object.
+
+            Raises:
+                OSError: if the day has no metadata.
+
+        """
+        self.path = path
+        self.frames = numpy.zeros(0, dtype=FRAME)
+        self.boxes = numpy.zeros(0, dtype=BOX)
+        self._size = -1
+        self._times = dict()
+        self._lock = threading.Lock()
+        if not os.path.exists(os.path.join(path, FRAMES)):
+            raise OSError("No metadata in %s" % (path))
+        self.refresh()
+
+    def refresh(self):
+        """Map records appended since the last refresh.
+
+            Returns:
+                True if new records were found.
+
+            Raises:
+
+        """
+        with self._lock:
+            size = os.path.getsize(os.path.join(self.path, FRAMES))
+            size -= size % FRAME.itemsize
+            if size == self._size:
+                return False
+            if size > 0:
+                frames = numpy.memmap(os.path.join(self.path, FRAMES), dtype=FRAME, mode='r', shape=(size//FRAME.itemsize,))
+                count = int(frames[-1]['box']) + int(frames[-1]['count'])
+                boxes = numpy.memmap(os.path.join(self.path, BOXES), dtype=BOX, mode='r', shape=(count,)) if count > 0 else numpy.zeros(0, dtype=BOX)
+            else:
+                frames = numpy.zeros(0, dtype=FRAME)
+                boxes = numpy.zeros(0, dtype=BOX)
+            known = self._size//FRAME.itemsize if self._size > 0 else 0
+            self._times.update((t, known + i) for i, t in enumerate(frames['time'][known:].tolist()))
+            self.frames, self.boxes, self._size = frames, boxes, size
+            return True
+
+    def __len__(self):
+        return len(self.frames)
+
+    def find(self, name):
+        """Position of the record of a frame name, or None.
+        """
+        img_time = archive.parse_name(name)
+        if img_time is None:
+            return None
+        i = self._times.get(archive.to_ms(img_time))
+        if i is None and self.refresh():
+            i = self._times.get(archive.to_ms(img_time))
+        return i
+
+    def name(self, i):
+        """Frame name of the i-th record.
+        """
+        return archive.frame_name(archive.from_ms(self.frames[i]['time']))
+
+    def detections(self, i):
+        """Detections of the i-th record.
+
+            Returns:
+                The mode, and a list of (box, score, name) with boxes as
+                top-left and bottom-right, x and y, and name None if no
+                name was recognized.
+
+            Raises:
+
+        """
+        record = self.frames[i]
+        boxes = self.boxes[int(record['box']):int(record['box']) + int(record['count'])]
+        return (record['mode'].decode('utf-8'),
+                [((int(b['x1']), int(b['y1']), int(b['x2']), int(b['y2'])), float(b['score']), b['name'].decode('utf-8') or None) for b in boxes])
+
+    def where(self, mode=None, name=None, min_count=1, min_area=0.0):
+        """Records matching all given conditions, in time order.
+
+            Args:
+                mode: the detection mode, or None for any.
+                name: a recognized name, or None for any.
+                min_count: the minimum number of boxes.
+                min_area: the minimum area of the largest box, as a
+                          fraction of the frame.
+
+            Returns:
+                A numpy array of record positions.
+
+            Raises:
+
+        """
+        frames = self.frames
+        keep = (frames['count'] >= min_count) & (frames['area'] >= min_area)
+        if mode is not None:
+            keep &= frames['mode'] == mode.encode('utf-8')
+        if name is not None:
+            # Frame of each box, then frames with a box of that name
+            owners = numpy.repeat(numpy.arange(len(frames)), frames['count'].astype(numpy.int64))
+            named = numpy.zeros(len(frames), dtype=bool)
+            named[owners[self.boxes['name'][:len(owners)] == name.encode('utf-8')]] = True
+            keep &= named
+        return numpy.flatnonzero(keep)
+
+    def largest(self, n=10):
+        """Records with the largest boxes, largest first.
+        """
+        return numpy.argsort(-self.frames['area'], kind='stable')[:n]
+
+    def close(self):
+        """Unmap the records, a later refresh() maps them again.
+        """
+        with self._lock:
+            self.frames = numpy.zeros(0, dtype=FRAME)
+            self.boxes = numpy.zeros(0, dtype=BOX)
+            self._times = dict()
+            self._size = -1
+
+# Readers are kept open for the most recently used days
+readers = archive.Readers(Reader)
+
+def reader(path):
+    """The Reader of a day folder, or None if it has no metadata.
+    """
+    return readers.get(path)
+
+def lookup(path):
+    """Detections recorded for a frame, see Reader.detections().
+
+        Args:
+            path: the frame path, day folder and frame name.
+
+        Returns:
+            The mode and detections, or None if none were recorded.
+
+        Raises:
+
+    """
+    meta = reader(os.path.dirname(path))
+    i = None if meta is None else meta.find(os.path.basename(path))
+    return None if i is None else meta.detections(i)
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Query the detections recorded in a day folder.")
+    parser.add_argument("path", help="A day folder, e.g. \"detected/2019/3. March/5\"")
+    parser.add_argument("-m", "--mode", help="Frames detected in this mode")
+    parser.add_argument("-n", "--name", help="Frames where this name was recognized")
+    parser.add_argument("-c", "--count", help="Frames with at least this many boxes (default 1)", type=int, default=1)
+    parser.add_argument("-l", "--largest", help="The N frames with the largest boxes", type=int)
+    args = parser.parse_args()
+
+    meta = reader(args.path)
+    if meta is None:
+        parser.exit(1, "No metadata in %s\n" % (args.path))
+    found = meta.where(args.mode, args.name, args.count)
+    if args.largest is not None:
+        matching = set(found.tolist())
+        found = [i for i in meta.largest(len(meta)) if i in matching][:args.largest]
+    for i in found:
+        mode, detections = meta.detections(i)
+        boxes = ' '.join('%d,%d,%d,%d%s' % (box + (':' + name if name else '',)) for box, _, name in detections)
+        print('%s  %-16s %5.1f%%  %s' % (meta.name(i), mode, 100*meta.frames[i]['area'], boxes))
@@ -0,0 +1,284 @@
+"""
+Lightweight instrumentation: stage timers, counters and histograms,
+exported as Prometheus text on localhost or as a periodic log line.
+"""
+# coding: utf-8
+
+# Standard imports
+import time
+import bisect
+import threading
+import http.server
+
+# Latency histogram bucket upper bounds, in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+class Histogram(object):
+    """Fixed-size latency histogram.
+
+        Attributes:
+            bounds: bucket upper bounds, in seconds, the last bucket
+                    counts everything above them.
+            counts: observations per bucket.
+            sum: sum of all observations.
+            count: number of observations.
+
+    """
+
+    def __init__(self, bounds=BUCKETS):
+        self.bounds = tuple(bounds)
+        self.counts = [0]*(len(self.bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        """Add an observation.
+        """
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Estimate a quantile from the buckets, as the upper bound of the
+        bucket holding it. Returns None if there are no observations.
+        """
+        if self.count == 0:
+            return None
+        rank = q*self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+class _Timer(object):
+    """Context manager timing one block into a histogram.
+    """
+
+    __slots__ = ('histogram', 'lock', 'start')
+
+    def __init__(self, histogram, lock):
+        self.histogram = histogram
+        self.lock = lock
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.monotonic() - self.start
+        with self.lock:
+            self.histogram.observe(elapsed)
+        return False
+
+class _NullTimer(object):
+    """Context manager doing nothing, used while metrics are disabled.
+    """
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+NULL_TIMER = _NullTimer()
+
+class Metrics(object):
+    """Registry of stage latencies and counters.
+
+        While disabled, stage() returns a shared no-op context manager and
+        count() returns immediately, so instrumented code costs a method
+        call per stage. Each stage() call returns its own timer, so a
+        stage can be timed from several threads at once, and observations
+        are recorded under a lock; export takes a consistent enough
+        snapshot for monitoring without taking it.
+
+        Attributes:
+            prefix: name prefix of exported metrics.
+            enabled: whether observations are recorded.
+            stages: stage name -> Histogram.
+            counters: counter name -> value.
+
+    """
+
+    def __init__(self, prefix='turret', enabled=False):
+        """Metrics constructor.
+
+            Args:
+                prefix: name prefix of exported metrics.
+                enabled: whether observations are recorded.
+
+            Returns:
+                A Metrics object.
+
+            Raises:
+
+        """
+        self.prefix = prefix
+        self.enabled = enabled
+        self.stages = dict()
+        self.counters = dict()
+        self.started = time.monotonic()
+        self._lock = threading.Lock()
+        self._server = None
+        self._logger = None
+
+    def stage(self, name):
+        """Time a block of code as a pipeline stage.
+
+            Args:
+                name: the stage name, e.g. "capture".
+
+            Returns:
+                A context manager.
+
+            Raises:
+
+        """
+        if not self.enabled:
+            return NULL_TIMER
+        histogram = self.stages.get(name)
+        if histogram is None:
+            with self._lock:
+                histogram = self.stages.setdefault(name, Histogram())
+        return _Timer(histogram, self._lock)
+
+    def observe(self, name, seconds):
+        """Record a duration measured elsewhere for a stage.
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            histogram = self.stages.get(name)
+            if histogram is None:
+                histogram = self.stages.setdefault(name, Histogram())
+            histogram.observe(seconds)
+
+    def count(self, name, value=1):
+        """Increase a counter.
+
+            Args:
+                name: the counter name, e.g. "frames".
+                value: the increment.
+
+            Returns:
+
+            Raises:
+
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def render(self):
+        """Format all metrics in the Prometheus text exposition format.
+
+            Returns:
+                A string.
+
+            Raises:
+
+        """
+        lines = list()
+        name = '%s_uptime_seconds' % (self.prefix)
+        lines.append('# TYPE %s gauge' % (name))
+        lines.append('%s %.3f' % (name, time.monotonic() - self.started))
+        for counter, value in sorted(list(self.counters.items())):
+            name = '%s_%s_total' % (self.prefix, counter)
+            lines.append('# TYPE %s counter' % (name))
+            lines.append('%s %d' % (name, value))
+        name = '%s_stage_seconds' % (self.prefix)
+        if self.stages:
+            lines.append('# TYPE %s histogram' % (name))
+        for stage, histogram in sorted(list(self.stages.items())):
+            counts = list(histogram.counts)
+            cumulative = 0
+            for bound, count in zip(histogram.bounds, counts):
+                cumulative += count
+                lines.append('%s_bucket{stage="%s",le="%g"} %d' % (name, stage, bound, cumulative))
+            cumulative += counts[-1]
+            lines.append('%s_bucket{stage="%s",le="+Inf"} %d' % (name, stage, cumulative))
+            lines.append('%s_sum{stage="%s"} %.6f' % (name, stage, histogram.sum))
+            lines.append('%s_count{stage="%s"} %d' % (name, stage, cumulative))
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """One line summary: counters, then mean and p95 bound per stage.
+
+            Returns:
+                A string.
+
+            Raises:
+
+        """
+        parts = ['%s=%d' % (k, v) for k, v in sorted(list(self.counters.items()))]
+        for stage, histogram in sorted(list(self.stages.items())):
+            if histogram.count == 0: continue
+            parts.append('%s=%.1fms/p95<%.0fms' % (stage, 1000*histogram.sum/histogram.count, 1000*histogram.quantile(0.95)))
+        return ' '.join(parts)
+
+    def serve(self, port, host='127.0.0.1'):
+        """Serve metrics over HTTP from a background thread.
+
+            Any path answers with render(), e.g. http://127.0.0.1:port/metrics.
+
+            Args:
+                port: the TCP port, 0 for any free port.
+                host: the address to listen on, localhost by default.
+
+            Returns:
+                The (host, port) address served.
+
+            Raises:
+                OSError: if the port can not be bound.
+
+        """
+        metrics = self
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                content = metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+            def log_message(self, *args):
+                pass
+        self._server = http.server.ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self._server.server_address[:2]
+
+    def log_every(self, interval, write=print):
+        """Write summary() every interval seconds from a background thread.
+
+            Args:
+                interval: seconds between lines.
+                write: function called with each line.
+
+            Returns:
+
+            Raises:
+
+        """
+        def run():
+            while not self._stopped.wait(interval):
+                write('[metrics] %s' % (self.summary()))
+        self._stopped = threading.Event()
+        self._logger = threading.Thread(target=run, daemon=True)
+        self._logger.start()
+
+    def stop(self):
+        """Stop the HTTP server and the log thread, if any.
+        """
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        if self._logger is not None:
+            self._stopped.set()
+            self._logger = None
@@ -0,0 +1,148 @@
+"""
+Frame preprocessing: rotation and timestamp overlay, with cached state.
+"""
+# coding: utf-8
+
+# External imports
+import cv2
+import numpy
+
+# Rotations that cv2.rotate() performs exactly, by clockwise angle
+FAST_ROTATIONS = {  90: cv2.ROTATE_90_CLOCKWISE,
+                    180: cv2.ROTATE_180,
+                    270: cv2.ROTATE_90_COUNTERCLOCKWISE }
+
+class Rotation(object):
+    """Rotate frames clockwise by a fixed angle, keeping the whole frame.
+
+        Same geometry as imgutils.rotate_bound(). The rotation matrix and
+        output size are computed once per input frame size, and the
+        output is written to a reused buffer. Multiples of 90 degrees use
+        cv2.rotate(), which is exact and much faster than warpAffine().
+
+        The returned frame is overwritten by the next call; copy it if it
+        must outlive the current frame.
+
+        Attributes:
+            angle: clockwise rotation in degrees.
+
+    """
+
+    def __init__(self, angle):
+        """Rotation constructor.
+
+            Args:
+                angle: clockwise rotation in degrees.
+
+            Returns:
+                A Rotation object.
+
+            Raises:
+
+        """
+        self.angle = angle % 360
+        self._shape = None
+        self._matrix = None
+        self._size = None
+        self._output = None
+
+    def _prepare(self, shape):
+        """Compute the rotation matrix and output buffer for a frame shape.
+        """
+        (h, w) = shape[:2]
+        (cX, cY) = (w // 2, h // 2)
+
+        if self.angle in FAST_ROTATIONS:
+            self._matrix = None
+            self._size = (w, h) if self.angle == 180 else (h, w)
+        else:
+            M = cv2.getRotationMatrix2D((cX, cY), -self.angle, 1.0)
+            cos = numpy.abs(M[0, 0])
+            sin = numpy.abs(M[0, 1])
+            nW = int((h * sin) + (w * cos))
+            nH = int((h * cos) + (w * sin))
+            M[0, 2] += (nW / 2) - cX
+            M[1, 2] += (nH / 2) - cY
+            self._matrix = M
+            self._size = (nW, nH)
+
+        self._output = numpy.empty((self._size[1], self._size[0]) + tuple(shape[2:]), dtype=numpy.uint8)
+        self._shape = shape
+
+    def __call__(self, frame):
+        """Rotate a frame.
+
+            Args:
+                frame: a cv2 image.
+
+            Returns:
+                The rotated frame, in the reused output buffer.
+
+            Raises:
+
+        """
+        if self.angle == 0:
+            return frame
+        if frame.shape != self._shape or frame.dtype != self._output.dtype:
+            self._prepare(frame.shape)
+        if self._matrix is None:
+            return cv2.rotate(frame, FAST_ROTATIONS[self.angle], dst=self._output)
+        return cv2.warpAffine(frame, self._matrix, self._size, dst=self._output)
+
+class Timestamp(object):
+    """Draw the current date and time in the top left corner of frames.
+
+        Text is rasterized into a mask only when the second changes; each
+        frame then just paints the mask with a solid plate, in white over
+        dark backgrounds and in black over bright ones.
+
+    """
+
+    FONT = cv2.FONT_HERSHEY_PLAIN
+    SCALE = 1.2
+    ORIGIN = (5, 20)
+
+    def __init__(self):
+        """Timestamp constructor.
+        """
+        self._text = None
+        self._mask = None
+        self._plates = None
+
+    def _render(self, text):
+        """Rasterize text into a mask covering the top left corner.
+        """
+        (w, h), baseline = cv2.getTextSize(text, self.FONT, self.SCALE, 1)
+        mask = numpy.zeros((self.ORIGIN[1] + baseline + 2, self.ORIGIN[0] + w + 2), dtype=numpy.uint8)
+        cv2.putText(mask, text, self.ORIGIN, self.FONT, self.SCALE, 255, 0, 4)
+        if self._plates is None or self._plates[0].shape[:2] != mask.shape:
+            self._plates = (numpy.full(mask.shape + (3,), 255, dtype=numpy.uint8),
+                            numpy.zeros(mask.shape + (3,), dtype=numpy.uint8))
+        self._mask = mask
+        self._text = text
+
+    def __call__(self, frame, now):
+        """Draw a time on a frame, in place.
+
+            Args:
+                frame: a cv2 BGR image.
+                now: a datetime.
+
+            Returns:
+                The frame.
+
+            Raises:
+
+        """
+        text = '%02d/%02d/%04d %02d:%02d:%02d' % (now.day, now.month, now.year, now.hour, now.minute, now.second)
+        if text != self._text:
+            self._render(text)
+        white, black = self._plates
+        plate = white if sum(cv2.mean(frame[0:30,0:120])[:3])/(3*255) < 0.6 else black
+        (h, w) = self._mask.shape
+        if frame.shape[0] < h or frame.shape[1] < w:
+            (h, w) = (min(h, frame.shape[0]), min(w, frame.shape[1]))
+            cv2.copyTo(plate[:h, :w], self._mask[:h, :w], frame[:h, :w])
+        else:
+            cv2.copyTo(plate, self._mask, frame[:h, :w])
+        return frame
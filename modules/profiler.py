@@ -0,0 +1,163 @@
+"""
+On-demand stack sampling profiler for running processes.
+
+Send SIGUSR1 to the process to sample the stacks of all its threads for a
+few seconds, then write them in the collapsed stack format read by
+flamegraph.pl and speedscope, one "frame;frame;frame count" line each.
+"""
+# coding: utf-8
+
+# Standard imports
+import os
+import sys
+import time
+import signal
+import datetime
+import threading
+from collections import Counter
+
+class Sampler(object):
+    """Time-bounded sampler of the stacks of every thread.
+
+        Attributes:
+            duration: seconds to sample for.
+            interval: seconds between samples.
+            directory: where profiles are written.
+            prefix: file name prefix of profiles.
+            log: function called with status messages.
+
+    """
+
+    def __init__(self, duration=10.0, interval=0.005, directory='profiles', prefix='profile', log=print):
+        """Sampler constructor.
+
+            Args:
+                duration: seconds to sample for.
+                interval: seconds between samples.
+                directory: where profiles are written.
+                prefix: file name prefix of profiles.
+                log: function called with status messages.
+
+            Returns:
+                A Sampler object.
+
+            Raises:
+
+        """
+        self.duration = duration
+        self.interval = interval
+        self.directory = directory
+        self.prefix = prefix
+        self.log = log
+        self._thread = None
+        self._lock = threading.Lock()
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        """Start a sampling session in a background thread.
+
+            Safe to call from a signal handler.
+
+            Returns:
+                False if a session is already running, else True.
+
+            Raises:
+
+        """
+        # Never block: a signal may arrive while the lock is held
+        if not self._lock.acquire(blocking=False):
+            return False
+        try:
+            if self.running:
+                return False
+            self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+            self._thread.start()
+            return True
+        finally:
+            self._lock.release()
+
+    def _run(self):
+        """Sample, then write the profile.
+        """
+        self.log('Profiling all threads for %gs' % (self.duration))
+        me = threading.get_ident()
+        stacks = Counter()
+        samples = 0
+        deadline = time.monotonic() + self.duration
+        while time.monotonic() < deadline:
+            names = dict((t.ident, t.name) for t in threading.enumerate())
+            for ident, frame in sys._current_frames().items():
+                if ident == me: continue
+                stack = list()
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                    frame = frame.f_back
+                stack.append(names.get(ident, 'thread-%d' % (ident)))
+                stacks[';'.join(reversed(stack))] += 1
+            samples += 1
+            time.sleep(self.interval)
+        path = self.dump(stacks)
+        self.log('Profile of %d samples written to %s' % (samples, path))
+        for function, count in self.top(stacks):
+            self.log('%6.1f%%  %s' % (100.0*count/max(samples, 1), function))
+
+    def dump(self, stacks):
+        """Write stacks in the collapsed stack format.
+
+            Args:
+                stacks: a Counter of ';' joined stacks, root first.
+
+            Returns:
+                The path of the profile.
+
+            Raises:
+                OSError: if the profile can not be written.
+
+        """
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        name = '%s-%d-%s.folded' % (self.prefix, os.getpid(), datetime.datetime.now().strftime('%Y%m%d-%H%M%S'))
+        path = os.path.join(self.directory, name)
+        with open(path + '.tmp', 'w') as profile:
+            for stack, count in stacks.most_common():
+                profile.write('%s %d\n' % (stack, count))
+        os.replace(path + '.tmp', path)
+        return path
+
+    @staticmethod
+    def top(stacks, n=10):
+        """Functions most often on top of a stack, with their sample counts.
+        """
+        leaves = Counter()
+        for stack, count in stacks.items():
+            leaves[stack.rsplit(';', 1)[-1]] += count
+        return leaves.most_common(n)
+
+def install(signum=getattr(signal, 'SIGUSR1', None), **kwargs):
+    """Start a profiling session whenever the process receives a signal.
+
+        Must be called from the main thread. Does nothing on platforms
+        without the signal, e.g. SIGUSR1 on Windows.
+
+        Args:
+            signum: the signal, SIGUSR1 by default.
+            kwargs: Sampler arguments.
+
+        Returns:
+            The Sampler, or None if the signal is not available.
+
+        Raises:
+
+    """
+    if signum is None:
+        return None
+    sampler = Sampler(**kwargs)
+    def handler(signum, frame):
+        if not sampler.start():
+            sampler.log('Profiling already running')
+    signal.signal(signum, handler)
+    return sampler
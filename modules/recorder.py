@@ -0,0 +1,154 @@
+"""
+Record detection events as clips, with the seconds before and after them.
+"""
+# coding: utf-8
+
+# Standard imports
+import os
+import queue
+import threading
+import collections
+
+# External imports
+import cv2
+
+# Project imports
+from . import save
+
+class ClipRecorder(object):
+    """Record events as Motion JPEG clips from a ring of recent frames.
+
+        Every frame pushed is JPEG encoded in a background thread and
+        kept in a ring holding the last pre seconds. When a frame has a
+        detection, a clip is opened in a clips/ folder of the day, the
+        ring is written to it as pre-roll, and every following frame is
+        appended until post seconds after the last detection. Clips are
+        concatenated JPEG frames (.mjpeg), which ffmpeg, VLC and
+        cv2.VideoCapture play. Detection times still go to the
+        activity.log of the day.
+
+        Attributes:
+            pre: seconds kept before a detection.
+            post: seconds recorded after the last detection.
+            quality: JPEG quality, 0 to 100.
+            root: the folder holding the day hierarchy.
+            clips: paths of the clips written so far.
+            dropped: frames dropped because the writer fell behind.
+
+    """
+
+    def __init__(self, pre=5.0, post=5.0, quality=80, root="detected", max_ring_bytes=64*1024*1024, queue_size=64):
+        """ClipRecorder constructor.
+
+            Args:
+                pre: seconds kept before a detection.
+                post: seconds recorded after the last detection.
+                quality: JPEG quality, 0 to 100.
+                root: the folder holding the day hierarchy.
+                max_ring_bytes: memory bound of the pre-roll ring.
+                queue_size: frames waiting for the writer thread.
+
+            Returns:
+                A ClipRecorder object.
+
+            Raises:
+
+        """
+        self.pre = pre
+        self.post = post
+        self.quality = quality
+        self.root = root
+        self.max_ring_bytes = max_ring_bytes
+        self.clips = list()
+        self.dropped = 0
+        self._ring = collections.deque()
+        self._ring_bytes = 0
+        self._clip = None
+        self._clip_path = None
+        self._last_found = None
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = threading.Thread(target=self._run, name='recorder', daemon=True)
+        self._thread.start()
+
+    def push(self, frame, now, found):
+        """Hand a frame to the recorder.
+
+            Args:
+                frame: a cv2 image, copied so the caller may reuse it.
+                now: the time of capture.
+                found: True if the frame has a detection.
+
+            Returns:
+                False if the frame was dropped, else True.
+
+            Raises:
+
+        """
+        try:
+            self._queue.put_nowait((frame.copy(), now, found))
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def stop(self):
+        """Write pending frames, close the open clip and stop the writer.
+        """
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        """Encode queued frames and write clips until stopped.
+        """
+        params = [int(cv2.IMWRITE_JPEG_QUALITY), self.quality]
+        while True:
+            item = self._queue.get()
+            if item is None: break
+            frame, now, found = item
+            ok, jpeg = cv2.imencode('.jpg', frame, params)
+            if not ok: continue
+            jpeg = jpeg.tobytes()
+            if found:
+                self._last_found = now
+                save.log_activity(now, self.root)
+                if self._clip is None: self._open()
+            if self._clip is not None:
+                self._clip.write(jpeg)
+                if (now - self._last_found).total_seconds() > self.post:
+                    self._close()
+            else:
+                self._keep(now, jpeg)
+        self._close()
+
+    def _keep(self, now, jpeg):
+        """Add a frame to the pre-roll ring and drop the ones too old.
+        """
+        self._ring.append((now, jpeg))
+        self._ring_bytes += len(jpeg)
+        while self._ring and ((now - self._ring[0][0]).total_seconds() > self.pre or self._ring_bytes > self.max_ring_bytes):
+            self._ring_bytes -= len(self._ring.popleft()[1])
+
+    def _open(self):
+        """Open a clip named after its first frame and write the pre-roll.
+        """
+        start = self._ring[0][0] if self._ring else self._last_found
+        path = "/".join((save.daypath(start, self.root), "clips"))
+        if not os.path.exists(path):
+            os.makedirs(path, exist_ok=True)
+        path = "/".join((path, save.filename(start, ".mjpeg")))
+        self._clip = open(path + ".tmp", "wb", buffering=1024*1024)
+        self._clip_path = path
+        for _, jpeg in self._ring:
+            self._clip.write(jpeg)
+        self._ring.clear()
+        self._ring_bytes = 0
+
+    def _close(self):
+        """Close the open clip, if any, and publish it under its name.
+        """
+        if self._clip is None: return
+        self._clip.close()
+        os.replace(self._clip_path + ".tmp", self._clip_path)
+        self.clips.append(self._clip_path)
+        self._clip = None
+        self._clip_path = None
@@ -15,10 +15,52 @@ from collections import deque
 # External imports
 import cv2
 
+# Project imports
+from . import imload
+from . import archive
+
 CV_CAP_PROP_POS_FRAMES = 1
 CV_CAP_PROP_FRAME_COUNT = 7
 
-def save(img, img_time):
+def daypath(img_time, root="detected"):
+    """Folder holding the detections of a day, root/year/month/day.
+
+        Args:
+            img_time: a datetime inside the day.
+            root: the folder holding the hierarchy.
+
+        Returns:
+            The folder path, which may not exist yet.
+
+        Raises:
+
+    """
+    return "/".join((root, str(img_time.year), str(img_time.month) + ". " + img_time.strftime('%B'), str(img_time.day)))
+
+def filename(img_time, extension=".jpg"):
+    """Name of a file captured at a time, e.g. 2019-03-05 14h02m59.123s.jpg
+    """
+    return str(img_time)[:10] + ' ' + '%02dh%02dm%02d.%03ds' % (img_time.hour, img_time.minute, img_time.second, img_time.microsecond//1000) + extension
+
+def log_activity(img_time, root="detected"):
+    """Append a detection time to the activity.log of its day.
+
+        Args:
+            img_time: the time of the detection.
+            root: the folder holding the hierarchy.
+
+        Returns:
+
+        Raises:
+
+    """
+    path = daypath(img_time, root)
+    if not os.path.exists(path):
+        os.makedirs(path, exist_ok=True)
+    with open("/".join((path, "activity.log")), "a") as activity_log:
+        activity_log.write(img_time.strftime('%Y/%m/%d %H:%M:%S') + '\n')
+
+def save(img, img_time, root="detected", packed=None):
     """Save images to disc or a Google Drive account.
 
         Save an image in a hierarchical structure inside the detected/
@@ -28,68 +70,65 @@ def save(img, img_time):
         Args:
             img: a cv2 image.
             img_time: the time of capture.
-            google: a Drive object.
+            root: the folder holding the hierarchy, e.g. detected/door
+                  for a stream named door.
+            packed: an archive.Archive under root; if given, the image
+                    is appended to the pack of its day instead of being
+                    written to its own file.
 
         Returns:
+            The path of the saved image, loose or packed.
 
         Raises:
 
     """
 
-    Y = img_time.year
-    M = img_time.month
-    M_str = img_time.strftime('%B')
-    D = img_time.day
-    h = img_time.hour
-    m = img_time.minute
-    s = img_time.second
-    ms = img_time.microsecond//1000
-    hms = str(img_time)[:10] + ' ' + '%02d'%(h) + 'h' + '%02d'%(m) + 'm' + '%02d.%03d'%(s,ms) + 's' + '.jpg'
-
-    if os.path.exists("/".join(("detected", str(Y), str(M) + ". " + M_str, str(D)))):
-        cv2.imwrite("/".join(("detected", str(Y), str(M) + ". " + M_str, str(D), hms)), img)
-    elif os.path.exists("/".join(("detected", str(Y), str(M) + ". " + M_str))):
-        os.mkdir("/".join(("detected", str(Y), str(M) + ". " + M_str, str(D))))
-        cv2.imwrite("/".join(("detected", str(Y), str(M) + ". " + M_str, str(D), hms)), img)
-    elif os.path.exists("/".join(("detected", str(Y)))):
-        os.mkdir("/".join(("detected", str(Y), str(M) + ". " + M_str)))
-        os.mkdir("/".join(("detected", str(Y), str(M) + ". " + M_str, str(D))))
-        cv2.imwrite("/".join(("detected", str(Y), str(M) + ". " + M_str, str(D), hms)), img)
-    elif os.path.exists("detected"):
-        os.mkdir("/".join(("detected", str(Y))))
-        os.mkdir("/".join(("detected", str(Y), str(M) + ". " + M_str)))
-        os.mkdir("/".join(("detected", str(Y), str(M) + ". " + M_str, str(D))))
-        cv2.imwrite("/".join(("detected", str(Y), str(M) + ". " + M_str, str(D), hms)), img)
+    if packed is not None:
+        _, jpeg = cv2.imencode(".jpg", img)
+        framepath = packed.append(jpeg, img_time)
     else:
-        os.mkdir("detected")
-        os.mkdir("/".join(("detected", str(Y))))
-        os.mkdir("/".join(("detected", str(Y), str(M) + ". " + M_str)))
-        os.mkdir("/".join(("detected", str(Y), str(M) + ". " + M_str, str(D))))
-        cv2.imwrite("/".join(("detected", str(Y), str(M) + ". " + M_str, str(D), hms)), img)
-    
-    with open("/".join(("detected", str(Y), str(M) + ". " + M_str, str(D), "activity.log")), "a") as activity_log:
-        activity_log.write('%04d/%02d/%02d %02d:%02d:%02d\n' % (Y,M,D,h,m,s))
-                                                                                                                                                                                            
-
-def video(time_, fps=30):
-    """
+        path = daypath(img_time, root)
+        if not os.path.exists(path):
+            os.makedirs(path, exist_ok=True)
+        framepath = "/".join((path, filename(img_time)))
+        cv2.imwrite(framepath, img)
+
+    log_activity(img_time, root)
+
+    return framepath
+
+
+def video(time_, fps=30, reduction=1, root="detected"):
+    """Join the frames detected in a day into a video.
+
+        Args:
+            time_: a datetime inside the day to convert.
+            fps: frame rate of the video.
+            reduction: 1, 2, 4 or 8; frames are decoded and written with
+                       width and height divided by this factor.
+            root: the folder holding the hierarchy, as in save().
+
+        Returns:
+
+        Raises:
+
     """
 
-    path = "/".join(("detected", str(time_.year), str(time_.month) + ". " + time_.strftime('%B'), str(time_.day)))
-    name = ".".join(("detected", str(time_.year), str(time_.month) + ". " + time_.strftime('%B'), str(time_.day)))
+    path = daypath(time_, root)
+    name = ".".join((root.replace("/", "."), str(time_.year), str(time_.month) + ". " + time_.strftime('%B'), str(time_.day)))
     frames = list()
 
     if os.path.exists(path):
 
-        files = [f for f in os.listdir(path) if os.path.isfile(os.path.join(path, f)) and not f.endswith('.avi')]
-        files.sort()
+        # Loose and packed frames, in time order
+        files = archive.names(path)
 
         output_path = os.path.join(path, name+'.avi')
 
         if int(cv2.__version__[0]) < 4:
-            video_ = cv2.VideoWriter(output_path+'.tmp.avi', cv2.VideoWriter_fourcc(*'MJPG'), fps, (480, 640))
+            video_ = cv2.VideoWriter(output_path+'.tmp.avi', cv2.VideoWriter_fourcc(*'MJPG'), fps, (480//reduction, 640//reduction))
         else:
-            video_ = cv2.VideoWriter(output_path+'.tmp.avi', cv2.VideoWriter_fourcc(*'MJPG'), fps, (640, 480))
+            video_ = cv2.VideoWriter(output_path+'.tmp.avi', cv2.VideoWriter_fourcc(*'MJPG'), fps, (640//reduction, 480//reduction))
 
         if os.path.exists(output_path):
             _video = cv2.VideoCapture(output_path)
@@ -101,8 +140,8 @@ def video(time_, fps=30):
 
         for f in files:
             f = os.path.join(path, f)
-            frame = cv2.imread(f)
-            video_.write(frame)
+            frame = imload.imread(f, reduction=reduction)
+            if frame is not None: video_.write(frame)
             # os.remove(f)
         
         video_.release()
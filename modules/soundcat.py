@@ -6,7 +6,11 @@ Categorize and play sounds randomly, based on category.
 # Standard imports
 import os
 import time
+import queue
 import random
+import threading
+import itertools
+import collections
 
 os.environ['PYGAME_HIDE_SUPPORT_PROMPT'] = '1'
 
@@ -33,16 +37,23 @@ class Soundcat(object):
 
         Note: All audio files must be WAV.
 
+        Sound files are listed once, when a category is added, and their
+        decoded samples are kept in memory, up to cache_size sounds. Sounds
+        play on a pool of reserved mixer channels.
+
         Attributes:
-            No public attributes.
+            pps: maximum plays per second when play() is called with
+                 use_pps=True.
 
     """
 
-    def __init__(self, pps=0.1):
+    def __init__(self, pps=0.1, cache_size=32, channels=4):
         """Soundcat constructor.
 
             Args:
-                None.
+                pps: maximum plays per second, see play().
+                cache_size: maximum number of decoded sounds kept in memory.
+                channels: number of mixer channels reserved for playback.
 
             Returns:
                 A Soundcat object.
@@ -55,9 +66,20 @@ class Soundcat(object):
         pygame.init()
         pygame.mixer.init()
 
-        # A dictionary to connect the names of categories and its sounds
+        # A dictionary to connect the names of categories and its sound files
         self._categories = {}
 
+        # Decoded sounds by file path, least recently played first
+        self._sounds = collections.OrderedDict()
+        self._cache_size = cache_size
+
+        # Reserve a pool of channels, so playback never waits for a free one
+        if pygame.mixer.get_num_channels() < channels:
+            pygame.mixer.set_num_channels(channels)
+        pygame.mixer.set_reserved(channels)
+        self._channels = [pygame.mixer.Channel(i) for i in range(channels)]
+        self._next_channel = 0
+
         # The pps (plays per second) defines how verbose soundcat should be
         self.pps = pps
         self._last_play_time = time.time()
@@ -98,8 +120,43 @@ class Soundcat(object):
 
         """
 
-        # Link category name and path
-        self._categories[category_name] = directory;
+        # Link category name and its WAV files
+        entries = sorted(os.listdir(directory))
+        self._categories[category_name] = ["/".join((directory, entry)) for entry in entries if entry.endswith(".wav")]
+
+        # Preload sounds while there is room in the cache
+        for path in self._categories[category_name]:
+            if len(self._sounds) >= self._cache_size: break
+            self._sound(path)
+
+
+    def _sound(self, path):
+        """Return the decoded sound for a file, loading it if needed.
+        """
+
+        sound = self._sounds.get(path)
+        if sound is None:
+            sound = pygame.mixer.Sound(path)
+            self._sounds[path] = sound
+            while len(self._sounds) > self._cache_size:
+                self._sounds.popitem(last=False)
+        else:
+            self._sounds.move_to_end(path)
+        return sound
+
+
+    def _channel(self):
+        """Return an idle reserved channel, or the least recently used one.
+        """
+
+        for i in range(len(self._channels)):
+            channel = self._channels[(self._next_channel + i) % len(self._channels)]
+            if not channel.get_busy():
+                break
+        else:
+            channel = self._channels[self._next_channel]
+        self._next_channel = (self._channels.index(channel) + 1) % len(self._channels)
+        return channel
 
 
     def play(self, category_name, use_pps=False):
@@ -107,9 +164,12 @@ class Soundcat(object):
 
             Args:
                 category_name: name of category.
+                use_pps: if True, do nothing if the last sound was played
+                         less than 1/pps seconds ago.
 
             Returns:
-                Nothing.
+                The mixer channel playing the sound, or None if nothing
+                was played.
 
             Raises:
                 No information.
@@ -119,16 +179,166 @@ class Soundcat(object):
         # Check if soudcat is speaking too much
         if not use_pps or time.time() - self._last_play_time > 1/self.pps:
 
-            # Get all WAV files of specified category
-            entries = os.listdir(self._categories[category_name]);
-            sounds = [];
-            for entry in entries:
-                if entry.endswith(".wav"):
-                    sounds.append(entry);
-
-            # Load one of the files randomly and play it
-            sound = pygame.mixer.Sound("/".join((self._categories[category_name], sounds[random.randrange(0, len(sounds))])));
-            sound.play()
+            # Play one of the sounds of the category randomly
+            sounds = self._categories[category_name]
+            sound = self._sound(sounds[random.randrange(0, len(sounds))])
+            channel = self._channel()
+            channel.play(sound)
 
             # Update last play time
             self._last_play_time = time.time()
+
+            return channel
+
+
+class TokenBucket(object):
+    """Token bucket rate limiter.
+
+        Tokens are added at a constant rate, up to a maximum burst. Each
+        allowed event takes one token.
+
+        Attributes:
+            rate: tokens added per second.
+            burst: maximum number of tokens.
+
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._last = time.monotonic()
+
+    def take(self):
+        """Take a token if one is available.
+
+            Returns:
+                True if the event is allowed.
+
+        """
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._last)*self.rate)
+        self._last = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return True
+        return False
+
+
+class Speaker(object):
+    """Play Soundcat categories from a background thread.
+
+        Requests are queued by play() and return immediately. A single
+        thread owns the mixer and plays them, highest priority first.
+        Each category can be rate limited by a token bucket, and a sound
+        preempts the sounds of lower priority still playing. Requests
+        arriving while a higher priority sound plays are dropped.
+
+        >>> speaker = soundcat.Speaker(rates={"detected": (0.2, 1)}, priorities={"quit": 1});
+        >>> speaker.add_category("detected", "resources/sounds/detected");
+        >>> speaker.start();
+        >>> speaker.play("detected");
+
+        Attributes:
+            enabled: if False, play() requests are ignored.
+
+    """
+
+    def __init__(self, rates=None, priorities=None, driver=None, **kwargs):
+        """Speaker constructor.
+
+            Args:
+                rates: a dict from category name to a (rate, burst) tuple
+                       for its token bucket. Categories not listed are not
+                       rate limited.
+                priorities: a dict from category name to its priority.
+                            Higher numbers win. Default priority is 0.
+                driver: SDL audio driver to use, e.g. "dummy" to run
+                        without audio hardware.
+                kwargs: passed to the Soundcat constructor.
+
+            Returns:
+                A Speaker object.
+
+            Raises:
+                No information.
+
+        """
+
+        if driver is not None:
+            os.environ['SDL_AUDIODRIVER'] = driver
+
+        self.enabled = True
+        self._soundcat = Soundcat(**kwargs)
+        self._buckets = {c: TokenBucket(rate, burst) for c, (rate, burst) in (rates or {}).items()}
+        self._priorities = priorities or {}
+        self._playing = []
+        self._queue = queue.PriorityQueue()
+        self._order = itertools.count()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+
+    def add_category(self, category_name, directory):
+        """Adds a category. Must be called before start().
+        """
+
+        self._soundcat.add_category(category_name, directory)
+
+
+    def start(self):
+        """Start the playback thread.
+        """
+
+        self._thread.start()
+
+
+    def play(self, category_name):
+        """Queue a random sound from the specified category.
+
+            Returns immediately. The request may be dropped by the rate
+            limiter or by a higher priority sound.
+
+        """
+
+        if self.enabled:
+            priority = self._priorities.get(category_name, 0)
+            self._queue.put((-priority, next(self._order), category_name))
+
+
+    def stop(self, timeout=3.0):
+        """Play pending requests, wait up to timeout seconds for sounds
+        to finish and quit the mixer.
+        """
+
+        self._queue.put((float('inf'), next(self._order), None))
+        self._thread.join(timeout)
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline and pygame.mixer.get_busy():
+            time.sleep(0.05)
+        self._soundcat.quit()
+
+
+    def _run(self):
+        """Play queued requests until stopped.
+        """
+
+        while True:
+            _, _, category_name = self._queue.get()
+            if category_name is None: break
+
+            priority = self._priorities.get(category_name, 0)
+            self._playing = [(p, c) for p, c in self._playing if c.get_busy()]
+
+            # Drop if a more important sound is playing
+            if any(p > priority for p, _ in self._playing): continue
+
+            # Drop if the category is speaking too much
+            bucket = self._buckets.get(category_name)
+            if bucket is not None and not bucket.take(): continue
+
+            # Preempt less important sounds
+            for p, channel in self._playing:
+                if p < priority: channel.stop()
+
+            channel = self._soundcat.play(category_name)
+            if channel is not None: self._playing.append((priority, channel))
@@ -0,0 +1,317 @@
+"""
+Frame sources: a V4L2 camera, a video file, a directory of images or
+synthetic frames, all behind the same interface.
+"""
+# coding: utf-8
+
+# Standard imports
+import os
+import re
+import time
+import datetime
+
+# External imports
+import cv2
+import numpy
+
+# Project imports
+from . import imload
+from . import archive
+
+# OpenCV camera settings
+CV_CAP_PROP_FRAME_WIDTH  = 3
+CV_CAP_PROP_FRAME_HEIGHT = 4
+CV_CAP_PROP_FPS = 5
+
+# Names given to frames by save.save(), e.g. 2019-03-05 14h02m59.123s.jpg
+FRAME_NAME = re.compile(r'(\d{4})-(\d{2})-(\d{2}) (\d{2})h(\d{2})m(\d{2})\.(\d{3})s')
+
+class Source(object):
+    """Base class for frame sources.
+
+        A source returns frames with read() until it is exhausted, then
+        read() returns None and finished is True. Sources reading
+        recorded footage can be paced in real time, reproducing the
+        original frame intervals, or as fast as possible.
+
+        Attributes:
+            pace: "realtime" or "fast".
+            finished: True once the source has no more frames.
+            frame_time: capture datetime of the last frame read, if
+                        known from the footage, else None.
+            live: True if frames come on their own clock, so a slow
+                  reader should skip frames rather than fall behind.
+
+    """
+
+    def __init__(self, pace="realtime"):
+        if pace not in ("realtime", "fast"):
+            raise ValueError("Unknown pace: %s" % (pace))
+        self.pace = pace
+        self.live = pace == "realtime"
+        self.finished = False
+        self.frame_time = None
+        self._start = None
+
+    def _wait(self, offset):
+        """Sleep until offset seconds after the first frame, in real time pace.
+        """
+        if self.pace != "realtime":
+            return
+        now = time.monotonic()
+        if self._start is None:
+            self._start = now - offset
+        delay = self._start + offset - now
+        if delay > 0:
+            time.sleep(delay)
+
+    def read(self):
+        """Return the next frame, or None if there is none.
+        """
+        raise NotImplementedError
+
+    def skip(self):
+        """Drop the next frame, without decoding it if the source can.
+        Return False if there is none.
+        """
+        return self.read() is not None
+
+    def release(self):
+        """Free the resources held by the source.
+        """
+        pass
+
+class CameraSource(Source):
+    """Frames from a V4L2 webcam.
+    """
+
+    def __init__(self, device=-1, width=640, height=480, controls=("gain_automatic=0", "exposure=1000"), retries=50, retry_delay=0.1):
+        """CameraSource constructor.
+
+            Args:
+                device: camera index, -1 for the first camera found.
+                width: frame width.
+                height: frame height.
+                controls: v4l2-ctl controls to set, see v4l2-ctl --list-ctrls.
+                retries: consecutive failed reads after which the camera
+                         is considered gone and the source finished.
+                retry_delay: seconds to wait after a failed read.
+
+            Returns:
+                A CameraSource object.
+
+            Raises:
+
+        """
+        Source.__init__(self, pace="fast")
+        self.live = True
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self._failures = 0
+        self.camera = cv2.VideoCapture(device)
+        self.camera.set(CV_CAP_PROP_FRAME_WIDTH, width)
+        self.camera.set(CV_CAP_PROP_FRAME_HEIGHT, height)
+        # Set camera settings
+        # sudo apt-get install v4l-utils
+        # v4l2-ctl --list-devices
+        # v4l2-ctl -d /dev/video0 --list-ctrls
+        # v4l2-ctl --get-ctrl=gain_automatic
+        # v4l2-ctl --get-ctrl=exposure
+        # Controls are set on the camera opened, or on the default one
+        target = '' if device < 0 else '-d /dev/video%d ' % (device)
+        for control in controls:
+            os.system('v4l2-ctl %s--set-ctrl=%s' % (target, control))
+
+    def _failed(self):
+        """Wait after a failed read, and finish after too many in a row.
+        """
+        self._failures += 1
+        if self._failures >= self.retries:
+            self.finished = True
+        else:
+            time.sleep(self.retry_delay)
+
+    def read(self):
+        ok, frame = self.camera.read()
+        if not ok or frame is None:
+            self._failed()
+            return None
+        self._failures = 0
+        return frame
+
+    def skip(self):
+        if not self.camera.grab():
+            self._failed()
+            return False
+        self._failures = 0
+        return True
+
+    def release(self):
+        self.camera.release()
+
+class VideoSource(Source):
+    """Frames from a video file.
+    """
+
+    def __init__(self, path, pace="realtime"):
+        Source.__init__(self, pace)
+        self.video = cv2.VideoCapture(path)
+        if not self.video.isOpened():
+            raise IOError("Could not open video %s" % (path))
+        self.fps = self.video.get(CV_CAP_PROP_FPS) or 30.0
+        self._index = 0
+
+    def read(self):
+        ok, frame = self.video.read()
+        if not ok:
+            self.finished = True
+            return None
+        self._wait(self._index/self.fps)
+        self._index += 1
+        return frame
+
+    def skip(self):
+        if not self.video.grab():
+            self.finished = True
+            return False
+        self._wait(self._index/self.fps)
+        self._index += 1
+        return True
+
+    def release(self):
+        self.video.release()
+
+class DirectorySource(Source):
+    """Frames from a directory of images, e.g. a day of detected/.
+
+        Images are read in name order, including frames packed in the
+        day archive. Frames named by save.save() carry their capture
+        time, which sets frame_time and the real time pace; other images
+        are paced at fps.
+
+    """
+
+    def __init__(self, path, pace="realtime", fps=30.0):
+        Source.__init__(self, pace)
+        self.path = path
+        self.fps = fps
+        self.names = archive.names(path)
+        self._index = 0
+        self._first_time = None
+
+    def _next(self):
+        """Advance to the next image and wait for its time.
+        Return its name, or None if there is none.
+        """
+        if self._index >= len(self.names):
+            self.finished = True
+            return None
+        name = self.names[self._index]
+        self._index += 1
+        match = FRAME_NAME.search(name)
+        if match:
+            Y, M, D, h, m, s, ms = [int(g) for g in match.groups()]
+            self.frame_time = datetime.datetime(Y, M, D, h, m, s, 1000*ms)
+            if self._first_time is None: self._first_time = self.frame_time
+            self._wait((self.frame_time - self._first_time).total_seconds())
+        else:
+            self.frame_time = None
+            self._wait((self._index - 1)/self.fps)
+        return name
+
+    def read(self):
+        while True:
+            name = self._next()
+            if name is None:
+                return None
+            frame = imload.imread(os.path.join(self.path, name))
+            if frame is not None:
+                return frame
+
+    def skip(self):
+        return self._next() is not None
+
+class SyntheticSource(Source):
+    """Reproducible synthetic frames: a static textured background with a
+    bright block moving across it and some sensor noise.
+    """
+
+    def __init__(self, frames=None, pace="realtime", fps=30.0, width=640, height=480, seed=0):
+        """SyntheticSource constructor.
+
+            Args:
+                frames: number of frames to generate, None for no limit.
+                pace: "realtime" or "fast".
+                fps: frame rate in real time pace.
+                width: frame width.
+                height: frame height.
+                seed: random seed.
+
+            Returns:
+                A SyntheticSource object.
+
+            Raises:
+
+        """
+        Source.__init__(self, pace)
+        self.frames = frames
+        self.fps = fps
+        self.width = width
+        self.height = height
+        self._random = numpy.random.RandomState(seed)
+        self._background = cv2.GaussianBlur(self._random.randint(0, 256, (height, width, 3)).astype(numpy.uint8), (31, 31), 0)
+        self._index = 0
+
+    def read(self):
+        if self.frames is not None and self._index >= self.frames:
+            self.finished = True
+            return None
+        self._wait(self._index/self.fps)
+        frame = self._background.copy()
+        x = (40*self._index) % (self.width - 120)
+        cv2.rectangle(frame, (x, self.height*5//16), (x + 120, self.height*5//6), (200, 180, 160), -1)
+        noise = self._random.randint(-4, 5, frame.shape)
+        self._index += 1
+        return numpy.clip(frame.astype(numpy.int16) + noise, 0, 255).astype(numpy.uint8)
+
+    def skip(self):
+        if self.frames is not None and self._index >= self.frames:
+            self.finished = True
+            return False
+        self._wait(self._index/self.fps)
+        self._index += 1
+        return True
+
+def open_source(spec=None, pace="realtime", width=640, height=480):
+    """Open a frame source from a textual description.
+
+        Args:
+            spec: one of
+                  None or "camera":  the first webcam found;
+                  "camera:N":        webcam number N;
+                  "synthetic[:N]":   N synthetic frames, endless if N is missing;
+                  a directory path:  the images it contains;
+                  a file path:       a video file.
+            pace: "realtime" or "fast", for recorded and synthetic sources.
+            width: frame width, for cameras and synthetic frames.
+            height: frame height, for cameras and synthetic frames.
+
+        Returns:
+            A Source object.
+
+        Raises:
+            IOError: if the source can not be opened.
+
+    """
+    if spec is None or spec == "camera":
+        return CameraSource(-1, width, height)
+    if spec.startswith("camera:"):
+        return CameraSource(int(spec.split(":", 1)[1]), width, height)
+    if spec == "synthetic" or spec.startswith("synthetic:"):
+        frames = int(spec.split(":", 1)[1]) if ":" in spec else None
+        return SyntheticSource(frames, pace, width=width, height=height)
+    if os.path.isdir(spec):
+        return DirectorySource(spec, pace)
+    if os.path.isfile(spec):
+        return VideoSource(spec, pace)
+    raise IOError("No such frame source: %s" % (spec))
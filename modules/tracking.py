@@ -0,0 +1,199 @@
+"""
+Follow detected objects between detector runs with sparse optical flow.
+"""
+# coding: utf-8
+
+# External imports
+import cv2
+import numpy
+
+class Track(object):
+    """An object followed across frames.
+
+        Attributes:
+            box: a numpy array with top-left and bottom-right, x and y.
+            label: the name given by the recognizer, or None.
+            descriptor: the descriptor the recognizer computed, e.g. a
+                        face encoding, or None.
+            points: feature points followed by optical flow, Nx1x2.
+            age: frames since the detector last confirmed the track.
+
+    """
+
+    def __init__(self, box, label=None):
+        self.box = numpy.array(box, dtype=numpy.float32)
+        self.label = label
+        self.descriptor = None
+        self.points = None
+        self.age = 0
+
+    @property
+    def coords(self):
+        """Integer box coordinates, for drawing and cropping.
+        """
+        return [int(round(c)) for c in self.box]
+
+def iou(a, b):
+    """Intersection over union of two boxes.
+    """
+    w = min(a[2], b[2]) - max(a[0], b[0])
+    h = min(a[3], b[3]) - max(a[1], b[1])
+    if w <= 0 or h <= 0:
+        return 0.0
+    inter = w*h
+    return inter/((a[2] - a[0])*(a[3] - a[1]) + (b[2] - b[0])*(b[3] - b[1]) - inter)
+
+class Tracker(object):
+    """Run a detector every few frames and follow its boxes in between.
+
+        Between detector runs, feature points inside each box are
+        followed with pyramidal Lucas-Kanade optical flow and the box is
+        moved by their median displacement. The detector runs again when
+        the interval has elapsed, when a track loses its points and on
+        every frame while nothing is tracked, so new arrivals are not
+        missed. Detections overlapping an existing track keep its label,
+        so the recognizer runs once per object visit.
+
+        Attributes:
+            detector: function returning boxes found in a frame.
+            recognizer: function returning a label for a box in a frame,
+                        or None to leave tracks unlabeled.
+            interval: frames between detector runs while tracking.
+            tracks: the current Track objects.
+            detected: True if the detector ran on the last frame.
+            created: the Track objects created on the last frame.
+
+    """
+
+    def __init__(self, detector, recognizer=None, interval=5, min_points=6, min_iou=0.3):
+        """Tracker constructor.
+
+            Args:
+                detector: function(frame) returning a list of boxes,
+                          as top-left and bottom-right, x and y.
+                recognizer: function(frame, box) returning a label, or a
+                            label and a descriptor.
+                interval: frames between detector runs while tracking.
+                min_points: a track with fewer followed points is lost.
+                min_iou: overlap for a detection to continue a track.
+
+            Returns:
+                A Tracker object.
+
+            Raises:
+
+        """
+        self.detector = detector
+        self.recognizer = recognizer
+        self.interval = interval
+        self.min_points = min_points
+        self.min_iou = min_iou
+        self.tracks = list()
+        self.detected = False
+        self.created = list()
+        self._gray = None
+        self._since = 0
+
+    def __call__(self, frame):
+        """Update tracks with a new frame.
+
+            Args:
+                frame: a cv2 BGR image.
+
+            Returns:
+                The list of current Track objects.
+
+            Raises:
+
+        """
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        lost = False
+        if self.tracks and self._gray is not None and self._gray.shape == gray.shape:
+            lost = not self._follow(gray)
+        self._since += 1
+        self.created = list()
+        self.detected = lost or not self.tracks or self._since >= self.interval
+        if self.detected:
+            self._detect(frame)
+            self._since = 0
+        for track in self.tracks:
+            if track.points is None or len(track.points) < 2*self.min_points:
+                track.points = self._features(gray, track.box)
+        self._gray = gray
+        return self.tracks
+
+    def reset(self):
+        """Forget all tracks, e.g. when the scene changes.
+        """
+        self.tracks = list()
+        self.created = list()
+        self._gray = None
+        self._since = 0
+
+    def _follow(self, gray):
+        """Move tracks along the optical flow from the previous frame.
+        Return False if a track was lost.
+        """
+        tracks = [t for t in self.tracks if t.points is not None and len(t.points) > 0]
+        if len(tracks) < len(self.tracks):
+            return False
+        points = numpy.concatenate([t.points for t in tracks])
+        moved, status, _ = cv2.calcOpticalFlowPyrLK(self._gray, gray, points, None, winSize=(15, 15), maxLevel=2)
+        status = status.ravel().astype(bool)
+        (h, w) = gray.shape
+        ok = True
+        start = 0
+        for track in tracks:
+            end = start + len(track.points)
+            good = status[start:end]
+            track.age += 1
+            if good.sum() < self.min_points:
+                track.points = None
+                ok = False
+            else:
+                shift = numpy.median(moved[start:end][good] - track.points[good], axis=0).ravel()
+                track.box += numpy.array([shift[0], shift[1], shift[0], shift[1]], dtype=numpy.float32)
+                track.points = moved[start:end][good].reshape(-1, 1, 2)
+                # Lost if mostly out of frame
+                if iou(track.box, (0, 0, w, h))*(w*h) < 0.5*(track.box[2] - track.box[0])*(track.box[3] - track.box[1]):
+                    track.points = None
+                    ok = False
+            start = end
+        self.tracks = [t for t in self.tracks if t.points is not None]
+        return ok
+
+    def _detect(self, frame):
+        """Run the detector and match its boxes to current tracks.
+        """
+        tracks = list()
+        for box in self.detector(frame):
+            match = max(self.tracks, key=lambda t: iou(t.box, box), default=None)
+            if match is not None and match not in tracks and iou(match.box, box) >= self.min_iou:
+                match.box = numpy.array(box, dtype=numpy.float32)
+                match.points = None
+                match.age = 0
+                tracks.append(match)
+            else:
+                track = Track(box)
+                if self.recognizer is not None:
+                    track.label = self.recognizer(frame, track.coords)
+                    if isinstance(track.label, tuple):
+                        track.label, track.descriptor = track.label
+                tracks.append(track)
+                self.created.append(track)
+        self.tracks = tracks
+
+    @staticmethod
+    def _features(gray, box):
+        """Corners inside a box, in frame coordinates.
+        """
+        (h, w) = gray.shape
+        x1, y1 = max(int(box[0]), 0), max(int(box[1]), 0)
+        x2, y2 = min(int(box[2]), w), min(int(box[3]), h)
+        if x2 - x1 < 8 or y2 - y1 < 8:
+            return None
+        corners = cv2.goodFeaturesToTrack(gray[y1:y2, x1:x2], maxCorners=40, qualityLevel=0.01, minDistance=4)
+        if corners is None:
+            return None
+        corners += numpy.array([x1, y1], dtype=numpy.float32)
+        return corners.astype(numpy.float32)
@@ -0,0 +1,394 @@
+"""
+Group the unknown faces seen into visitors, and enroll them as known
+faces from their stored encodings.
+
+Faces recognized as "Unknown" are read from the encodings stored in each
+day folder, see modules/facestore.py, as they are appended: a run only
+reads the faces stored since the previous one. Each face joins the
+visitor whose mean encoding is nearest, if within the recognition
+tolerance, else it starts a new visitor (leader clustering), and visitors
+that drift together are merged. A visitor seen often enough, over
+several visits, is proposed with a strip of face crops written to
+visitors/ under the root. Labelling it appends its most typical
+encodings to the known faces in faces/enrolled, which the turret and the
+bot recognize like the images in faces/, so no image is encoded again.
+
+Run the job every ten minutes, then label a proposal with:
+
+    python3 -m modules.visitors detected/ --every 600
+    python3 -m modules.visitors detected/ --label 7 Carol
+"""
+# coding: utf-8
+
+# Standard imports
+import os
+import time
+import argparse
+import datetime
+
+# External imports
+import cv2
+import numpy
+
+# Project imports
+from . import archive
+from . import imload
+from . import facestore
+
+DIRECTORY = 'visitors'
+STATE = 'clusters.npz'
+
+class Visitor(object):
+    """Unknown faces believed to be the same person.
+
+        Attributes:
+            id: a number identifying the visitor across runs.
+            sum: the sum of the encodings of its faces.
+            count: the number of faces.
+            visits: the number of visits, faces more than the visit gap
+                    apart starting a new one.
+            first: capture time of the first face, in ms since the epoch.
+            last: capture time of the last face, in ms since the epoch.
+            exemplars: a list of the (time, box, encoding) of its faces
+                       nearest to the mean, at most Visitors.exemplars.
+            ignored: True if it should not be proposed again.
+
+    """
+
+    def __init__(self, id, encoding, ms, box):
+        self.id = id
+        self.sum = numpy.array(encoding, dtype=numpy.float64)
+        self.count = 1
+        self.visits = 1
+        self.first = ms
+        self.last = ms
+        self.exemplars = [(ms, box, numpy.array(encoding, dtype=numpy.float32))]
+        self.ignored = False
+
+    @property
+    def centroid(self):
+        return (self.sum/self.count).astype(numpy.float32)
+
+class Visitors(object):
+    """Online clustering of unknown faces, kept under a root between runs.
+
+        The state holds the visitors and how many faces of each day were
+        read, and is replaced at once when saved, so a run interrupted
+        before saving is simply done again.
+
+        Attributes:
+            root: the folder holding the day hierarchy, e.g. detected.
+            visitors: the Visitor objects.
+            read: day folder -> number of faces already read.
+
+    """
+
+    def __init__(self, root="detected", radius=facestore.TOLERANCE, merge=0.35, gap=300.0, exemplars=8):
+        """Visitors constructor, loading the state of previous runs.
+
+            Args:
+                root: the folder holding the day hierarchy.
+                radius: the largest distance of a face to the mean of
+                        the visitor it joins.
+                merge: visitors with means closer than this are merged.
+                gap: seconds without a face of a visitor that end a visit.
+                exemplars: faces kept per visitor, for crops and
+                           enrollment.
+
+            Returns:
+                A Visitors object.
+
+            Raises:
+                OSError: if the state can not be read.
+
+        """
+        self.root = root
+        self.radius = radius
+        self.merge = merge
+        self.gap = gap
+        self.exemplars = exemplars
+        self.visitors = list()
+        self.read = dict()
+        self._next = 1
+        self._centroids = numpy.zeros((0, facestore.DIMENSION), dtype=numpy.float32)
+        self.load()
+
+    @property
+    def path(self):
+        return os.path.join(self.root, DIRECTORY)
+
+    def load(self):
+        """Load the state saved by a previous run, if any.
+        """
+        path = os.path.join(self.path, STATE)
+        if not os.path.exists(path):
+            return
+        with numpy.load(path) as state:
+            self.read = dict(zip(state['days'].tolist(), state['read'].tolist()))
+            self._next = int(state['next'])
+            start = 0
+            for i in range(len(state['ids'])):
+                visitor = Visitor(int(state['ids'][i]), state['sums'][i], int(state['first'][i]), None)
+                visitor.sum = state['sums'][i].astype(numpy.float64)
+                visitor.count, visitor.visits = int(state['counts'][i]), int(state['visits'][i])
+                visitor.last, visitor.ignored = int(state['last'][i]), bool(state['ignored'][i])
+                end = start + int(state['exemplar_counts'][i])
+                visitor.exemplars = [(int(t), tuple(int(c) for c in b), v) for t, b, v in
+                                     zip(state['exemplar_times'][start:end], state['exemplar_boxes'][start:end], state['exemplar_vectors'][start:end])]
+                start = end
+                self.visitors.append(visitor)
+        self._centroids = numpy.array([v.centroid for v in self.visitors], dtype=numpy.float32).reshape(-1, facestore.DIMENSION)
+
+    def save(self):
+        """Replace the saved state with the current one.
+
+            Raises:
+                OSError: if the state can not be written.
+
+        """
+        if not os.path.exists(self.path):
+            os.makedirs(self.path, exist_ok=True)
+        exemplars = [e for v in self.visitors for e in v.exemplars]
+        state = {   'days': numpy.array(sorted(self.read), dtype=str),
+                    'read': numpy.array([self.read[d] for d in sorted(self.read)], dtype=numpy.int64),
+                    'next': self._next,
+                    'ids': numpy.array([v.id for v in self.visitors], dtype=numpy.int64),
+                    'sums': numpy.array([v.sum for v in self.visitors], dtype=numpy.float64).reshape(-1, facestore.DIMENSION),
+                    'counts': numpy.array([v.count for v in self.visitors], dtype=numpy.int64),
+                    'visits': numpy.array([v.visits for v in self.visitors], dtype=numpy.int64),
+                    'first': numpy.array([v.first for v in self.visitors], dtype=numpy.int64),
+                    'last': numpy.array([v.last for v in self.visitors], dtype=numpy.int64),
+                    'ignored': numpy.array([v.ignored for v in self.visitors], dtype=bool),
+                    'exemplar_counts': numpy.array([len(v.exemplars) for v in self.visitors], dtype=numpy.int64),
+                    'exemplar_times': numpy.array([t for t, _, _ in exemplars], dtype=numpy.int64),
+                    'exemplar_boxes': numpy.array([b for _, b, _ in exemplars], dtype=numpy.int64).reshape(-1, 4),
+                    'exemplar_vectors': numpy.array([e for _, _, e in exemplars], dtype=numpy.float32).reshape(-1, facestore.DIMENSION) }
+        with open(os.path.join(self.path, STATE + '.tmp'), 'wb') as state_file:
+            numpy.savez(state_file, **state)
+        os.replace(os.path.join(self.path, STATE + '.tmp'), os.path.join(self.path, STATE))
+
+    def add(self, encoding, ms, box):
+        """Add an unknown face to the nearest visitor, or to a new one.
+
+            Args:
+                encoding: the face encoding.
+                ms: its capture time, in ms since the epoch.
+                box: its box, as top-left and bottom-right, x and y.
+
+            Returns:
+                The Visitor the face joined.
+
+            Raises:
+
+        """
+        encoding = numpy.asarray(encoding, dtype=numpy.float32)
+        if len(self.visitors) > 0:
+            distances = numpy.linalg.norm(self._centroids - encoding, axis=1)
+            i = int(numpy.argmin(distances))
+            if distances[i] <= self.radius:
+                visitor = self.visitors[i]
+                visitor.sum += encoding
+                visitor.count += 1
+                if ms - visitor.last > 1000*self.gap: visitor.visits += 1
+                visitor.first, visitor.last = min(visitor.first, ms), max(visitor.last, ms)
+                self._centroids[i] = visitor.centroid
+                self._keep(visitor, (ms, box, encoding))
+                return visitor
+        visitor = Visitor(self._next, encoding, ms, box)
+        self._next += 1
+        self.visitors.append(visitor)
+        self._centroids = numpy.vstack((self._centroids, visitor.centroid[None, :]))
+        return visitor
+
+    def _keep(self, visitor, exemplar):
+        """Keep the faces of a visitor nearest to its mean.
+        """
+        if len(visitor.exemplars) < self.exemplars:
+            visitor.exemplars.append(exemplar)
+            return
+        centroid = visitor.centroid
+        distances = [numpy.linalg.norm(e - centroid) for _, _, e in visitor.exemplars]
+        farthest = int(numpy.argmax(distances))
+        if numpy.linalg.norm(exemplar[2] - centroid) < distances[farthest]:
+            visitor.exemplars[farthest] = exemplar
+
+    def _merge(self):
+        """Merge visitors whose means are closer than the merge distance.
+        """
+        while len(self.visitors) > 1:
+            distances = numpy.linalg.norm(self._centroids[:, None, :] - self._centroids[None, :, :], axis=2)
+            distances[numpy.diag_indices(len(distances))] = numpy.inf
+            i, j = numpy.unravel_index(numpy.argmin(distances), distances.shape)
+            if distances[i, j] > self.merge:
+                break
+            # The larger visitor absorbs the smaller one
+            if self.visitors[i].count < self.visitors[j].count: i, j = j, i
+            kept, merged = self.visitors[i], self.visitors[j]
+            kept.sum += merged.sum
+            kept.count += merged.count
+            kept.visits += merged.visits
+            kept.first, kept.last = min(kept.first, merged.first), max(kept.last, merged.last)
+            kept.ignored = kept.ignored and merged.ignored
+            centroid = kept.centroid
+            kept.exemplars = sorted(kept.exemplars + merged.exemplars, key=lambda e: numpy.linalg.norm(e[2] - centroid))[:self.exemplars]
+            self._centroids[i] = centroid
+            del self.visitors[j]
+            self._centroids = numpy.delete(self._centroids, j, axis=0)
+
+    def days(self):
+        """Day folders under the root with stored faces, oldest first.
+        """
+        days = list()
+        for (dirpath, dirnames, filenames) in os.walk(self.root):
+            dirnames[:] = [d for d in dirnames if d not in ('clips', DIRECTORY)]
+            if facestore.RECORDS not in filenames: continue
+            faces = facestore.reader(dirpath)
+            if faces is not None and len(faces) > 0:
+                days.append((int(faces.records['time'][0]), os.path.normpath(dirpath)))
+        return [path for _, path in sorted(days)]
+
+    def update(self):
+        """Read the unknown faces stored since the last update.
+
+            Returns:
+                The number of unknown faces read.
+
+            Raises:
+
+        """
+        added = 0
+        for path in self.days():
+            faces = facestore.reader(path)
+            faces.refresh()
+            start, end = self.read.get(path, 0), len(faces)
+            if start >= end: continue
+            records = faces.records[start:end]
+            for i in numpy.flatnonzero(records['name'] == b'Unknown').tolist():
+                record = records[i]
+                self.add(faces.vectors[start + i], int(record['time']), (int(record['x1']), int(record['y1']), int(record['x2']), int(record['y2'])))
+                added += 1
+            self.read[path] = end
+        self._merge()
+        return added
+
+    def proposals(self, min_faces=10, min_visits=2):
+        """Visitors worth a name, most seen first.
+        """
+        found = [v for v in self.visitors if not v.ignored and v.count >= min_faces and v.visits >= min_visits]
+        return sorted(found, key=lambda v: -v.count)
+
+    def find(self, id):
+        """The visitor of an id.
+
+            Raises:
+                KeyError: if there is no such visitor.
+
+        """
+        for visitor in self.visitors:
+            if visitor.id == id:
+                return visitor
+        raise KeyError("No visitor %d" % (id))
+
+    def crops(self, visitor, size=96, margin=0.25):
+        """Write a strip of the faces of a visitor.
+
+            Args:
+                visitor: the Visitor.
+                size: the side of each face crop, in pixels.
+                margin: the margin around each face, as a fraction of it.
+
+            Returns:
+                The path of the strip, or None if none of its frames
+                could be read, e.g. when saving clips.
+
+            Raises:
+
+        """
+        tiles = list()
+        for ms, (x1, y1, x2, y2), _ in sorted(visitor.exemplars, key=lambda e: e[0]):
+            img_time = archive.from_ms(ms)
+            frame = imload.imread("/".join((facestore.daypath(self.root, img_time), archive.frame_name(img_time))))
+            if frame is None: continue
+            (h, w) = frame.shape[:2]
+            mx, my = int(margin*(x2 - x1)), int(margin*(y2 - y1))
+            crop = frame[max(y1 - my, 0):min(y2 + my, h), max(x1 - mx, 0):min(x2 + mx, w)]
+            if crop.size == 0: continue
+            tiles.append(cv2.resize(crop, (size, size), interpolation=cv2.INTER_AREA))
+        if not tiles:
+            return None
+        path = os.path.join(self.path, 'visitor-%04d.jpg' % (visitor.id))
+        cv2.imwrite(path, numpy.hstack(tiles))
+        return path
+
+    def enroll(self, id, name, path=facestore.ENROLLED):
+        """Enroll a visitor as a known face, from its stored encodings.
+
+            Its most typical encodings are appended to the enrolled faces,
+            and it is forgotten: its next faces are recognized.
+
+            Args:
+                id: the visitor id.
+                name: the name it is known by.
+                path: the folder holding the enrolled faces.
+
+            Returns:
+                The number of encodings enrolled.
+
+            Raises:
+                KeyError: if there is no such visitor.
+                ValueError: if the name is not a valid name.
+                OSError: if the enrolled faces can not be written.
+
+        """
+        if not name or name == 'Unknown' or '.' in name or '/' in name or len(name.encode('utf-8')) > facestore.FACE['name'].itemsize:
+            raise ValueError("Invalid name %r, names are at most %d bytes, without dots or slashes" % (name, facestore.FACE['name'].itemsize))
+        visitor = self.find(id)
+        writer = facestore.Writer(path)
+        try:
+            for ms, box, encoding in visitor.exemplars:
+                writer.append(archive.from_ms(ms), [box], [encoding], [name])
+        finally:
+            writer.close()
+        i = self.visitors.index(visitor)
+        del self.visitors[i]
+        self._centroids = numpy.delete(self._centroids, i, axis=0)
+        try: os.remove(os.path.join(self.path, 'visitor-%04d.jpg' % (visitor.id)))
+        except OSError: pass
+        return len(visitor.exemplars)
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Group unknown faces into visitors and enroll them as known faces.")
+    parser.add_argument("root", help="A detected/ folder")
+    parser.add_argument("--every", help="Keep running, reading new faces every this many seconds", type=float)
+    parser.add_argument("--faces", help="Faces a visitor needs to be proposed (default 10)", type=int, default=10)
+    parser.add_argument("--visits", help="Visits a visitor needs to be proposed (default 2)", type=int, default=2)
+    parser.add_argument("--label", help="Enroll a visitor under a name", nargs=2, metavar=("ID", "NAME"))
+    parser.add_argument("--ignore", help="Do not propose a visitor again", type=int, metavar="ID")
+    args = parser.parse_args()
+
+    visitors = Visitors(args.root)
+    if args.label is not None or args.ignore is not None:
+        try:
+            if args.label is not None:
+                count = visitors.enroll(int(args.label[0]), args.label[1])
+                print("Visitor %s enrolled as %s with %d encodings" % (args.label[0], args.label[1], count))
+            else:
+                visitors.find(args.ignore).ignored = True
+        except (KeyError, ValueError) as error:
+            parser.exit(1, "%s\n" % (error.args[0]))
+        visitors.save()
+        parser.exit()
+
+    while True:
+        started = time.monotonic()
+        added = visitors.update()
+        visitors.save()
+        proposals = visitors.proposals(args.faces, args.visits)
+        print("%s: %d unknown faces read, %d visitors, %d proposed (%.1f s)" % (str(datetime.datetime.now())[:19], added, len(visitors.visitors), len(proposals), time.monotonic() - started))
+        for visitor in proposals:
+            crops = visitors.crops(visitor)
+            print('%6d  %5d faces  %3d visits  %s - %s  %s' % (visitor.id, visitor.count, visitor.visits,
+                  str(archive.from_ms(visitor.first))[:16], str(archive.from_ms(visitor.last))[:16], crops or 'no frames'))
+        if args.every is None: break
+        time.sleep(args.every)
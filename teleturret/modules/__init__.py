@@ -0,0 +1,11 @@
+""" Teleturret modules
+
+Modules shared with the turret, such as archive.py, metadata.py or
+facestore.py, are not copied here: they are imported from the turret's
+modules/ folder, searched after this one.
+"""
+
+# Standard imports
+import os
+
+__path__.append(os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), 'modules'))
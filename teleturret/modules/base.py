@@ -5,23 +5,29 @@
 import os
 import sys
 import datetime
+import threading
+import collections
+import concurrent.futures
 
 # External imports
 import cv2
-import dlib
-import scipy
 import numpy
-import skimage.exposure
-import sklearn.cluster
-import matplotlib
-import matplotlib.pyplot as plt
 
 # Project imports
 import botkit.nlu
 import botkit.answer
 
-# Load Cascade Classifiers for upperbody
-CASCADE_UPPERBODY = cv2.CascadeClassifier("../resources/cascades/haarcascade_upperbody.xml")
+# Teleturret imports
+from . import archive
+from . import imload
+from . import metadata
+from . import store
+
+# Cascade Classifier for upperbody, loaded once per thread by FrameScanner
+CASCADE_UPPERBODY_PATH = "../resources/cascades/haarcascade_upperbody.xml"
+
+# Turret detection modes whose recorded boxes are faces, see modules/metadata.py
+FACE_MODES = ("upperbody-face", "face-recognition")
 
 def log(m):
     print(m)
@@ -78,32 +84,128 @@ def box(coords, img, color=(0,255,0)):
         cv2.rectangle(img, (x1, y1), (x2, y2), color, 2)
     return img
 
-def single_cascade(frame, cascade=CASCADE_UPPERBODY, return_objects=False, drawboxes=True, min_rectangle=(60,60)):
+def im2float(im):
     """
-    Use a single cascade to perform object detection
+    Convert OpenCV image type to numpy.float
     """
+    info = numpy.iinfo(im.dtype)
+    return im.astype(numpy.float) / info.max
 
-    # Detect cascade pattern in frame
-    (rects, frame) = detect_pattern(frame, cascade, min_rectangle)
-
-    # Draw a rectangle around detected patterns if required
-    if drawboxes: frame = box(rects, frame)
+def scratch(name):
+    """
+    Return a hidden file name for answer images, private to the calling thread
+    Requests are answered concurrently, each worker writes its own files
+    """
+    return '.%s-%s' % (threading.current_thread().name, name)
 
-    # Set found to True if pattern was detected
-    found = False
-    if len(rects) > 0:
-        found = True
+# Matplotlib figures are not thread safe
+plot_lock = threading.Lock()
 
-    # Return detected pattern coordinates if required + frame and found state
-    if return_objects: return frame, found, rects
-    else: return frame, found
+def today_detections():
+    """
+    Return the path to todays' detections and the names of all frames
+    detected today, from recent to older
+    """
+    now = datetime.datetime.now()
+    todaypath = '/'.join(('..', 'detected', str(now.year), str(now.month) + '. ' + now.strftime('%B'), str(now.day)))
+    detections = archive.names(todaypath)
+    detections.reverse()
+    return todaypath, detections
 
-def im2float(im):
+class FrameScanner:
     """
-    Convert OpenCV image type to numpy.float
+    Search saved frames for people using warm detectors
+
+    Frames are decoded and scored by a thread pool, ahead of the consumer.
+    Upperbody scans decode frames at reduction, a fraction of their
+    resolution. Face scans decode them at face_reduction, full resolution
+    by default: dlib finds faces of 80 pixels and more, so halving the
+    frames would miss the faces under 160 pixels. Faces the turret
+    recorded in the metadata of a frame are used without decoding it.
+    Results are cached per frame path, so repeated queries only score the
+    frames that were not seen before.
     """
-    info = numpy.iinfo(im.dtype)
-    return im.astype(numpy.float) / info.max
+    def __init__(self, workers=4, reduction=2, face_reduction=1, prefetch=8, cache_size=50000):
+        """
+        Start the worker pool
+        """
+        self.reduction = reduction
+        self.face_reduction = face_reduction
+        self.prefetch = prefetch
+        self.cache_size = cache_size
+        self.cache = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+
+    def detector(self, kind):
+        """
+        Return the detector for kind owned by the calling thread,
+        creating it on first use
+        """
+        detectors = getattr(self.local, 'detectors', None)
+        if detectors is None:
+            detectors = self.local.detectors = dict()
+        if kind not in detectors:
+            if kind == 'face':
+                import dlib
+                detectors[kind] = dlib.get_frontal_face_detector()
+            elif kind == 'upperbody': detectors[kind] = cv2.CascadeClassifier(CASCADE_UPPERBODY_PATH)
+            else: raise ValueError('Unknown detector: %s' % (kind))
+        return detectors[kind]
+
+    def score(self, framepath, kind):
+        """
+        Detect kind in a frame
+        Return detected rectangles in full resolution coordinates
+        """
+        key = (kind, framepath)
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return self.cache[key]
+        if kind == 'face':
+            recorded = metadata.lookup(framepath)
+            if recorded is not None and recorded[0] in FACE_MODES:
+                return [box for box, _, _ in recorded[1]]
+        reduction = self.face_reduction if kind == 'face' else self.reduction
+        frame = imload.imread(framepath, reduction=reduction)
+        # Frames still being written can not be decoded, do not cache them
+        if frame is None: return []
+        if kind == 'face':
+            rects = [(f.left(), f.top(), f.right(), f.bottom()) for f in self.detector(kind)(frame)]
+        else:
+            min_rectangle = (60//reduction, 60//reduction)
+            rects, _ = detect_pattern(frame, self.detector(kind), min_rectangle)
+        rects = [tuple(reduction*int(v) for v in r) for r in rects]
+        with self.lock:
+            self.cache[key] = rects
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return rects
+
+    def scan(self, framepaths, kind, stop=None):
+        """
+        Yield (framepath, rects) for each frame path, in order
+        Next frames are decoded and scored while the consumer works
+        Stop early if the stop event is set
+        """
+        framepaths = iter(framepaths)
+        pending = collections.deque()
+        try:
+            for framepath in framepaths:
+                pending.append((framepath, self.pool.submit(self.score, framepath, kind)))
+                if len(pending) >= self.prefetch: break
+            while pending:
+                if stop is not None and stop.is_set(): break
+                framepath, future = pending.popleft()
+                for nextpath in framepaths:
+                    pending.append((nextpath, self.pool.submit(self.score, nextpath, kind)))
+                    break
+                yield framepath, future.result()
+        finally:
+            for _, future in pending:
+                future.cancel()
 
 class Base:
     """
@@ -113,6 +215,7 @@ class Base:
         """
         Initialize answer processor and set callbacks for intents
         """
+        self.scanner = FrameScanner()
         self.answer_processor = botkit.answer.AnswerProcessor('base')
         self.answer_processor.set_callback('none', self.none)
         self.answer_processor.set_callback('greetings', self.greetings)
@@ -147,21 +250,16 @@ class Base:
         now = datetime.datetime.now()
         todaypath = '/'.join(('..', 'detected', str(now.year), str(now.month) + '. ' + now.strftime('%B'), str(now.day)))
         # Get paths for all frames detected today
-        detections = list()
-        for (_, _, filenames) in os.walk(todaypath):
-            detections.extend(filenames)
-            break
-        detections.sort(reverse=True)
-        detections = [d for d in detections if not d.endswith('.log')]
+        detections = archive.names(todaypath)
+        detections.reverse()
         # If no detection was made today, infer that nobody went to the lab
         if len(detections) == 0:
             answer.append({'type': 'text', 'text': 'Nobody was here today.'})
         else:
             # If there was a detection today, get the last frame
             lastframepath = os.path.join(todaypath, detections[0])
-            lastframe = cv2.imread(lastframepath)
             # Check the state of lights
-            light = numpy.mean(im2float(lastframe).flatten())
+            light = imload.brightness(lastframepath) or 0.0
             # Infer if there is someone in the lab
             if light > 0.3: answer.append({'type': 'text', 'text': 'Someone is here!'})
             else: answer.append({'type': 'text', 'text': 'Nobody here.'})
@@ -175,45 +273,30 @@ class Base:
         Infer if there is someone in the room
         If positive, get the last frame in which a face is detected and return
         """
-        # Get path to todays' detections
-        now = datetime.datetime.now()
-        todaypath = '/'.join(('..', 'detected', str(now.year), str(now.month) + '. ' + now.strftime('%B'), str(now.day)))
         # Get paths for all frames detected today
-        detections = list()
-        for (_, _, filenames) in os.walk(todaypath):
-            detections.extend(filenames)
-            break
-        detections.sort(reverse=True)
-        detections = [d for d in detections if not d.endswith('.log')]
+        todaypath, detections = today_detections()
         # If no detection was made today, infer that nobody went to the lab
         if len(detections) == 0:
             answer.append({'type': 'text', 'text': 'Nobody was here today.'})
         else:
-            # Load dlib face detector
-            detector = dlib.get_frontal_face_detector()
             # If there was a detection today, get the last frame
             lastframepath = os.path.join(todaypath, detections[0])
-            lastframe = cv2.imread(lastframepath)
             # Check the state of lights
-            light = numpy.mean(im2float(lastframe).flatten())
+            light = imload.brightness(lastframepath) or 0.0
             # Infer if there is someone in the lab
             if light > 0.3:
                 answer.append({'type': 'text', 'text': 'Someone is here!'})
                 # Check frames from recent to older and try to find a person, skipping 10 by 10
-                for i in range(0, len(detections), 10):
-                    detection = detections[i]
-                    # Get frame
-                    framepath = os.path.join(todaypath, detection)
-                    frame = cv2.imread(framepath)
-                    # Try face detection
-                    faces = detector(frame)
+                framepaths = [os.path.join(todaypath, d) for d in detections[::10]]
+                for framepath, faces in self.scanner.scan(framepaths, 'face', stop=message.get('cancel')):
                     # If a face was detected, draw a rectangle over it and save, then answer!
                     if len(faces) > 0:
-                        for f in faces:
-                            cv2.rectangle(frame, (f.left(), f.top()), (f.right(), f.bottom()), (0,0,255), 2)
-                        cv2.imwrite('.found.jpg', frame)
+                        frame = imload.imread(framepath)
+                        for left, top, right, bottom in faces:
+                            cv2.rectangle(frame, (left, top), (right, bottom), (0,0,255), 2)
+                        cv2.imwrite(scratch('found.jpg'), frame)
                         answer.append({'type': 'text', 'text': 'Target acquired.'})
-                        answer.append({'type': 'image', 'url': '.found.jpg'})
+                        answer.append({'type': 'image', 'url': scratch('found.jpg')})
                         break
             else:
                 answer.append({'type': 'text', 'text': 'Nobody here.'})
@@ -226,41 +309,28 @@ class Base:
         Infer if there is someone in the room
         If positive, get the last frame in which a face is detected and return
         """
-        # Get path to todays' detections
-        now = datetime.datetime.now()
-        todaypath = '/'.join(('..', 'detected', str(now.year), str(now.month) + '. ' + now.strftime('%B'), str(now.day)))
         # Get paths for all frames detected today
-        detections = list()
-        for (_, _, filenames) in os.walk(todaypath):
-            detections.extend(filenames)
-            break
-        detections.sort(reverse=True)
-        detections = [d for d in detections if not d.endswith('.log')]
+        todaypath, detections = today_detections()
         # If no detection was made today, infer that nobody went to the lab
         if len(detections) == 0:
             answer.append({'type': 'text', 'text': 'Nobody was here today.'})
         else:
             # If there was a detection today, get the last frame
             lastframepath = os.path.join(todaypath, detections[0])
-            lastframe = cv2.imread(lastframepath)
             # Check the state of lights
-            light = numpy.mean(im2float(lastframe).flatten())
+            light = imload.brightness(lastframepath) or 0.0
             # Infer if there is someone in the lab
             if light > 0.3:
                 answer.append({'type': 'text', 'text': 'Someone is here!'})
                 # Check frames from recent to older and try to find a person, skipping 10 by 10
-                for i in range(0, len(detections), 10):
-                    detection = detections[i]
-                    # Get frame
-                    framepath = os.path.join(todaypath, detection)
-                    frame = cv2.imread(framepath)
-                    # Try upperbody detection
+                framepaths = [os.path.join(todaypath, d) for d in detections[::10]]
+                for framepath, rects in self.scanner.scan(framepaths, 'upperbody', stop=message.get('cancel')):
                     # If upperbody was detected, draw a rectangle over it and save, then answer!
-                    frame, found = single_cascade(frame, drawboxes=True)
-                    if found:
-                        cv2.imwrite('.found.jpg', frame)
+                    if len(rects) > 0:
+                        frame = box(rects, imload.imread(framepath))
+                        cv2.imwrite(scratch('found.jpg'), frame)
                         answer.append({'type': 'text', 'text': 'Target acquired.'})
-                        answer.append({'type': 'image', 'url': '.found.jpg'})
+                        answer.append({'type': 'image', 'url': scratch('found.jpg')})
                         break
             else:
                 answer.append({'type': 'text', 'text': 'Nobody here.'})
@@ -273,39 +343,28 @@ class Base:
         Infer if there is someone in the room
         If positive, get the last frame in which a face is detected and return
         """
-        # Get path to todays' detections
-        now = datetime.datetime.now()
-        todaypath = '/'.join(('..', 'detected', str(now.year), str(now.month) + '. ' + now.strftime('%B'), str(now.day)))
+        # Heavy dependencies, imported on first use
+        import skimage.exposure
+        import sklearn.cluster
         # Get paths for all frames detected today
-        detections = list()
-        for (_, _, filenames) in os.walk(todaypath):
-            detections.extend(filenames)
-            break
-        detections.sort(reverse=True)
-        detections = [d for d in detections if not d.endswith('.log')]
+        todaypath, detections = today_detections()
         # If no detection was made today, infer that nobody went to the lab
         if len(detections) == 0:
             answer.append({'type': 'text', 'text': 'Nobody was here today.'})
         else:
             # If there was a detection today, get the last frame
             lastframepath = os.path.join(todaypath, detections[0])
-            lastframe = cv2.imread(lastframepath)
             # Check the state of lights
-            light = numpy.mean(im2float(lastframe).flatten())
+            light = imload.brightness(lastframepath) or 0.0
             # Infer if there is someone in the lab
             if light > 0.3:
                 people = list()
                 answer.append({'type': 'text', 'text': 'Someone is here!'})
                 # Check frames from recent to older and try to find a person, skipping 10 by 10
-                for i in range(0, len(detections), 10):
-                    detection = detections[i]
-                    # Get frame
-                    framepath = os.path.join(todaypath, detection)
-                    frame = cv2.imread(framepath)
-                    # Try upperbody detection
-                    # If upperbody was detected, draw a rectangle over it and save, then answer!
-                    frame, found, rects = single_cascade(frame, drawboxes=False, return_objects=True)
-                    if found: people.append((frame, rects))
+                framepaths = [os.path.join(todaypath, d) for d in detections[::10]]
+                for framepath, rects in self.scanner.scan(framepaths, 'upperbody', stop=message.get('cancel')):
+                    # If upperbody was detected, keep the frame for clustering
+                    if len(rects) > 0: people.append((imload.imread(framepath), rects))
                     if len(people) > 15: break
                 # Clustering
                 features = list()
@@ -338,8 +397,8 @@ class Base:
                         selected_labels.append(labels[i])
                 answer.append({'type': 'text', 'text': 'Targets acquired.'})
                 for i, f in enumerate(selected_frames):
-                    cv2.imwrite('.found-%02d.jpg' % (i), f)
-                    answer.append({'type': 'image', 'url': '.found-%02d.jpg' % (i)})
+                    cv2.imwrite(scratch('found-%02d.jpg' % (i)), f)
+                    answer.append({'type': 'image', 'url': scratch('found-%02d.jpg' % (i))})
                 answer.append({'type': 'text', 'text': 'This was a test using affinity propagation clustering.'})
             else:
                 answer.append({'type': 'text', 'text': 'Nobody here.'})
@@ -352,16 +411,16 @@ class Base:
         Infer if there is someone in the room
         If positive, return last five events
         """
+        # Heavy dependencies, imported on first use
+        import scipy.signal
+        import matplotlib.ticker
+        import matplotlib.pyplot as plt
         # Get path to todays' detections
         now = datetime.datetime.now()
         todaypath = '/'.join(('..', 'detected', str(now.year), str(now.month) + '. ' + now.strftime('%B'), str(now.day)))
         # Get paths for all frames detected today
-        detections = list()
-        for (_, _, filenames) in os.walk(todaypath):
-            detections.extend(filenames)
-            break
-        detections.sort(reverse=True)
-        detections = [d for d in detections if not d.endswith('.log')]
+        detections = archive.names(todaypath)
+        detections.reverse()
         # If no detection was made today, infer that nobody went to the lab
         if len(detections) == 0:
             answer.append({'type': 'text', 'text': 'Nobody was here today.'})
@@ -376,16 +435,18 @@ class Base:
                 s = int(t.split()[1].split('h')[1].split('m')[1].split('.')[0])
                 counts[3600*h + 60*m + s] += 1
             xaxis = numpy.arange(0, len(counts))
-            # Generate graph
-            fig, ax = plt.subplots()
             # Identify peaks
             peaks, _ = scipy.signal.find_peaks(counts, height=8, distance=6)
-            ax.plot(xaxis, counts)
-            ax.plot(peaks, counts[peaks], "x")
-            ax.set(xlabel='Time', ylabel='Detections', title='Activity Graph')
-            formatter = matplotlib.ticker.FuncFormatter(lambda s, x: '%02d:%02d' % (s//3600,(s%3600)//60))
-            ax.xaxis.set_major_formatter(formatter)
-            fig.savefig(".activity.png", dpi=300, bbox_inches='tight')
+            # Generate graph
+            with plot_lock:
+                fig, ax = plt.subplots()
+                ax.plot(xaxis, counts)
+                ax.plot(peaks, counts[peaks], "x")
+                ax.set(xlabel='Time', ylabel='Detections', title='Activity Graph')
+                formatter = matplotlib.ticker.FuncFormatter(lambda s, x: '%02d:%02d' % (s//3600,(s%3600)//60))
+                ax.xaxis.set_major_formatter(formatter)
+                fig.savefig(scratch('activity.png'), dpi=300, bbox_inches='tight')
+                plt.close(fig)
             if len(peaks) > 0:
                 # Iterate over the peaks
                 answer.append({'type': 'text', 'text': 'Targets acquired.'})
@@ -397,12 +458,12 @@ class Base:
                             # Selecting
                             j = i + 6
                             framepath = os.path.join(todaypath, detections[j])
-                            frame = cv2.imread(framepath)
+                            frame = imload.imread(framepath)
                             selected_frames.append(frame)
                             break
                 for i, f in enumerate(selected_frames):
-                    cv2.imwrite('.found-%02d.jpg' % (i), f)
-                    answer.append({'type': 'image', 'url': '.found-%02d.jpg' % (i)})
+                    cv2.imwrite(scratch('found-%02d.jpg' % (i)), f)
+                    answer.append({'type': 'image', 'url': scratch('found-%02d.jpg' % (i))})
             else:
                 answer.append({'type': 'text', 'text': 'Oops, there was no significant activity today.'})
 
@@ -419,7 +480,7 @@ class Base:
             feature = 'notifications'
 
         if feature != '':
-            context = botkit.nlu.Context()
+            context = store.shared()
             context.write(message['username'], feature, True)
             answer.append({'type': 'text', 'text': '%s activated' % (feature.capitalize())})
         else:
@@ -438,7 +499,7 @@ class Base:
             feature = 'notifications'
 
         if feature != '':
-            context = botkit.nlu.Context()
+            context = store.shared()
             context.write(message['username'], feature, False)
             answer.append({'type': 'text', 'text': '%s deactivated' % (feature.capitalize())})
         else:
@@ -451,16 +512,16 @@ class Base:
         Post process activity_graph intent
         Generates daily activity graph
         """
+        # Heavy dependencies, imported on first use
+        import scipy.signal
+        import matplotlib.ticker
+        import matplotlib.pyplot as plt
         # Get path to todays' detections
         now = datetime.datetime.now()
         todaypath = '/'.join(('..', 'detected', str(now.year), str(now.month) + '. ' + now.strftime('%B'), str(now.day)))
         # Get paths for all frames detected today
-        detections = list()
-        for (_, _, filenames) in os.walk(todaypath):
-            detections.extend(filenames)
-            break
-        detections.sort(reverse=True)
-        detections = [d for d in detections if not d.endswith('.log')]
+        detections = archive.names(todaypath)
+        detections.reverse()
         # If no detection was made today, infer that nobody went to the lab
         if len(detections) == 0:
             answer.append({'type': 'text', 'text': 'Nobody was here today.'})
@@ -478,15 +539,17 @@ class Base:
             counts = numpy.trim_zeros(counts)
             xaxis = numpy.arange(offset, offset + len(counts))
             # Generate graph
-            fig, ax = plt.subplots()
-            ax.plot(xaxis, counts)
-            ax.set(xlabel='Time', ylabel='Detections', title='Activity Graph')
-            formatter = matplotlib.ticker.FuncFormatter(lambda s, x: '%02d:%02d' % (s//3600,(s%3600)//60))
-            ax.xaxis.set_major_formatter(formatter)
-            fig.savefig(".activity.png", dpi=300, bbox_inches='tight')
+            with plot_lock:
+                fig, ax = plt.subplots()
+                ax.plot(xaxis, counts)
+                ax.set(xlabel='Time', ylabel='Detections', title='Activity Graph')
+                formatter = matplotlib.ticker.FuncFormatter(lambda s, x: '%02d:%02d' % (s//3600,(s%3600)//60))
+                ax.xaxis.set_major_formatter(formatter)
+                fig.savefig(scratch('activity.png'), dpi=300, bbox_inches='tight')
+                plt.close(fig)
             # Answer with graph
             answer.append({'type': 'text', 'text': 'Sending you today\'s activity graph...'})
-            answer.append({'type': 'image', 'url': '.activity.png'})
+            answer.append({'type': 'image', 'url': scratch('activity.png')})
 
         return answer
 
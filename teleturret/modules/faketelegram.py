@@ -0,0 +1,196 @@
+""" Local fake of the Telegram Bot API, for testing the bot offline
+
+Start it and point the bot to it with the "api_url" key in config.json:
+
+    python3 modules/faketelegram.py 8081
+    "api_url": "http://127.0.0.1:8081/bot"
+
+Lines typed in the terminal as "@username message" are delivered to the
+bot as private text messages. Everything the bot sends is printed.
+"""
+
+# Standard imports
+import sys
+import json
+import time
+import zlib
+import email
+import threading
+import http.server
+import urllib.parse
+
+def log(m):
+    print(m)
+    sys.stdout.flush()
+
+class FakeTelegram:
+    """
+    Minimal Telegram Bot API server
+
+    Serves getMe, getUpdates, getMyCommands, sendMessage, sendPhoto,
+    sendMediaGroup and a few no-op methods. Incoming updates are created
+    with send_text() and every call made by the bot is recorded in calls.
+    """
+    def __init__(self, host='127.0.0.1', port=0, botname='teleturretbot'):
+        """
+        Start the HTTP server in a background thread
+        """
+        self.botname = botname
+        self.lock = threading.Condition()
+        self.updates = list()
+        self.calls = list()
+        self.next_update_id = 1
+        self.next_message_id = 1
+        fake = self
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_POST(self):
+                fake.handle(self)
+            do_GET = do_POST
+            def log_message(self, *args):
+                pass
+        self.server = http.server.ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    @property
+    def url(self):
+        """
+        Base URL to give to telegram.Bot(token, base_url=...)
+        """
+        host, port = self.server.server_address[:2]
+        return 'http://%s:%d/bot' % (host, port)
+
+    def close(self):
+        """
+        Stop the server
+        """
+        self.server.shutdown()
+        self.server.server_close()
+
+    def send_text(self, username, text, chat_id=None, chat_type='private'):
+        """
+        Queue a text message from username to the bot
+        """
+        user_id = zlib.crc32(username.encode('utf-8'))
+        with self.lock:
+            message = { 'message_id': self.next_message_id,
+                        'date': int(time.time()),
+                        'text': text,
+                        'from': {'id': user_id, 'is_bot': False,
+                                 'first_name': username.lstrip('@'), 'username': username.lstrip('@')},
+                        'chat': {'id': chat_id or user_id, 'type': chat_type} }
+            self.next_message_id += 1
+            self.updates.append({'update_id': self.next_update_id, 'message': message})
+            self.next_update_id += 1
+            self.lock.notify_all()
+
+    def sent(self, method=None):
+        """
+        Return recorded calls, optionally only those of one method
+        """
+        with self.lock:
+            return [c for c in self.calls if method is None or c['method'] == method]
+
+    def wait_sent(self, method, count=1, timeout=10.0):
+        """
+        Wait until the bot made count calls to method
+        Return True if it did before timeout
+        """
+        deadline = time.monotonic() + timeout
+        with self.lock:
+            while len([c for c in self.calls if c['method'] == method]) < count:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0: return False
+                self.lock.wait(remaining)
+            return True
+
+    def parse(self, request):
+        """
+        Return the parameters of a request as a dict
+        Uploaded files are replaced by their size in bytes
+        """
+        query = urllib.parse.urlparse(request.path).query
+        params = {k: v[-1] for k, v in urllib.parse.parse_qs(query).items()}
+        length = int(request.headers.get('Content-Length') or 0)
+        body = request.rfile.read(length) if length > 0 else b''
+        ctype = request.headers.get('Content-Type', '')
+        if ctype.startswith('application/json'):
+            params.update(json.loads(body.decode('utf-8') or '{}'))
+        elif ctype.startswith('application/x-www-form-urlencoded'):
+            params.update({k: v[-1] for k, v in urllib.parse.parse_qs(body.decode('utf-8')).items()})
+        elif ctype.startswith('multipart/form-data'):
+            message = email.message_from_bytes(b'Content-Type: ' + ctype.encode('latin-1') + b'\r\n\r\n' + body)
+            for part in message.get_payload():
+                name = part.get_param('name', header='content-disposition')
+                payload = part.get_payload(decode=True) or b''
+                if part.get_filename() is not None: params[name] = len(payload)
+                else: params[name] = payload.decode('utf-8')
+        return params
+
+    def message(self, chat_id, **content):
+        """
+        Build a message sent by the bot
+        """
+        with self.lock:
+            message = { 'message_id': self.next_message_id,
+                        'date': int(time.time()),
+                        'chat': {'id': int(chat_id), 'type': 'private'} }
+            self.next_message_id += 1
+        message.update(content)
+        return message
+
+    def handle(self, request):
+        """
+        Answer one Bot API call
+        """
+        method = urllib.parse.urlparse(request.path).path.rsplit('/', 1)[-1]
+        params = self.parse(request)
+        photo = [{'file_id': 'fake', 'file_unique_id': 'fake', 'width': 640, 'height': 480, 'file_size': 0}]
+        if method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'Turret', 'username': self.botname}
+        elif method == 'getUpdates':
+            offset = int(params.get('offset') or 0)
+            timeout = float(params.get('timeout') or 0)
+            deadline = time.monotonic() + timeout
+            with self.lock:
+                self.updates = [u for u in self.updates if u['update_id'] >= offset]
+                while not self.updates and time.monotonic() < deadline:
+                    self.lock.wait(deadline - time.monotonic())
+                result = list(self.updates)
+        elif method == 'sendMessage':
+            result = self.message(params.get('chat_id'), text=params.get('text'))
+        elif method == 'sendPhoto':
+            result = self.message(params.get('chat_id'), photo=photo)
+        elif method == 'sendMediaGroup':
+            media = params.get('media')
+            if isinstance(media, str): media = json.loads(media)
+            result = [self.message(params.get('chat_id'), photo=photo) for _ in media or []]
+        elif method == 'getMyCommands':
+            result = []
+        else:
+            result = True
+        if method != 'getUpdates':
+            with self.lock:
+                self.calls.append({'method': method, 'params': params})
+                self.lock.notify_all()
+            log('%s %s' % (method, json.dumps(params, ensure_ascii=False, default=str)))
+        content = json.dumps({'ok': True, 'result': result}).encode('utf-8')
+        request.send_response(200)
+        request.send_header('Content-Type', 'application/json')
+        request.send_header('Content-Length', str(len(content)))
+        request.end_headers()
+        request.wfile.write(content)
+
+if __name__ == "__main__":
+
+    fake = FakeTelegram(port=int(sys.argv[1]) if len(sys.argv) > 1 else 8081)
+    log('Fake Telegram API at %s' % (fake.url))
+    try:
+        for line in sys.stdin:
+            username, _, text = line.strip().partition(' ')
+            if username.startswith('@') and text:
+                fake.send_text(username, text)
+    except KeyboardInterrupt:
+        pass
+    fake.close()
@@ -0,0 +1,83 @@
+""" Cached bot configuration
+"""
+
+# Standard imports
+import os
+import sys
+import json
+import time
+import threading
+
+def log(m):
+    print(m)
+    sys.stdout.flush()
+
+class Config:
+    """
+    Configuration loaded once from a JSON file
+
+    The file modification time is checked at most every check_interval
+    seconds and the file is parsed again only when it changed, so edits
+    take effect without a restart. If the new content can not be parsed,
+    the previous configuration is kept.
+    """
+    def __init__(self, path='config.json', check_interval=2.0):
+        """
+        Load the configuration file
+        """
+        self.path = path
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        self.mtime = None
+        self.checked = 0
+        self.config = dict()
+        self.allowed_users = frozenset()
+        self.reload()
+
+    def reload(self):
+        """
+        Parse the configuration file if it changed since last load
+        """
+        mtime = os.stat(self.path).st_mtime_ns
+        if mtime == self.mtime: return
+        # Remember this version even if it is invalid, it is retried once changed
+        self.mtime = mtime
+        with open(self.path) as config_file:
+            config = json.load(config_file)
+        self.config = config
+        self.allowed_users = frozenset(config.get('allowed', list()))
+
+    def refresh(self):
+        """
+        Reload the configuration file if it is time to check it
+        """
+        now = time.monotonic()
+        if now - self.checked < self.check_interval: return
+        with self.lock:
+            if now - self.checked < self.check_interval: return
+            self.checked = now
+            try:
+                self.reload()
+            except (OSError, ValueError) as e:
+                log('Could not reload %s, keeping previous configuration: %s' % (self.path, e))
+
+    def get(self):
+        """
+        Return the whole configuration dict
+        """
+        self.refresh()
+        return self.config
+
+    def __getitem__(self, key):
+        return self.get()[key]
+
+    def __contains__(self, key):
+        return key in self.get()
+
+    @property
+    def allowed(self):
+        """
+        Set of usernames allowed to talk with the bot
+        """
+        self.refresh()
+        return self.allowed_users
@@ -0,0 +1,184 @@
+""" Thread-safe context store for bot state
+"""
+
+# Standard imports
+import os
+import sys
+import copy
+import json
+import time
+import queue
+import atexit
+import threading
+import multiprocessing
+
+# Project imports
+import botkit.nlu
+
+def log(m):
+    print(m)
+    sys.stdout.flush()
+
+class Context:
+    """
+    In-memory drop-in for botkit.nlu.Context
+
+    State is kept in memory and guarded by a lock, so the Telegram thread,
+    the notifications timer and the answer processors never read it from
+    disk. A single writer thread persists it, coalescing all writes done
+    within flush_interval seconds into one atomic file replacement.
+
+    Processes forked after the store is created keep a snapshot for reads
+    and forward their writes to the writer thread through a queue.
+    """
+    def __init__(self, path='.context.json', flush_interval=1.0, seed=None):
+        """
+        Load state from path, or from seed() if path does not exist yet
+        Start the writer thread
+        """
+        self.path = path
+        self.flush_interval = flush_interval
+        self.lock = threading.RLock()
+        self.flush_lock = threading.Lock()
+        self.data = dict()
+        self.dirty = False
+        if os.path.exists(path):
+            with open(path) as context_file:
+                self.data = json.load(context_file)
+        elif seed is not None:
+            self.data = seed() or dict()
+            self.dirty = True
+        self.pid = os.getpid()
+        self.queue = multiprocessing.Queue()
+        self.writer = threading.Thread(target=self._writer, daemon=True)
+        self.writer.start()
+        atexit.register(self.flush)
+
+    def __load__(self):
+        """
+        Return a copy of the whole state
+        """
+        with self.lock:
+            return copy.deepcopy(self.data)
+
+    def _apply(self, op, user, key, value):
+        """
+        Apply a write operation to the in-memory state
+        """
+        with self.lock:
+            entry = self.data.setdefault(user, dict())
+            if op == 'write':
+                entry[key] = value
+            elif op == 'merge':
+                current = entry.get(key)
+                if not isinstance(current, dict): current = entry[key] = dict()
+                current.update(value)
+            self.dirty = True
+
+    def _submit(self, op, user, key, value):
+        """
+        Apply an operation here, or forward it to the owner process
+        """
+        if os.getpid() == self.pid:
+            self._apply(op, user, key, value)
+        else:
+            self.queue.put((op, user, key, value))
+
+    def _writer(self):
+        """
+        Apply forwarded operations and flush state to disk periodically
+        """
+        last_flush = time.monotonic()
+        while True:
+            try:
+                self._apply(*self.queue.get(timeout=self.flush_interval))
+            except queue.Empty:
+                pass
+            if time.monotonic() - last_flush >= self.flush_interval:
+                self.flush()
+                last_flush = time.monotonic()
+
+    def flush(self):
+        """
+        Write state to disk if it changed since the last flush
+        """
+        if os.getpid() != self.pid: return
+        with self.flush_lock:
+            with self.lock:
+                if not self.dirty: return
+                content = json.dumps(self.data, indent=4, sort_keys=True, ensure_ascii=False)
+                self.dirty = False
+            try:
+                with open(self.path + '.tmp', 'w') as context_file:
+                    context_file.write(content)
+                os.replace(self.path + '.tmp', self.path)
+            except OSError as e:
+                log('Could not save context: %s' % (e))
+                with self.lock: self.dirty = True
+
+    def users(self):
+        """
+        Return all known usernames
+        """
+        with self.lock:
+            return list(self.data.keys())
+
+    def has_user(self, user):
+        """
+        Return True if there is state for user
+        """
+        with self.lock:
+            return user in self.data
+
+    def has_key(self, user, key):
+        """
+        Return True if key is set for user
+        """
+        with self.lock:
+            return user in self.data and key in self.data[user]
+
+    def read(self, user, key, default=None):
+        """
+        Return a copy of the value of key for user
+        """
+        with self.lock:
+            return copy.deepcopy(self.data.get(user, dict()).get(key, default))
+
+    def write(self, user, key, value):
+        """
+        Set the value of key for user
+        """
+        self._submit('write', user, key, value)
+
+    def merge(self, user, key, items):
+        """
+        Atomically add items to the dict stored in key for user
+        Works from forked processes too
+        """
+        self._submit('merge', user, key, dict(items))
+
+    def update(self, user, key, function, default=None):
+        """
+        Atomically replace the value of key for user by function(value)
+        Only available in the owner process
+        Return the new value
+        """
+        if os.getpid() != self.pid:
+            raise RuntimeError('Context.update() is not available in forked processes, use merge()')
+        with self.lock:
+            value = function(copy.deepcopy(self.data.get(user, dict()).get(key, default)))
+            self._apply('write', user, key, value)
+            return value
+
+shared_context = None
+shared_lock = threading.Lock()
+def shared():
+    """
+    Return the context store shared by the whole bot, creating it on first use
+    On first run, state is imported from botkit's context
+    """
+    global shared_context
+    with shared_lock:
+        if shared_context is None:
+            shared_context = Context(seed=lambda: botkit.nlu.Context().__load__())
+        return shared_context
@@ -0,0 +1,117 @@
+""" Concurrent processing of bot requests
+"""
+
+# Standard imports
+import sys
+import time
+import threading
+import traceback
+import concurrent.futures
+
+def log(m):
+    print(m)
+    sys.stdout.flush()
+
+class Job:
+    """
+    A request being processed by an IntentPool
+
+    Functions running a job should check cancelled() before expensive
+    steps and before replying, or pass the cancel event to code that can
+    stop early, such as FrameScanner.scan().
+    """
+    def __init__(self, key, intent, timeout):
+        self.key = key
+        self.intent = intent
+        self.cancel = threading.Event()
+        self.timed_out = False
+        self.started = time.monotonic()
+        self.timeout = timeout
+
+    def cancelled(self):
+        """
+        Return True if the job was cancelled or timed out
+        """
+        return self.cancel.is_set()
+
+class IntentPool:
+    """
+    Bounded worker pools, one per class of intents
+
+    Each class is configured by a dict with keys:
+        intents: list of intents in this class
+        workers: number of threads serving the class
+        queue: number of jobs that may wait for a free thread
+        timeout: seconds after which a job is cancelled, None for no limit
+        cancel_previous: if True, a new job from the same key cancels the
+                         one still running
+    Intents not listed in any class go to the default class.
+    """
+    def __init__(self, classes, default):
+        """
+        Start worker pools
+        """
+        self.classes = classes
+        self.default = default
+        self.intent_class = dict()
+        self.pools = dict()
+        self.slots = dict()
+        for name, c in classes.items():
+            for intent in c.get('intents', list()):
+                self.intent_class[intent] = name
+            self.pools[name] = concurrent.futures.ThreadPoolExecutor(max_workers=c['workers'], thread_name_prefix=name)
+            self.slots[name] = threading.BoundedSemaphore(c['workers'] + c.get('queue', 0))
+        self.lock = threading.Lock()
+        self.running = dict()
+
+    def classify(self, intent):
+        """
+        Return the name of the class serving intent
+        """
+        return self.intent_class.get(intent, self.default)
+
+    def submit(self, intent, key, function, on_timeout=None):
+        """
+        Run function(job) in the pool for intent
+        key identifies the requester, usually the chat id
+        on_timeout(job) is called from a timer thread if the job times out
+        Return the Job, or None if the class is saturated
+        """
+        name = self.classify(intent)
+        c = self.classes[name]
+        if not self.slots[name].acquire(blocking=False):
+            return None
+        job = Job(key, intent, c.get('timeout'))
+        with self.lock:
+            previous = self.running.get((name, key))
+            if c.get('cancel_previous') and previous is not None:
+                previous.cancel.set()
+            self.running[(name, key)] = job
+
+        def expire():
+            if job.cancel.is_set(): return
+            job.timed_out = True
+            job.cancel.set()
+            if on_timeout is not None: on_timeout(job)
+
+        timer = None
+        if job.timeout:
+            timer = threading.Timer(job.timeout, expire)
+            timer.daemon = True
+            timer.start()
+
+        def run():
+            try:
+                if not job.cancelled(): function(job)
+            except Exception:
+                log(traceback.format_exc())
+            finally:
+                if timer is not None: timer.cancel()
+                with self.lock:
+                    if self.running.get((name, key)) is job:
+                        del self.running[(name, key)]
+                self.slots[name].release()
+
+        self.pools[name].submit(run)
+        return job
+
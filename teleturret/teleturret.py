@@ -5,10 +5,12 @@
 """
 
 # Standard imports
+import io
 import os
 import sys
 import json
 import time
+STARTED = time.monotonic()
 import logging
 import requests
 import datetime
@@ -18,18 +20,21 @@ import multiprocessing
 # External imports
 import cv2
 import numpy
-import scipy
 import telegram
 import telegram.ext
-import face_recognition as fc
-import matplotlib
-import matplotlib.pyplot as plt
 
 # Project imports
 import botkit.nlu
 
 # Teleturret imports
 from modules import base
+from modules import archive
+from modules import imload
+from modules import facestore
+from modules import store
+from modules import settings
+from modules import workers
+from modules import profiler
 
 def log(m):
     print(m)
@@ -37,6 +42,8 @@ def log(m):
 
 # Initialize botkit, disable entity recognition, activate base module
 turretbot = botkit.nlu.NLU(disable=['entities'])
+# Load bot state before any process is forked, so children can forward writes
+context = store.shared()
 online_modules = [base]
 
 # Get all defined intents and link to their answer processors
@@ -46,19 +53,14 @@ for m in online_modules:
         link[i] = m.link.answer_processor
         log("Loaded intent: " + i)
 
-def loadconfig():
-    """
-    """
-    with open('config.json') as config_file:
-        config = json.load(config_file)
-    return config
+# Load config file, reloaded automatically when it changes
+config = settings.Config('config.json')
 
 def allowed(update):
     """
-    Return True if username is in list ALLOWED
+    Return True if username is in the allowed set
     """
-    config = loadconfig()
-    if 'allowed' in config: ALLOWED = config['allowed']
+    ALLOWED = config.allowed
     if update.message is not None:
         return '@' + update.effective_message.from_user.username in ALLOWED \
                 and ( update.message.chat.type == 'private' \
@@ -89,15 +91,38 @@ def build_menu(buttons, n_cols, header_buttons=None, footer_buttons=None):
     if footer_buttons: menu.append(footer_buttons)
     return menu
 
-def generate_answer(bot, answer, update):
+def send_images(bot, urls, update):
+    """
+    Upload images, grouping them in albums of up to 10 images
+    """
+    for i in range(0, len(urls), 10):
+        files = [io.BytesIO(archive.read(url)) for url in urls[i:i + 10]]
+        try:
+            if len(files) == 1:
+                update.effective_message.reply_photo(photo=files[0])
+            else:
+                media = [telegram.InputMediaPhoto(media=f) for f in files]
+                bot.send_media_group(chat_id=update.effective_message.chat.id, media=media)
+        finally:
+            for f in files: f.close()
+
+def generate_answer(bot, answer, update, job=None):
     """
     Interpret botkit answers and produce Telegram answers
+    Consecutive images are sent together as an album
+    Stop if job is cancelled
     """
+    images = list()
     for a in answer:
+        if job is not None and job.cancelled(): return
+        if a['type'] == 'image':
+            images.append(a['url'])
+            continue
+        if len(images) > 0:
+            send_images(bot, images, update)
+            images = list()
         if a['type'] == 'text':
             update.effective_message.reply_text(text=a['text'])
-        if a['type'] == 'image':
-            update.effective_message.reply_photo(photo=open(a['url'], 'rb'))
         if a['type'] == 'lyrics':
             update.effective_message.reply_text(text=a['lyrics'])
         if a['type'] == 'select':
@@ -108,19 +133,41 @@ def generate_answer(bot, answer, update):
             button = [telegram.InlineKeyboardButton(text=a['title'], url=a['link'])]
             reply_markup = telegram.InlineKeyboardMarkup(build_menu(button, n_cols=1))
             bot.send_message(chat_id=update.effective_message.chat.id, text=a['text'], reply_markup=reply_markup)
+    if len(images) > 0 and (job is None or not job.cancelled()):
+        send_images(bot, images, update)
+
+# Expensive intents scan directories and run detectors, they get their own
+# workers so they never delay cheap answers. A new expensive request from
+# the same chat replaces the previous one.
+pool = workers.IntentPool({
+    'fast': {'intents': ['none', 'greetings', 'activate', 'deactivate'], 'workers': 4, 'queue': 32, 'timeout': 30},
+    'heavy': {'intents': ['someone', 'who', 'activity_graph'], 'workers': 2, 'queue': 4, 'timeout': 120, 'cancel_previous': True},
+}, default='fast')
 
 def teleturretbot(update, type_, bot):
     """
     Get client message, forward to botkit
     Get botkit answers, generate respective Telegram actions
+    Answers are computed and sent by the worker pool of the message intent
     """
     message = build_message(update, type_)
     message_data = turretbot.compute(message['text'])
-    message_data['answer'] = link[message_data['intent']].compute(message, message_data)
-    log('----------------------------------------')
-    log('*--------------------------------------*')
-    log(json.dumps(message_data, indent=4, sort_keys=True, ensure_ascii=False))
-    generate_answer(bot, message_data['answer'], update)
+
+    def process(job):
+        message['cancel'] = job.cancel
+        message_data['answer'] = link[message_data['intent']].compute(message, message_data)
+        message.pop('cancel')
+        log('----------------------------------------')
+        log('*--------------------------------------*')
+        log(json.dumps(message_data, indent=4, sort_keys=True, ensure_ascii=False))
+        generate_answer(bot, message_data['answer'], update, job)
+
+    def timed_out(job):
+        update.effective_message.reply_text(text='Sorry, that took too long. Please try again later.')
+
+    job = pool.submit(message_data['intent'], message['userid'], process, on_timeout=timed_out)
+    if job is None:
+        update.effective_message.reply_text(text='I am busy right now. Please try again in a moment.')
 
 def start(bot, update):
     """
@@ -134,7 +181,6 @@ def answer_text(bot, update):
     """
     Process arbitrary text
     """
-    context = botkit.nlu.Context()
     if not context.has_user('@' + update.effective_message.from_user.username):
         context.write('@' + update.effective_message.from_user.username, 'chat_id', update.effective_message.chat.id)
     if allowed(update):
@@ -156,23 +202,17 @@ def notifications():
     now = datetime.datetime.now()
     todaypath = '/'.join(('..', 'detected', str(now.year), str(now.month) + '. ' + now.strftime('%B'), str(now.day)))
     # Get paths for all frames detected today
-    detections = list()
-    for (_, _, filenames) in os.walk(todaypath):
-        detections.extend(filenames)
-        break
-    detections.sort(reverse=True)
-    detections = [d for d in detections if not d.endswith('.log')]
+    detections = archive.names(todaypath)
+    detections.reverse()
     # If a detection was made today
     if len(detections) > 0:
         # If there was a detection today, get the last frame
         lastframepath = os.path.join(todaypath, detections[0])
-        lastframe = cv2.imread(lastframepath)
         # Check the state of lights
-        light_lvl = numpy.mean(im2float(lastframe).flatten())
+        light_lvl = imload.brightness(lastframepath) or 0.0
         # Infer if there is someone in the lab
         light = True if light_lvl > 0.3 else False
     
-        context = botkit.nlu.Context()
         if not context.has_key('@teleturretbot', 'light'):
             log('New light')
             context.write('@teleturretbot', 'light', light)
@@ -180,7 +220,7 @@ def notifications():
         if light != context.read('@teleturretbot', 'light'):
             context.write('@teleturretbot', 'light', light)
             nt_message = 'Someone just %s the lab!' % ('opened' if light else 'closed')
-            for username in context.__load__().keys():
+            for username in context.users():
                 if context.read(username, 'notifications'):
                     bot.send_message(chat_id=context.read(username, 'chat_id'), text=nt_message)
 
@@ -193,27 +233,49 @@ def notifications_loop():
     nt_timer = threading.Timer((next_nt_time-now).seconds, notifications_loop)
     nt_timer.setDaemon(True)
     nt_timer.start()
-notifications_loop()
 
+fc = None
 database = None
 facedatabase = None
 facedatabase_names = None
 facedatabase_encodings = None
-fraction = 1.0
-# Set up recognizer if not ready
-if (not database) or (not facedatabase) or (not facedatabase_encodings):
-    database = list()
-    for (_, _, filenames) in os.walk('faces'):
-        database.extend(filenames)
-        break
-    database = sorted(database)
-    facedatabase = [fc.load_image_file(os.path.join('faces', name)) for name in database]
-    facedatabase_names = [name.split('.')[0] for name in database]
-    facedatabase_encodings = [fc.face_encodings(face)[0] for face in facedatabase]
+enrolled = 0
+reduction = 2
+# The turret enrolls faces relative to its own folder, the parent of this one
+ENROLLED = os.path.join('..', facestore.ENROLLED)
+def load_face_database():
+    """ Import face_recognition and encode known faces, once, then add the
+    faces enrolled by the turret since the last call
+    Called before forking recognizers, so they inherit the database
+    Known faces are in the facedatabase lists, in the same order; enrolled
+    faces have no image in facedatabase
+    """
+    global fc, database, facedatabase, facedatabase_names, facedatabase_encodings, enrolled
+    # Set up recognizer if not ready
+    if database is None:
+        import face_recognition as fc
+        database = list()
+        for (_, _, filenames) in os.walk('faces'):
+            database.extend(filenames)
+            break
+        database = sorted(database)
+        facedatabase = [fc.load_image_file(os.path.join('faces', name)) for name in database]
+        facedatabase_names = [name.split('.')[0] for name in database]
+        facedatabase_encodings = [fc.face_encodings(face)[0] for face in facedatabase]
+        enrolled = 0
+    # Faces enrolled from visitors by the turret, see modules/visitors.py
+    # The store is only read again when its size changed
+    names, encodings = facestore.enrolled(enrolled, path=ENROLLED)
+    database.extend(names)
+    facedatabase.extend([None]*len(names))
+    facedatabase_names.extend(names)
+    facedatabase_encodings.extend(encodings)
+    enrolled += len(names)
 
 def face_recognition(t_datetime):
     """ Face recognition
     """
+    load_face_database()
     nkeyframes = 10
     # Get path to todays' activity log
     Y, M, M_str, D = t_datetime.year, t_datetime.month, t_datetime.strftime('%B'), t_datetime.day
@@ -222,15 +284,10 @@ def face_recognition(t_datetime):
     for ms in range(1000):    
         hms = str(t_datetime)[:10] + ' ' + '%02d'%(h) + 'h' + '%02d'%(m) + 'm' + '%02d.%03d'%(s,ms) + 's' + '.jpg'
         baseframepath = os.path.join(todaypath, hms)
-        if os.path.exists(baseframepath):
+        if archive.exists(baseframepath):
             break
     # Get paths for all frames detected today
-    detections = list()
-    for (_, _, filenames) in os.walk(todaypath):
-        detections.extend(filenames)
-        break
-    detections = [d for d in detections if not d.endswith('.log')]
-    detections.sort()
+    detections = archive.names(todaypath)
     baseindex = detections.index(hms)
     keyframespaths = detections[baseindex-nkeyframes:baseindex+nkeyframes]
     votes = numpy.zeros(len(database))
@@ -238,12 +295,17 @@ def face_recognition(t_datetime):
     # Loop through key frames
     for keyframepath in keyframespaths:
         framepath = os.path.join(todaypath, keyframepath)
-        frame = cv2.imread(framepath)
-        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-        frame = cv2.resize(frame, (0, 0), fx=fraction, fy=fraction)
-        face_locations = fc.face_locations(frame)
-        if len(face_locations) > 0:
-            face_encodings = fc.face_encodings(frame, face_locations)
+        # Faces encoded by the turret when it saved the frame are not encoded again
+        faces = facestore.lookup(framepath)
+        if faces is not None:
+            face_encodings = [encoding for _, _, encoding in faces]
+        else:
+            frame = imload.imread(framepath, reduction=reduction)
+            if frame is None: continue
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+            face_locations = fc.face_locations(frame)
+            face_encodings = fc.face_encodings(frame, face_locations) if len(face_locations) > 0 else []
+        if len(face_encodings) > 0:
             for face_encoding in face_encodings:
                 results = fc.compare_faces(facedatabase_encodings, face_encoding, tolerance=0.5)
                 if True in results:
@@ -254,18 +316,17 @@ def face_recognition(t_datetime):
         detected_name = facedatabase_names[numpy.argmax(votes)]
     else: detected_name = 'Unknown'
 
-    context = botkit.nlu.Context()
-    if not context.has_key('@teleturretbot', 'activity'):
-        context.write('@teleturretbot', 'activity', {})
-    activity = context.read('@teleturretbot', 'activity')
     name = detected_name
     time = '%04d/%02d/%02d %02d:%02d:%02d' % (Y,M,D,h,m,s)
-    activity[time] = name
-    context.write('@teleturretbot', 'activity', activity)
+    # Runs in a child process, the merge is applied by the main process
+    context.merge('@teleturretbot', 'activity', {time: name})
     time_str = str(t_datetime)[:19]
     log('%s %s' % (time_str, name))
 
 def event_detection():
+    # Plotting and peak detection are only needed in this process
+    import scipy.signal
+    import matplotlib.pyplot as plt
     time_window = 8
     while True:
         # Get path to todays' activity log
@@ -299,6 +360,7 @@ def event_detection():
                 fig.savefig(".activity-tmp.png", dpi=300, bbox_inches='tight')
                 plt.close()
                 if len(peaks) > 0:
+                    load_face_database()
                     for peak in peaks:
                         activity_peak_datetime = now - datetime.timedelta(seconds=int(peak))
                         face_recognition_process = multiprocessing.Process(target=face_recognition, args=(activity_peak_datetime,))
@@ -308,34 +370,46 @@ def event_detection():
         else:
             time.sleep(60)
 
-event_detection_process = multiprocessing.Process(target=event_detection, args=())
-event_detection_process.start()
-
-# Load config file
-config = loadconfig()
-
-# Set Telegram API key
-TELEGRAM_BOT_KEY = config['keys']['telegram']['teleturretbot']
-# Set list of allowed users
-ALLOWED = list()
-if 'allowed' in config: ALLOWED = config['allowed']
+bot = None
+def build_updater(config):
+    """
+    Create the Telegram bot and its updater, with handlers for /start and text
+    An optional api_url points the bot to another Bot API server, e.g. modules/faketelegram.py
+    """
+    global bot
+    TELEGRAM_BOT_KEY = config['keys']['telegram']['teleturretbot']
+    if 'api_url' in config: bot = telegram.Bot(TELEGRAM_BOT_KEY, base_url=config['api_url'])
+    else: bot = telegram.Bot(TELEGRAM_BOT_KEY)
+    updater = telegram.ext.Updater(bot=bot)
+    dispatcher = updater.dispatcher
+    # Set up handler for /start command
+    start_handler = telegram.ext.CommandHandler('start', start)
+    dispatcher.add_handler(start_handler)
+    # Set up handler for arbitrary text
+    text_handler = telegram.ext.MessageHandler(telegram.ext.Filters.text, answer_text)
+    dispatcher.add_handler(text_handler)
+    return updater
+
+def main():
+    """
+    Start event detection, notifications and the Telegram bot
+    """
+    global event_detection_process
+    event_detection_process = multiprocessing.Process(target=event_detection, args=())
+    event_detection_process.start()
 
-# Set up Telegram updated and dispatcher
-bot = telegram.Bot(TELEGRAM_BOT_KEY)
-updater = telegram.ext.Updater(bot=bot)
-dispatcher = updater.dispatcher
+    updater = build_updater(config)
+    notifications_loop()
 
-# Set up logging
-logging.basicConfig(level=logging.ERROR, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    # Set up logging
+    logging.basicConfig(level=logging.ERROR, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 
-# Set up handler for /start command
-start_handler = telegram.ext.CommandHandler('start', start)
-dispatcher.add_handler(start_handler)
+    # Profile all threads on SIGUSR1 (kill -USR1 <pid>), into profiles/
+    profiler.install(duration=config['profile_seconds'] if 'profile_seconds' in config else 10.0, prefix='teleturret', log=log)
 
-# Set up handler for arbitrary text
-text_handler = telegram.ext.MessageHandler(telegram.ext.Filters.text, answer_text)
-dispatcher.add_handler(text_handler)
+    # I see you
+    print("Turret Bot ready! (%.2fs)" % (time.monotonic() - STARTED))
+    updater.start_polling()
 
-# I see you
-print("Turret Bot ready!")
-updater.start_polling()
+if __name__ == "__main__":
+    main()
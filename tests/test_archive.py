@@ -0,0 +1,43 @@
+""" Readers cache of modules/archive.py
+"""
+
+# Standard imports
+import os
+import datetime
+
+# Project imports
+from modules import archive
+
+def pack(path, frames=2):
+    writer = archive.Writer(path)
+    try:
+        for i in range(frames):
+            writer.append(b'frame %d' % (i), datetime.datetime(2019, 3, 5, 14, 2, i))
+    finally:
+        writer.close()
+
+def test_readers_are_bounded(tmp_path):
+    days = [str(tmp_path / str(day)) for day in range(4)]
+    for day in days: pack(day)
+    readers = archive.Readers(archive.Reader, size=2)
+    first = readers.get(days[0])
+    assert readers.get(days[1]) is not None
+    # Using the first day keeps it open, the second one is closed instead
+    assert readers.get(days[0]) is first
+    second = readers._readers[os.path.normpath(days[1])]
+    readers.get(days[2])
+    assert list(readers._readers) == [os.path.normpath(days[0]), os.path.normpath(days[2])]
+    assert len(second) == 0
+    # A closed reader maps its files again when refreshed
+    assert second.refresh() and second.read(1) == b'frame 1'
+    readers.close()
+
+def test_missing_days_are_retried(tmp_path):
+    day = str(tmp_path / 'day')
+    readers = archive.Readers(archive.Reader, retry=3600.0)
+    assert readers.get(day) is None
+    pack(day)
+    assert readers.get(day) is None
+    readers.retry = 0.0
+    assert readers.get(day) is not None
+    readers.close()
@@ -0,0 +1,100 @@
+""" Speaker and TokenBucket of modules/soundcat.py, without audio hardware
+
+Sounds are not decoded: the Soundcat of each Speaker is asked to play by
+category and answers with a fake mixer channel, which records what was
+played and stopped.
+"""
+
+# External imports
+import pytest
+
+pygame = pytest.importorskip('pygame')
+
+# Project imports
+from modules import soundcat
+
+class Channel:
+    """
+    Mixer channel playing until stopped
+    """
+    def __init__(self, category_name, busy):
+        self.category_name = category_name
+        self.busy = busy
+        self.stopped = False
+
+    def get_busy(self):
+        return self.busy
+
+    def stop(self):
+        self.busy = False
+        self.stopped = True
+
+@pytest.fixture
+def speaker(monkeypatch):
+    """
+    Speaker on the dummy SDL driver, with the channels it played as
+    speaker.channels, busy when speaker.busy is True
+    """
+    monkeypatch.setenv('SDL_AUDIODRIVER', 'dummy')
+    speaker = soundcat.Speaker(rates={'detected': (1.0, 2)}, priorities={'quit': 2, 'alarm': 1}, driver='dummy')
+    speaker.channels = list()
+    speaker.busy = False
+    def play(category_name, use_pps=False):
+        channel = Channel(category_name, speaker.busy)
+        speaker.channels.append(channel)
+        return channel
+    monkeypatch.setattr(speaker._soundcat, 'play', play)
+    yield speaker
+    if speaker._thread.is_alive(): speaker.stop(timeout=1.0)
+    else: speaker._soundcat.quit()
+
+def played(speaker):
+    return [channel.category_name for channel in speaker.channels]
+
+def test_priority_order(speaker):
+    for category_name in ('hello', 'alarm', 'bye', 'quit'):
+        speaker.play(category_name)
+    speaker.start()
+    speaker.stop()
+    # Highest priority first, in request order within a priority
+    assert played(speaker) == ['quit', 'alarm', 'hello', 'bye']
+
+def test_preemption(speaker):
+    speaker.busy = True
+    # Each request is played by the loop before the next one is queued
+    for category_name in ('hello', 'alarm', 'hello'):
+        speaker.play(category_name)
+        speaker._queue.put((float('inf'), next(speaker._order), None))
+        speaker._run()
+    # The alarm stops the first hello and drops the second one
+    assert played(speaker) == ['hello', 'alarm']
+    assert speaker.channels[0].stopped
+    assert not speaker.channels[1].stopped
+
+def test_rate_limit(speaker):
+    for _ in range(5):
+        speaker.play('detected')
+    speaker.play('hello')
+    speaker.start()
+    speaker.stop()
+    # A burst of 2, the bucket does not refill while the queue drains
+    assert played(speaker) == ['detected', 'detected', 'hello']
+
+def test_stop_drains_queue(speaker):
+    for _ in range(20):
+        speaker.play('hello')
+    speaker.start()
+    speaker.stop()
+    assert not speaker._thread.is_alive()
+    assert played(speaker) == ['hello']*20
+
+def test_token_bucket(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(soundcat.time, 'monotonic', lambda: now[0])
+    bucket = soundcat.TokenBucket(rate=2.0, burst=3)
+    assert [bucket.take() for _ in range(4)] == [True, True, True, False]
+    now[0] += 0.5
+    assert [bucket.take() for _ in range(2)] == [True, False]
+    # Tokens do not accumulate past the burst
+    now[0] += 10.0
+    assert [bucket.take() for _ in range(4)] == [True, True, True, False]
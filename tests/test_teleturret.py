@@ -0,0 +1,273 @@
+""" Teleturret bot loop, run against the fake Telegram Bot API
+
+The bot is pointed to teleturret/modules/faketelegram.py with the api_url
+config key, and its NLU and answer processors are replaced, so only the
+Telegram side of the bot runs: handlers, worker pools and answers.
+
+Without python-telegram-bot or botkit, the bot imports the stand-ins
+below instead. They implement what the bot uses, the telegram one over
+HTTP, so the bot still talks to the fake API.
+"""
+
+# Standard imports
+import os
+import sys
+import json
+import time
+import types
+import threading
+import urllib.request
+import importlib.util
+
+# External imports
+import pytest
+import numpy
+import cv2
+
+TELETURRET = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'teleturret')
+USERNAME = '@alice'
+
+def telegram_module():
+    """
+    Stand-in for the parts of python-telegram-bot 12 used by the bot
+    """
+    telegram = types.ModuleType('telegram')
+    ext = types.ModuleType('telegram.ext')
+    telegram.ext = ext
+
+    class Message:
+        def __init__(self, bot, data):
+            self.bot = bot
+            self.text = data.get('text')
+            self.chat = types.SimpleNamespace(**data['chat'])
+            self.chat_id = self.chat.id
+            self.from_user = types.SimpleNamespace(**data['from'])
+
+        def reply_text(self, text, **kwargs):
+            return self.bot.send_message(chat_id=self.chat_id, text=text, **kwargs)
+
+        def reply_photo(self, photo):
+            return self.bot.send_photo(chat_id=self.chat_id, photo=photo)
+
+    class Update:
+        def __init__(self, bot, data):
+            self.update_id = data['update_id']
+            self.message = Message(bot, data['message']) if 'message' in data else None
+            self.effective_message = self.message
+            self.callback_query = None
+
+    class Bot:
+        def __init__(self, token, base_url='https://api.telegram.org/bot'):
+            self.url = base_url + token
+
+        def call(self, method, **params):
+            request = urllib.request.Request('%s/%s' % (self.url, method), data=json.dumps(params).encode('utf-8'), headers={'Content-Type': 'application/json'})
+            with urllib.request.urlopen(request, timeout=params.get('timeout', 0) + 10) as response:
+                return json.loads(response.read().decode('utf-8'))['result']
+
+        def get_updates(self, offset, timeout):
+            return [Update(self, u) for u in self.call('getUpdates', offset=offset, timeout=timeout)]
+
+        def send_message(self, chat_id, text, reply_markup=None):
+            return self.call('sendMessage', chat_id=chat_id, text=text)
+
+        def send_photo(self, chat_id, photo):
+            # Uploads are sent as their size, as the fake records them
+            return self.call('sendPhoto', chat_id=chat_id, photo=len(photo.read()))
+
+        def send_media_group(self, chat_id, media):
+            return self.call('sendMediaGroup', chat_id=chat_id, media=json.dumps([{'type': 'photo', 'media': len(m.media.read())} for m in media]))
+
+    class InputMediaPhoto:
+        def __init__(self, media):
+            self.media = media
+
+    class InlineKeyboardButton:
+        def __init__(self, text, callback_data=None, url=None):
+            self.text, self.callback_data, self.url = text, callback_data, url
+
+    class InlineKeyboardMarkup:
+        def __init__(self, inline_keyboard):
+            self.inline_keyboard = inline_keyboard
+
+    class CommandHandler:
+        def __init__(self, command, callback):
+            self.command, self.callback = command, callback
+
+        def check(self, update):
+            return update.message is not None and (update.message.text or '').split(' ')[0] == '/' + self.command
+
+    class MessageHandler:
+        def __init__(self, filter, callback):
+            self.filter, self.callback = filter, callback
+
+        def check(self, update):
+            return self.filter(update)
+
+    class Updater:
+        def __init__(self, bot):
+            self.bot = bot
+            self.dispatcher = types.SimpleNamespace(handlers=list())
+            self.dispatcher.add_handler = self.dispatcher.handlers.append
+            self.stopped = threading.Event()
+            self.thread = None
+
+        def poll(self, poll_interval, timeout):
+            offset = 0
+            while not self.stopped.is_set():
+                for update in self.bot.get_updates(offset, timeout):
+                    offset = update.update_id + 1
+                    for handler in self.dispatcher.handlers:
+                        if handler.check(update):
+                            handler.callback(self.bot, update)
+                            break
+                self.stopped.wait(poll_interval)
+
+        def start_polling(self, poll_interval=0.0, timeout=10):
+            self.thread = threading.Thread(target=self.poll, args=(poll_interval, timeout), daemon=True)
+            self.thread.start()
+
+        def stop(self):
+            self.stopped.set()
+            self.thread.join()
+
+    telegram.Bot = Bot
+    telegram.InputMediaPhoto = InputMediaPhoto
+    telegram.InlineKeyboardButton = InlineKeyboardButton
+    telegram.InlineKeyboardMarkup = InlineKeyboardMarkup
+    ext.Updater = Updater
+    ext.CommandHandler = CommandHandler
+    ext.MessageHandler = MessageHandler
+    ext.Filters = types.SimpleNamespace(text=lambda update: update.message is not None and bool(update.message.text) and not update.message.text.startswith('/'))
+    return {'telegram': telegram, 'telegram.ext': ext}
+
+def botkit_module():
+    """
+    Stand-in for the parts of botkit used by the bot
+    """
+    botkit = types.ModuleType('botkit')
+    botkit.nlu = types.ModuleType('botkit.nlu')
+    botkit.answer = types.ModuleType('botkit.answer')
+
+    class NLU:
+        def __init__(self, disable=None):
+            pass
+
+    class Context:
+        def __load__(self):
+            return dict()
+
+    class AnswerProcessor:
+        def __init__(self, name):
+            self.name = name
+            self.intents = list()
+            self.callbacks = dict()
+
+        def set_callback(self, intent, callback):
+            self.intents.append(intent)
+            self.callbacks[intent] = callback
+
+    botkit.nlu.NLU = NLU
+    botkit.nlu.Context = Context
+    botkit.answer.AnswerProcessor = AnswerProcessor
+    return {'botkit': botkit, 'botkit.nlu': botkit.nlu, 'botkit.answer': botkit.answer}
+
+class NLU:
+    """
+    Intent of a text message is its first word
+    """
+    def compute(self, text):
+        return {'intent': text.split()[0]}
+
+class Processor:
+    """
+    Answer processor calling a function with the botkit message
+    """
+    def __init__(self, function):
+        self.function = function
+
+    def compute(self, message, message_data):
+        return self.function(message)
+
+def shared_modules():
+    return {name: module for name, module in sys.modules.items() if name == 'modules' or name.startswith('modules.')}
+
+@pytest.fixture
+def bot(tmp_path, monkeypatch):
+    """
+    Teleturret module polling a fake Telegram, with the fake as bot.fake
+    """
+    monkeypatch.chdir(tmp_path)
+    for package, stand_in in (('telegram', telegram_module), ('botkit', botkit_module)):
+        if importlib.util.find_spec(package) is None:
+            for name, module in stand_in().items(): monkeypatch.setitem(sys.modules, name, module)
+    # The bot has its own modules package, imported instead of the turret's
+    saved = shared_modules()
+    for name in saved: del sys.modules[name]
+    monkeypatch.syspath_prepend(TELETURRET)
+    from modules import faketelegram
+    fake = faketelegram.FakeTelegram()
+    with open('config.json', 'w') as config_file:
+        json.dump({'allowed': [USERNAME], 'keys': {'telegram': {'teleturretbot': '123:TEST'}}, 'api_url': fake.url}, config_file)
+    updater = None
+    try:
+        spec = importlib.util.spec_from_file_location('teleturret_bot', os.path.join(TELETURRET, 'teleturret.py'))
+        teleturret = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(teleturret)
+        monkeypatch.setattr(teleturret, 'turretbot', NLU())
+        monkeypatch.setattr(teleturret, 'link', dict())
+        updater = teleturret.build_updater(teleturret.config)
+        updater.start_polling(poll_interval=0.0, timeout=1)
+        teleturret.fake = fake
+        yield teleturret
+    finally:
+        if updater is not None: updater.stop()
+        fake.close()
+        if 'teleturret' in locals(): teleturret.context.flush()
+        for name in shared_modules(): del sys.modules[name]
+        sys.modules.update(saved)
+
+def test_intent_is_answered(bot):
+    bot.link['greetings'] = Processor(lambda message: [{'type': 'text', 'text': 'Hello ' + message['username']}])
+    bot.fake.send_text(USERNAME, 'greetings')
+    assert bot.fake.wait_sent('sendMessage')
+    assert bot.fake.sent('sendMessage')[0]['params']['text'] == 'Hello ' + USERNAME
+
+def test_album_is_split(bot, tmp_path):
+    ok, jpeg = cv2.imencode('.jpg', numpy.zeros((8, 8, 3), dtype=numpy.uint8))
+    urls = list()
+    for i in range(12):
+        url = str(tmp_path / ('%02d.jpg' % (i)))
+        with open(url, 'wb') as image: image.write(jpeg.tobytes())
+        urls.append(url)
+    bot.link['someone'] = Processor(lambda message: [{'type': 'image', 'url': url} for url in urls])
+    bot.fake.send_text(USERNAME, 'someone')
+    # 10 images in an album, then 2 in another one
+    assert bot.fake.wait_sent('sendMediaGroup', count=2)
+    albums = [json.loads(c['params']['media']) for c in bot.fake.sent('sendMediaGroup')]
+    assert [len(album) for album in albums] == [10, 2]
+
+def test_previous_heavy_job_is_cancelled(bot):
+    started = list()
+    release = threading.Event()
+    def who(message):
+        cancel = message['cancel']
+        started.append(cancel)
+        n = len(started)
+        while not cancel.is_set() and not release.is_set():
+            time.sleep(0.01)
+        return [{'type': 'text', 'text': 'Job %d' % (n)}]
+    bot.link['who'] = Processor(who)
+    bot.fake.send_text(USERNAME, 'who first')
+    deadline = time.monotonic() + 10.0
+    while len(started) < 1 and time.monotonic() < deadline: time.sleep(0.01)
+    bot.fake.send_text(USERNAME, 'who second')
+    while len(started) < 2 and time.monotonic() < deadline: time.sleep(0.01)
+    assert len(started) == 2
+    assert started[0].is_set()
+    assert not started[1].is_set()
+    release.set()
+    # Only the second job answers
+    assert bot.fake.wait_sent('sendMessage')
+    time.sleep(0.2)
+    assert [c['params']['text'] for c in bot.fake.sent('sendMessage')] == ['Job 2']
@@ -0,0 +1,44 @@
+""" Detection mode changes of turret.py
+"""
+
+# Standard imports
+import os
+import sys
+import json
+import locale
+import importlib.util
+
+# External imports
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+@pytest.fixture
+def turret(tmp_path, monkeypatch):
+    """
+    turret.py imported as a module, with a pipeline whose cascade OpenCV
+    rejects, haarcascade_smile, as the "smile" mode
+    """
+    pipelines = tmp_path / 'pipelines.json'
+    with open(str(pipelines), 'w') as pipelines_file:
+        json.dump({'smile': {'description': 'Smiles', 'stages': [{'cascade': 'haarcascade_smile'}]}}, pipelines_file)
+    monkeypatch.chdir(ROOT)
+    monkeypatch.setattr(sys, 'argv', ['turret.py', '--pipelines', str(pipelines)])
+    # Month names only matter for saved frames, the locale may be missing
+    monkeypatch.setattr(locale, 'setlocale', lambda *args: None)
+    spec = importlib.util.spec_from_file_location('turret', os.path.join(ROOT, 'turret.py'))
+    turret = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(turret)
+    yield turret
+    turret.detect.pipelines.pop('smile', None)
+    turret.detect.requirements.pop('smile', None)
+    turret.detect.mode_description.pop('smile', None)
+    if 'smile' in turret.detect.detection_modes: turret.detect.detection_modes.remove('smile')
+
+def test_rejected_cascade_keeps_mode(turret):
+    try: turret.detect.registry.load('haarcascade_smile')
+    except ValueError: pass
+    else: pytest.skip('this OpenCV version accepts haarcascade_smile')
+    assert turret.set_mode('motion')
+    assert not turret.set_mode('smile')
+    assert turret.MODE == 'motion'
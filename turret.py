@@ -14,20 +14,54 @@ if sys.platform == "linux" or sys.platform == "linux2":
                                     .  motion:               Motion detection function based on background subtraction.
                                     .  upperbody-face:       Upperbody and face detection
                                     .  face-recognition:     Face detection and recognition
+                                    .  people:               People detection with the HOG people detector of OpenCV
+                                    .  Cascade pipelines from resources/pipelines.json, e.g. eyes, palm, fist;
+                                    .  list the cascades and check the pipelines with python3 -m modules.cascades
+
+                                .  Available inputs:
+                                .  --------------------------------
+                                .  camera, camera:N:     First webcam found, or webcam number N (default)
+                                .  synthetic[:N]:        N synthetic frames, endless if N is missing
+                                .  DIRECTORY:            Images in a directory, e.g. a day in detected/
+                                .  FILE:                 A video file
+                                .  NAME=INPUT:           A named stream, repeat -i to serve several
+                                .                        streams, saved in detected/NAME/
+
+                                .  Profiling a running turret:
+                                .  --------------------------------
+                                .  kill -USR1 <pid>      Sample all threads, write profiles/turret-*.folded
 
                                 '''), formatter_class=argparse.RawDescriptionHelpFormatter,)
 
 parser.add_argument("-s", help="Turn on the turret's sound modules.", action="store_true")
 parser.add_argument("-g", help="Show a graphical user interface.", action="store_true")
 parser.add_argument("-d", help="Save images on disk hierarchically by date", action="store_true")
+parser.add_argument("-a", help="Save detected frames in a packed archive per day instead of one file each", action="store_true")
+parser.add_argument("-c", help="Save detections as clips, with the seconds before and after them, instead of single frames", action="store_true")
+parser.add_argument("--pre", help="Seconds recorded before a detection in clips (default 5)", type=float, default=5.0)
+parser.add_argument("--post", help="Seconds recorded after the last detection in clips (default 5)", type=float, default=5.0)
 parser.add_argument("-r", help="Rotate frame by specified angle")
 parser.add_argument("-m", help="The detection mode")
+parser.add_argument("-t", help="Run face and people detectors every T frames, tracking them in between (default 5, 1 to detect on every frame)", type=int, default=5)
+parser.add_argument("--pipelines", help="Cascade pipelines file, added to the detection modes (default resources/pipelines.json)", default="resources/pipelines.json")
+parser.add_argument("--hog", help="HOG people detector settings, e.g. scale=1.05,stride=8,padding=8,width=400,threads=4, see modules/detect.py")
+parser.add_argument("-i", help="The frame input, see available inputs below", action="append")
+parser.add_argument("--idle-fps", help="Frames per second taken from live inputs when the scene is still or dark (default 2, 0 to take every frame)", type=float, default=2.0)
+parser.add_argument("--active-seconds", help="Seconds at full rate after motion or a detection (default 10)", type=float, default=10.0)
+parser.add_argument("-p", help="Pace of recorded inputs: realtime (default) or fast", choices=["realtime", "fast"], default="realtime")
+parser.add_argument("--metrics", help="Serve Prometheus metrics on this localhost port", type=int)
+parser.add_argument("--metrics-log", help="Log a metrics summary every this many seconds", type=float)
+parser.add_argument("--profile", help="Seconds sampled on SIGUSR1 (default 10)", type=float, default=10.0)
 
 args = parser.parse_args()
 
 # Import standard packages
 import os
+import time
+STARTED = time.monotonic()
 import array
+import queue
+import collections
 import signal
 import locale
 import datetime
@@ -36,13 +70,21 @@ import threading
 # Import external packages
 import cv2
 import numpy
-from PIL import Image
 
 # Import project packages
-from modules import imgutils
 from modules import detect
-from modules import soundcat
 from modules import save
+from modules import preprocess
+from modules import source
+from modules import metrics
+from modules import profiler
+from modules import tracking
+from modules import recorder
+from modules import archive
+from modules import metadata
+from modules import facestore
+from modules import governor
+IMPORTED = time.monotonic()
 
 # Set locale (standardize month names to english)
 if sys.platform == "linux" or sys.platform == "linux2":
@@ -54,38 +96,51 @@ elif sys.platform == "win32":
 SPEAK = args.s or False
 GUI = args.g or False
 SAVE_TO_DISK = args.d or not GUI
+ARCHIVE = args.a
+CLIPS = args.c
+PRE_SECONDS = args.pre
+POST_SECONDS = args.post
 ROTATION = int(args.r or 0)
 MODE = args.m or 'motion'
+HOG = args.hog
+PIPELINES = args.pipelines
+TRACK = max(args.t, 1)
+INPUT = args.i
+PACE = args.p
+IDLE_FPS = args.idle_fps
+ACTIVE_SECONDS = args.active_seconds
+METRICS_PORT = args.metrics
+METRICS_LOG = args.metrics_log
+PROFILE_SECONDS = args.profile
 
 # Frame width and height
 WIDTH  = 640
 HEIGHT = 480
 
-# OpenCV camera settings
-CV_CAP_PROP_FRAME_WIDTH  = 3
-CV_CAP_PROP_FRAME_HEIGHT = 4
+# Camera streams
+streams = list()
+def parse_inputs(inputs):
+    """
+    Return (name, input) pairs from -i arguments.
+    A single unnamed input has no name and saves directly in detected/.
+    """
+    inputs = inputs or [None]
+    pairs = list()
+    for index, spec in enumerate(inputs):
+        name, sep, rest = (spec or '').partition('=')
+        if sep and name.isidentifier(): pairs.append((name, rest))
+        elif len(inputs) > 1: pairs.append(('stream%d' % (index), spec))
+        else: pairs.append((None, spec))
+    return pairs
 
-# Configure camera
-camera = None
 def init_camera():
     """
-    Initiate video capture using the first webcam found.
+    Open the frame inputs, by default the first webcam found.
     Set camera width and height settings.
     """
-    global camera
-    camera = cv2.VideoCapture(-1)
-    camera.set(CV_CAP_PROP_FRAME_WIDTH, WIDTH)
-    camera.set(CV_CAP_PROP_FRAME_HEIGHT, HEIGHT)
-    # Set camera settings
-    # sudo apt-get install v4l-utils
-    # v4l2-ctl --list-devices
-    # v4l2-ctl -d /dev/video0 --list-ctrls
-    # v4l2-ctl --set-ctrl=gain_automatic=0
-    # v4l2-ctl --set-ctrl=exposure=1000
-    # v4l2-ctl --get-ctrl=gain_automatic
-    # v4l2-ctl --get-ctrl=exposure
-    os.system('v4l2-ctl --set-ctrl=gain_automatic=0')
-    os.system('v4l2-ctl --set-ctrl=exposure=1000')
+    global streams
+    if not streams:
+        streams = [Stream(name, spec) for name, spec in parse_inputs(INPUT)]
 
 # Configure speaker
 speaker = None
@@ -94,11 +149,15 @@ def init_speaker():
     Initialize speaker modules
     """
     global speaker
-    if SPEAK:
-        speaker = soundcat.Soundcat(pps=1.0/5)
+    # The speaker and its mixer are created once and live until clean()
+    if SPEAK and speaker is None:
+        # pygame takes a while to import, only load it if the turret speaks
+        from modules import soundcat
+        speaker = soundcat.Speaker(rates={'detected': (1.0/5, 1)}, priorities={'init': 1, 'quit': 2})
         speaker.add_category('init', 'resources/sounds/init')
         speaker.add_category('detected', 'resources/sounds/detected')
         speaker.add_category('quit', 'resources/sounds/quit')
+        speaker.start()
 
 # Convert daily detections to a video
 timer = None
@@ -111,49 +170,271 @@ def convert_to_video():
     else:
         next_convert_time = now + datetime.timedelta(hours=12)
         next_convert_time.replace(hour=23, minute=50, second=0, microsecond=0)
-        save.video(now)
+        for stream in streams: save.video(now, root=stream.root)
     timer = threading.Timer((next_convert_time-now).seconds, convert_to_video)
     timer.setDaemon(True)
     timer.start()
 
-# Main operation
-def loop():
+# People detector settings
+if HOG:
+    try: detect.hog_settings.update(detect.parse_hog_settings(HOG))
+    except ValueError as error: parser.error(str(error))
+
+# Cascade pipelines, available as detection modes
+if os.path.exists(PIPELINES):
+    try: detect.load_pipelines(PIPELINES)
+    except ValueError as error: parser.error(str(error))
+
+# Stage latencies and counters, recorded only if metrics are exported
+meter = metrics.Metrics('turret', enabled=METRICS_PORT is not None or bool(METRICS_LOG))
+def init_metrics():
     """
-    Get a new frame from camera.
-    Process this frame according to current detection mode.
+    Start the metrics HTTP endpoint and log line, as requested
+    """
+    if METRICS_PORT is not None:
+        host, port = meter.serve(METRICS_PORT)
+        print("Metrics at http://%s:%d/metrics" % (host, port))
+    if METRICS_LOG:
+        meter.log_every(METRICS_LOG)
+
+# Time to first frame, reported once
+first_frame = None
+def report_startup():
+    """
+    Print the time from start to the first processed frame and what was
+    loaded for the detection modes in use
     """
-    global camera
+    global first_frame
+    first_frame = time.monotonic()
+    loaded = ', '.join('%s %.2fs' % (name, seconds) for name, seconds in sorted(detect.load_times.items()))
+    print("First frame %.2fs after start (imports %.2fs, models: %s)" % (first_frame - STARTED, IMPORTED - STARTED, loaded or 'none'))
 
-    # Capture frame
-    _, frame = camera.read()
+class Stream:
+    """
+    A camera stream and the state kept between its frames.
+    """
 
-    # Rotate if required
-    if ROTATION != 0:
-        frame = imgutils.rotate_bound(frame, ROTATION)
+    def __init__(self, name, spec):
+        """
+        Open the input and prepare the stream state
 
-    found = None
+        Streams share the detectors and face database loaded by
+        modules/detect.py. Named streams save in detected/<name>/.
+        """
+        self.name = name
+        self.root = 'detected' if name is None else '/'.join(('detected', name))
+        self.camera = source.open_source(spec, PACE, WIDTH, HEIGHT)
+        self.mode = MODE
+        detect.prepare(self.mode)
+        # Preprocessing stages keep cached state between frames
+        self.rotation = preprocess.Rotation(ROTATION)
+        self.timestamp = preprocess.Timestamp()
+        self.motion_buffer = collections.deque(maxlen=1)
+        self.trackers = dict()
+        # Clips are saved from a ring of recent frames, see modules/recorder.py
+        self.recorder = recorder.ClipRecorder(PRE_SECONDS, POST_SECONDS, root=self.root) if CLIPS else None
+        # Detected frames are appended to day packs, see modules/archive.py
+        self.archive = archive.Archive(self.root) if ARCHIVE else None
+        # Boxes, names and frame statistics of detections, see modules/metadata.py
+        self.metadata = metadata.Log(self.root)
+        # Encodings of the faces seen, searchable by example, see modules/facestore.py
+        self.faces = facestore.Log(self.root)
+        # Live inputs slow down while nothing happens, see modules/governor.py
+        self.governor = None
+        if IDLE_FPS > 0 and self.camera.live:
+            log = print if name is None else lambda m: print('%s: %s' % (name, m))
+            self.governor = governor.Governor(IDLE_FPS, IDLE_FPS, ACTIVE_SECONDS, log=log)
+
+    def capture(self):
+        """
+        Get a new frame from camera.
+        Return None if no frame could be read, or if the governor skipped it.
+        """
+        if self.governor is not None and not self.governor.due():
+            with meter.stage('skip'):
+                self.camera.skip()
+            meter.count('skipped')
+            return None
+        with meter.stage('capture'):
+            frame = self.camera.read()
+        if frame is None and not self.camera.finished:
+            meter.count('drops')
+        return frame
+
+    def process(self, frame, now=None):
+        """
+        Process a frame according to current detection mode.
+        Frames replayed from footage keep their original capture time.
+        """
+        meter.count('frames')
+        if self.governor is not None: meter.count('frames_%s' % (self.governor.state))
+
+        # Rotate if required
+        if ROTATION != 0:
+            with meter.stage('rotation'):
+                frame = self.rotation(frame)
+
+        found = None
+        boxes, scores, names = [], None, None
+        faces = []
+
+        # Process according to current detection mode
+        with meter.stage('detection'):
+            if self.governor is not None and not self.governor.watch(frame):
+                meter.count('detector_skips')
+            elif self.mode is None or self.mode == 'motion':
+                frame, found, boxes = detect.motion_detection(frame, thresh=50, drawboxes=False, buffer=self.motion_buffer, return_objects=True)
+            elif self.mode in detect.tracked_modes and TRACK > 1:
+                frame, found, tracks = self.track(frame)
+                boxes, names = [t.coords for t in tracks], [t.label for t in tracks]
+                # Faces are encoded once per visit, when their track starts
+                faces = [(t.coords, t.label, t.descriptor) for t in self.trackers[self.mode].created if t.descriptor is not None]
+            elif self.mode == 'upperbody-face':
+                frame, found, boxes = detect.double_cascade(frame, return_objects=True)
+            elif self.mode == 'face-recognition':
+                frame, found, faces = detect.face_recognition(frame, return_objects=True)
+                boxes, names = [coords for coords, _, _ in faces], [name for _, name, _ in faces]
+            elif self.mode == 'people':
+                frame, found, boxes, scores = detect.hog_people(frame, return_objects=True)
+            elif self.mode in detect.pipelines:
+                frame, found, boxes = detect.cascade_pipeline(frame, self.mode, return_objects=True, timer=meter.stage)
+        if self.governor is not None: self.governor.update(found)
+
+        # Save detections
+        now = now or datetime.datetime.now()
+        with meter.stage('overlay'):
+            self.timestamp(frame, now)
+
+        if SAVE_TO_DISK and self.recorder is not None:
+            with meter.stage('save'):
+                if not self.recorder.push(frame, now, found): meter.count('clip_drops')
+
+        if found:
+            meter.count('detections')
+            if SAVE_TO_DISK:
+                with meter.stage('metadata'):
+                    self.metadata.append(now, self.mode or 'motion', frame, boxes, scores, names)
+                    if faces: self.faces.append(now, [c for c, _, _ in faces], [e for _, _, e in faces], [n for _, n, _ in faces])
+            if SAVE_TO_DISK and self.recorder is None:
+                with meter.stage('save'):
+                    path = save.save(frame, now, self.root, self.archive)
+                if meter.enabled: meter.count('save_bytes', archive.size(path))
+            if SPEAK:
+                with meter.stage('sound'):
+                    speaker.play("detected")
+
+        if first_frame is None: report_startup()
+
+        return frame
+
+    def track(self, frame):
+        """
+        Detect faces every TRACK frames and follow them in between.
+        Recognized names follow their face, so each visit is recognized once.
+        Return the frame, the found state and the tracks.
+        """
+        tracker = self.trackers.get(self.mode)
+        if tracker is None:
+            detector, recognizer = detect.tracked_modes[self.mode]
+            tracker = self.trackers[self.mode] = tracking.Tracker(detector, recognizer, interval=TRACK)
+        tracks = tracker(frame)
+        if tracker.detected: meter.count('detector_runs')
+        frame = detect.draw_tracks(frame, self.mode, tracks)
+        return frame, len(tracks) > 0, tracks
+
+# Main operation, on the first stream
+def capture():
+    """
+    Get a new frame from camera.
+    Return None if no frame could be read.
+    """
+    return streams[0].capture()
 
-    # Process according to current detection mode
-    if MODE is None or MODE == 'motion':
-        frame, found = detect.motion_detection(frame, thresh=50, drawboxes=False)
-    elif MODE == 'upperbody-face':
-        frame, found = detect.double_cascade(frame)
-    elif MODE == 'face-recognition':
-        frame, found = detect.face_recognition(frame)
+def process(frame, now=None):
+    """
+    Process a frame according to current detection mode.
+    Frames replayed from footage keep their original capture time.
+    """
+    return streams[0].process(frame, now)
 
-    # Save detections
-    now = datetime.datetime.now()
-    timestr = '%02d/%02d/%04d %02d:%02d:%02d' % (now.day, now.month, now.year, now.hour, now.minute, now.second)
-    font = cv2.FONT_HERSHEY_PLAIN
-    color= (255, 255, 255) if numpy.mean(frame[0:30,0:120])/255 < 0.6 else (0, 0, 0)
-    cv2.putText(frame, timestr, (5, 20), font, 1.2, color, 0, 4)
+def loop():
+    """
+    Get a new frame from camera.
+    Process this frame according to current detection mode.
+    Return None if no frame could be read.
+    """
+    frame = capture()
+    if frame is None: return None
+    with meter.stage('frame'):
+        return process(frame, streams[0].camera.frame_time)
 
-    if found:
-        if SAVE_TO_DISK: save.save(frame, now)
-        if SPEAK: speaker.play("detected", use_pps=True)
+class Multiplexer:
+    """
+    A class to serve several camera streams from one process.
 
-    return frame
+    Each stream is captured by its own thread. A single detection thread
+    processes the newest frame of each stream in turn, so detectors and
+    the face database are loaded once and shared. Live streams skip
+    frames the detector could not keep up with; recorded streams replayed
+    at fast pace wait for the detector instead.
+    """
 
+    def __init__(self, streams):
+        """
+        Multiplexer constructor
+        """
+        self.streams = streams
+        self.latest = dict()
+        self.ready = queue.Queue()
+        self.cond = threading.Condition()
+        self.running = False
+
+    def capture_loop(self, stream):
+        """
+        Capture frames from a stream until it is finished
+        """
+        while self.running and not stream.camera.finished:
+            frame = stream.capture()
+            if frame is None: continue
+            with self.cond:
+                while not stream.camera.live and stream in self.latest and self.running:
+                    self.cond.wait()
+                if stream in self.latest: meter.count('drops')
+                else: self.ready.put(stream)
+                self.latest[stream] = (frame, stream.camera.frame_time)
+        self.ready.put(None)
+
+    def run(self, between=None, on_frame=None):
+        """
+        Process frames until every stream is finished, or until stopped
+        between() is called before each frame, e.g. to apply settings changes,
+        and on_frame(stream, frame, seconds) after each processed frame
+        """
+        self.running = True
+        for stream in self.streams:
+            threading.Thread(target=self.capture_loop, args=(stream,), daemon=True).start()
+        remaining = len(self.streams)
+        while remaining > 0:
+            stream = self.ready.get()
+            if stream is None:
+                remaining -= 1
+                continue
+            if between is not None: between()
+            with self.cond:
+                frame, frame_time = self.latest.pop(stream)
+                self.cond.notify_all()
+            start = time.monotonic()
+            with meter.stage('frame'):
+                frame = stream.process(frame, frame_time)
+            if on_frame is not None: on_frame(stream, frame, time.monotonic() - start)
+
+    def stop(self):
+        """
+        Stop capturing
+        """
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
 
 class Cli:
     """
@@ -173,8 +454,131 @@ class Cli:
         Run loop
         """
         print("Turret is on!")
+        if len(streams) > 1:
+            print("Serving streams: %s" % (', '.join(stream.name for stream in streams)))
+            Multiplexer(streams).run()
+        else:
+            while not streams[0].camera.finished:
+                loop()
+        print("Input finished.")
+
+class Pipeline:
+    """
+    A class to capture and process frames in a background thread.
+    Every stream is processed with the settings of the GUI, the first one
+    is displayed.
+    """
+
+    def __init__(self, on_frame):
+        """
+        Pipeline constructor
+
+        on_frame(frame, stats) is called from the pipeline thread after
+        each processed frame. Stats hold the processing rate (fps), the
+        time spent processing the last frame (latency, in seconds) and the
+        number of settings changes waiting to be applied (queue).
+        """
+        self.on_frame = on_frame
+        self.commands = queue.Queue()
+        self.running = False
+        self.thread = None
+        self.multiplexer = None
+        self.fps = 0.0
+        self.last = time.monotonic()
+
+    def post(self, function, *args):
+        """
+        Schedule function(*args) to run in the pipeline thread, between frames.
+        Safe to call from any thread.
+        """
+        self.commands.put((function, args))
+
+    def start(self):
+        """
+        Start the pipeline thread
+        """
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stop the pipeline thread and wait for it
+        """
+        self.running = False
+        if self.multiplexer is not None: self.multiplexer.stop()
+        if self.thread is not None: self.thread.join(timeout=1)
+
+    def run(self):
+        """
+        Apply pending settings changes, then capture and process a frame
+        Several streams are captured by a Multiplexer, and settings changes
+        are applied between their frames
+        """
+        if len(streams) > 1:
+            self.multiplexer = Multiplexer(streams)
+            self.multiplexer.run(self.apply, self.processed)
+            return
+        while self.running:
+            self.apply()
+            frame = capture()
+            if frame is None:
+                if streams[0].camera.finished: break
+                continue
+            start = time.monotonic()
+            frame = process(frame, streams[0].camera.frame_time)
+            meter.observe('frame', time.monotonic() - start)
+            self.processed(streams[0], frame, time.monotonic() - start)
+
+    def apply(self):
+        """
+        Run the settings changes posted since the last frame
+        """
         while True:
-            loop()
+            try: function, args = self.commands.get_nowait()
+            except queue.Empty: break
+            function(*args)
+
+    def processed(self, stream, frame, seconds):
+        """
+        Hand the frames of the first stream to on_frame, with their stats
+        """
+        if stream is not streams[0]: return
+        end = time.monotonic()
+        self.fps = 0.9*self.fps + 0.1/max(end - self.last, 1e-6)
+        self.last = end
+        self.on_frame(frame, {'fps': self.fps, 'latency': seconds, 'queue': self.commands.qsize()})
+
+def set_speak(speak):
+    """
+    Turn the speaker modules on or off.
+    """
+    global SPEAK
+    SPEAK = speak
+    init_speaker()
+
+def set_save_to_disk(save_to_disk):
+    """
+    Turn saving detections on or off.
+    """
+    global SAVE_TO_DISK
+    SAVE_TO_DISK = save_to_disk
+
+def set_mode(mode):
+    """
+    Change the detection mode of every stream.
+    The previous mode is kept if what the new one needs can not be loaded,
+    e.g. a cascade rejected by this OpenCV version.
+    Return True if the mode was changed.
+    """
+    global MODE
+    try: detect.prepare(mode)
+    except ValueError as error:
+        print("Can not use detection mode %s, keeping %s: %s" % (mode, MODE, error))
+        return False
+    MODE = mode
+    for stream in streams: stream.mode = mode
+    return True
 
 class Gui:
     """
@@ -200,6 +604,14 @@ class Gui:
         self.SaveToDiskSwitch = self.gtk.get_object("SaveToDiskSwitch")
         self.DetectionModeCombo = self.gtk.get_object("DetectionModeCombo")
 
+        # Detection runs in the pipeline thread, which hands the newest
+        # annotated frame to update_frame()
+        self.rgb = None
+        self.latest = None
+        self.pending = False
+        self.frame_lock = threading.Lock()
+        self.pipeline = Pipeline(self.new_frame)
+
         self.init_speak_switch()
         self.init_savetodisk_switch()
         self.init_detectionmode_combo()
@@ -207,7 +619,7 @@ class Gui:
         init_camera()
         init_speaker()
 
-        GLib.idle_add(self.update_frame)
+        self.pipeline.start()
 
         if GUI:
             self.MainWindow = self.gtk.get_object("MainWindow")
@@ -229,9 +641,7 @@ class Gui:
         SPEAK defines if the turret speaker modules are on or off.
         The state of the speak switch updates the global variable SPEAK.
         """
-        global SPEAK
-        SPEAK = self.SpeakSwitch.get_active()
-        init_speaker()
+        self.pipeline.post(set_speak, self.SpeakSwitch.get_active())
 
     def init_savetodisk_switch(self):
         """
@@ -247,8 +657,7 @@ class Gui:
         The state of the save on disk switch updates the global variable SAVE_TO_DISK.
         It Also changes the state of cloud backup switches and variables.
         """
-        global SAVE_TO_DISK
-        SAVE_TO_DISK = self.SaveToDiskSwitch.get_active()
+        self.pipeline.post(set_save_to_disk, self.SaveToDiskSwitch.get_active())
 
     def init_detectionmode_combo(self):
         """
@@ -265,8 +674,18 @@ class Gui:
         MODE defines the detection algorithm our turret is running
         The selected option updates the global variable MODE.
         """
-        global MODE
-        MODE = self.DetectionModeCombo.get_active_id()
+        self.pipeline.post(self.select_mode, self.DetectionModeCombo.get_active_id())
+
+    def select_mode(self, mode):
+        """
+        Change the detection mode, from the pipeline thread.
+        If the mode can not be used, the combo shows the mode kept again.
+        """
+        if set_mode(mode): return
+        def reset():
+            self.DetectionModeCombo.set_active_id(MODE)
+            return False
+        GLib.idle_add(reset)
 
     def close_button_pressed(self, widget, event):
         """
@@ -275,30 +694,65 @@ class Gui:
         Execute clean() method, for other resources deallocations.
         Then, actually shut down the poor turret with Gtk.main_quit().
         """
+        self.pipeline.stop()
         clean()
         Gtk.main_quit()
 
+    def new_frame(self, frame, stats):
+        """
+        Called from the pipeline thread for each processed frame.
+        Keep only the newest frame and schedule a single update_frame() for it,
+        so the main loop sleeps while there is no new frame.
+        """
+        # The rotated frame buffer is reused by the next frame
+        if ROTATION != 0: frame = frame.copy()
+        with self.frame_lock:
+            # A frame not yet shown is replaced by the newer one
+            if self.latest is not None: meter.count('display_drops')
+            self.latest = (frame, stats)
+            if self.pending: return
+            self.pending = True
+        GLib.idle_add(self.update_frame)
+
     def update_frame(self):
         """
-        Calls loop, updates frame
+        Shows the newest processed frame and live stats
         """
-        frame = loop()
+        with self.frame_lock:
+            latest, self.latest = self.latest, None
+            self.pending = False
+        if latest is None: return False
+        frame, stats = latest
 
-        # Convert OpenCV image format to GDK Pixbuf
+        # Convert OpenCV image format to GDK Pixbuf, reusing the RGB buffer
         h, w, _ = frame.shape
-        frame_show = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-        pixbuf = GdkPixbuf.Pixbuf.new_from_data(frame_show.flatten(), GdkPixbuf.Colorspace.RGB, False, 8, w, h, w*3, None, None)
+        if self.rgb is None or self.rgb.shape != frame.shape:
+            self.rgb = numpy.empty_like(frame)
+        cv2.cvtColor(frame, cv2.COLOR_BGR2RGB, dst=self.rgb)
+
+        # Overlay stats, on the displayed copy only
+        statstr = '%.1f fps  detect %.0f ms  queue %d' % (stats['fps'], 1000*stats['latency'], stats['queue'])
+        cv2.putText(self.rgb, statstr, (5, h - 10), cv2.FONT_HERSHEY_PLAIN, 1.0, (255, 255, 0), 1, cv2.LINE_AA)
+        # GLib.Bytes copies the buffer once per frame, the Pixbuf then
+        # wraps that copy; PyGObject can not fill an existing Pixbuf
+        pixbuf = GdkPixbuf.Pixbuf.new_from_bytes(GLib.Bytes.new(self.rgb.data), GdkPixbuf.Colorspace.RGB, False, 8, w, h, w*3)
         self.Frame.set_from_pixbuf(pixbuf)
 
-        return True
+        return False
 
 def clean():
     """
     Use this to close the turret's modules when shutting down.
     """
     if SPEAK: speaker.play('quit')
-    global camera
-    camera.release()
+    if speaker is not None: speaker.stop()
+    meter.stop()
+    for stream in streams:
+        stream.camera.release()
+        if stream.recorder is not None: stream.recorder.stop()
+        if stream.archive is not None: stream.archive.close()
+        stream.metadata.close()
+        stream.faces.close()
 
 def sigint_handler(signum, instant):
     """
@@ -312,6 +766,12 @@ if __name__ == "__main__":
     # Activate capture of SIGINT (Ctrl-C)
     signal.signal(signal.SIGINT, sigint_handler)
 
+    # Profile all threads on SIGUSR1
+    profiler.install(duration=PROFILE_SECONDS, prefix='turret')
+
+    # Export metrics, if requested
+    init_metrics()
+
     # Convert detections to video every day
     # convert_to_video()
 
@@ -333,3 +793,4 @@ if __name__ == "__main__":
 
         cli = Cli()
         cli.start()
+        clean()